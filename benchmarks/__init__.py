@@ -0,0 +1,5 @@
+"""Benchmarks for the data layer and gallery pipeline.
+
+Run with ``python -m benchmarks --help``. Results are emitted as JSON so they can be compared
+across commits.
+"""
@@ -0,0 +1,144 @@
+"""Generates a synthetic library, runs the selected scenarios and emits the results as JSON."""
+
+import fnmatch
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from typing import Any, Dict
+
+from imgtag import data
+from imgtag.roots import init_roots
+from imgtag.settings import Root
+from imgtag.shards import SHARD_BY_OPTIONS
+
+from .scenarios import SCENARIOS, Context
+from .synthetic import (bind_database, generate_database, generate_tree, make_tagnames,
+                        shard_database)
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark the data layer and gallery pipeline')
+    parser.add_argument('--files', help='Number of files', type=int, default=10000)
+    parser.add_argument('--tags', help='Size of the tag vocabulary', type=int, default=1000)
+    parser.add_argument('--tags-per-file', help='Mean tags per file', type=int, default=6)
+    parser.add_argument('--zipf',
+                        help='Zipf exponent for tag frequencies',
+                        type=float,
+                        default=1.1)
+    parser.add_argument('--dirs', help='Number of directories', type=int, default=100)
+    parser.add_argument('--image-size', help='Width/height of images', type=int, default=64)
+    parser.add_argument('--repeat', help='Repetitions per scenario', type=int, default=5)
+    parser.add_argument('--seed', help='Random seed', type=int, default=0)
+    parser.add_argument('--shard-by',
+                        help='Split file tags into shards (spreading files over 5 years)',
+                        choices=SHARD_BY_OPTIONS,
+                        default='none')
+    parser.add_argument('--scenario',
+                        help='Only run scenarios matching this glob (repeatable)',
+                        action='append')
+    parser.add_argument('--workdir', help='Directory for the synthetic library (default: temp)')
+    parser.add_argument('--output', help='Write JSON results to this file (default: stdout)')
+    parser.add_argument('--list', help='List scenarios and exit', action='store_true')
+
+    args = parser.parse_args()
+
+    if args.list:
+        print('\n'.join(SCENARIOS))
+        sys.exit()
+
+    names = [
+        name for name in SCENARIOS
+        if not args.scenario or any(fnmatch.fnmatch(name, pat) for pat in args.scenario)
+    ]
+
+    with tempfile.TemporaryDirectory(prefix='imgtag-bench-') as tmpdir:
+        workdir = args.workdir or tmpdir
+        ctx = setup_library(workdir, args)
+        results = {name: run_scenario(name, ctx, args.repeat) for name in names}
+
+    report = {
+        'commit': _git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'params': {k: v
+                   for k, v in vars(args).items() if k not in ('output', 'workdir', 'list')},
+        'results': results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+        print(f'Wrote results to {args.output}', file=sys.stderr)
+    else:
+        print(output)
+
+
+def setup_library(workdir: str, args) -> Context:
+    db_filepath = os.path.join(workdir, 'bench.db')
+    root_dir = os.path.join(workdir, 'images')
+
+    print(f'Generating database with {args.files} files and {args.tags} tags', file=sys.stderr)
+    filenames = generate_database(db_filepath, args.files, args.tags, args.tags_per_file,
+                                  args.zipf, args.seed)
+    print(f'Generating {args.files} images in {args.dirs} directories', file=sys.stderr)
+    filepaths = generate_tree(root_dir,
+                              filenames,
+                              args.dirs,
+                              image_size=args.image_size,
+                              seed=args.seed)
+    # Stale paths are re-resolved against the configured roots, which must not be the real library
+    init_roots([Root('bench', root_dir, priority=0, concurrency=4, stale_after=300)])
+    if args.shard_by != 'none':
+        print(f'Sharding file tags by {args.shard_by}', file=sys.stderr)
+        shard_database(os.path.join(workdir, 'shards'), args.shard_by, filepaths, seed=args.seed)
+
+    return Context(db_filepath, root_dir, filenames, filepaths, make_tagnames(args.tags),
+                   args.seed)
+
+
+def run_scenario(name: str, ctx: Context, repeat: int) -> Dict[str, Any]:
+    print(f'Running {name}', file=sys.stderr)
+    # Reconnect so that each scenario starts with a fresh connection
+    bind_database(ctx.db_filepath)
+    case = SCENARIOS[name](ctx)
+
+    timings = []
+    ops = 0
+    for _ in range(repeat):
+        # Every repetition starts cold
+        data.clear_caches()
+        if case.setup:
+            case.setup()
+        start = time.perf_counter()
+        ops = case.run()
+        timings.append(time.perf_counter() - start)
+
+    median = statistics.median(timings)
+    return {
+        'ops': ops,
+        'min_s': min(timings),
+        'median_s': median,
+        'mean_s': statistics.mean(timings),
+        'max_s': max(timings),
+        'ops_per_s': ops / median if median else None,
+    }
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'],
+                              capture_output=True,
+                              text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,316 @@
+"""Timed benchmark scenarios.
+
+Each scenario is a factory taking a `Context` and returning a `Case`. The optional `setup` is run
+(untimed) before every repetition, and `run` returns the number of operations performed so that
+throughput can be reported alongside latency.
+"""
+
+import os
+import random
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+from imgtag import data
+from imgtag.accel import TagIndex
+from imgtag.analytics import compute_stats
+from imgtag.backup import backup_db, export_tags
+from imgtag.cooccurrence import CooccurrenceIndex
+from imgtag.data import File
+from imgtag.metadata import refresh_metadata
+from imgtag.roots import get_root_indexes
+from imgtag.shards import get_shards
+from imgtag.untagged import iter_untagged
+
+
+class Context(NamedTuple):
+    """Everything a scenario needs to know about the synthetic library."""
+    db_filepath: str
+    root_dir: str
+    filenames: List[str]
+    filepaths: List[str]
+    tagnames: List[str]
+    seed: int
+
+
+class Case(NamedTuple):
+    run: Callable[[], int]
+    setup: Optional[Callable[[], None]] = None
+
+
+SCENARIOS: Dict[str, Callable[[Context], Case]] = {}
+
+# Number of files sampled for per-file scenarios
+SAMPLE_SIZE = 200
+
+
+def scenario(name: str) -> Callable:
+    """Registers a scenario factory under the given name."""
+    def register(factory: Callable[[Context], Case]) -> Callable[[Context], Case]:
+        SCENARIOS[name] = factory
+        return factory
+
+    return register
+
+
+# -- Data layer
+
+
+@scenario('get_files_with_tags.common_pair')
+def files_with_common_pair(ctx: Context) -> Case:
+    # The two most popular tags, i.e. the largest intermediate sets
+    return Case(_once(lambda: data.get_files_with_tags(ctx.tagnames[:2])))
+
+
+@scenario('get_files_with_tags.common_and_rare')
+def files_with_common_and_rare(ctx: Context) -> Case:
+    tagnames = [ctx.tagnames[0], ctx.tagnames[len(ctx.tagnames) // 2]]
+    return Case(_once(lambda: data.get_files_with_tags(tagnames)))
+
+
+@scenario('get_files_with_tags.exclusion')
+def files_with_exclusion(ctx: Context) -> Case:
+    return Case(_once(lambda: data.get_files_with_tags(ctx.tagnames[:1], ctx.tagnames[1:4])))
+
+
+@scenario('accel.build')
+def accel_build(ctx: Context) -> Case:
+    return Case(_once(TagIndex.build))
+
+
+@scenario('accel.search.common_pair')
+def accel_common_pair(ctx: Context) -> Case:
+    index = TagIndex.build()
+    return Case(_once(lambda: index.search(ctx.tagnames[:2])))
+
+
+@scenario('accel.search.exclusion')
+def accel_exclusion(ctx: Context) -> Case:
+    index = TagIndex.build()
+    return Case(_once(lambda: index.search(ctx.tagnames[:1], ctx.tagnames[1:4])))
+
+
+@scenario('cooccurrence.build')
+def cooccurrence_build(ctx: Context) -> Case:
+    return Case(_once(CooccurrenceIndex.build))
+
+
+@scenario('cooccurrence.related_tags')
+def cooccurrence_related_tags(ctx: Context) -> Case:
+    index = CooccurrenceIndex.build()
+    tagnames = [ctx.tagnames[0], ctx.tagnames[len(ctx.tagnames) // 2]]
+    return Case(_once(lambda: index.related_tags(tagnames)))
+
+
+@scenario('cooccurrence.facets')
+def cooccurrence_facets(ctx: Context) -> Case:
+    # Facets of the results for the most popular tag, i.e. the largest result set
+    index = CooccurrenceIndex.build()
+    filenames = data.get_files_with_tags(ctx.tagnames[:1])
+    return Case(_once(lambda: index.facets(filenames, excluded_tagnames=ctx.tagnames[:1])))
+
+
+@scenario('get_file_tags')
+def file_tags(ctx: Context) -> Case:
+    filenames = _sample(ctx, ctx.filenames)
+
+    def run() -> int:
+        for filename in filenames:
+            data.get_file_tags(filename)
+        return len(filenames)
+
+    return Case(run)
+
+
+@scenario('get_all_tags')
+def all_tags(ctx: Context) -> Case:
+    return Case(_once(data.get_all_tags))
+
+
+@scenario('search_tags.substring')
+def tags_substring(ctx: Context) -> Case:
+    return Case(_once(lambda: data.search_tags('000')))
+
+
+@scenario('search_tags.fuzzy')
+def tags_fuzzy(ctx: Context) -> Case:
+    # Transposed digits, so there is no substring match
+    name = ctx.tagnames[len(ctx.tagnames) // 2]
+    return Case(_once(lambda: data.search_tags(name[:-2] + name[-1] + name[-2] + 'x')))
+
+
+@scenario('get_file_paths.cached')
+def file_paths_cached(ctx: Context) -> Case:
+    filenames = _sample(ctx, ctx.filenames)
+    paths = dict(zip(ctx.filenames, ctx.filepaths))
+
+    def setup():
+        _set_paths({filename: paths[filename] for filename in filenames})
+
+    def run() -> int:
+        data.get_file_paths(filenames)
+        return len(filenames)
+
+    return Case(run, setup)
+
+
+@scenario('get_file_paths.stale')
+def file_paths_stale(ctx: Context) -> Case:
+    # Cached paths point to a location that no longer exists, as after moving a directory
+    filenames = _sample(ctx, ctx.filenames)
+
+    def setup():
+        _set_paths(
+            {filename: os.path.join(ctx.root_dir, 'moved', filename)
+             for filename in filenames})
+
+    def run() -> int:
+        data.get_file_paths(filenames)
+        return len(filenames)
+
+    return Case(run, setup)
+
+
+@scenario('_resolve_filepath')
+def resolve_filepath(ctx: Context) -> Case:
+    # Lookups in an up-to-date root index
+    filenames = _sample(ctx, ctx.filenames, SAMPLE_SIZE // 10)
+
+    def setup():
+        for index in get_root_indexes():
+            index.scan(if_stale=True)
+
+    def run() -> int:
+        for filename in filenames:
+            data._resolve_filepath(filename)
+        return len(filenames)
+
+    return Case(run, setup)
+
+
+@scenario('roots.scan')
+def roots_scan(ctx: Context) -> Case:
+    def run() -> int:
+        for index in get_root_indexes():
+            index.scan()
+        return len(ctx.filepaths)
+
+    return Case(run)
+
+
+@scenario('metadata.refresh.all')
+def metadata_refresh_all(ctx: Context) -> Case:
+    def setup():
+        File.update(size=None, mtime=None).execute()
+
+    return Case(lambda: refresh_metadata([ctx.root_dir]), setup)
+
+
+@scenario('metadata.refresh.unchanged')
+def metadata_refresh_unchanged(ctx: Context) -> Case:
+    # Only stats files
+    def setup():
+        refresh_metadata([ctx.root_dir])
+
+    return Case(lambda: len(ctx.filepaths) - refresh_metadata([ctx.root_dir]), setup)
+
+
+@scenario('get_files_with_tags.filtered_sorted')
+def files_filtered_sorted(ctx: Context) -> Case:
+    def setup():
+        refresh_metadata([ctx.root_dir])
+
+    return Case(
+        _once(lambda: data.get_files_with_tags(
+            ctx.tagnames[:1], filters=[('width', '>=', 1)], sort='mtime', descending=True)), setup)
+
+
+@scenario('untagged.scan')
+def untagged_scan(ctx: Context) -> Case:
+    # Walks the whole tree, as when few images are left to tag
+    def run() -> int:
+        for _ in iter_untagged([ctx.root_dir]):
+            pass
+        return len(ctx.filepaths)
+
+    return Case(run)
+
+
+@scenario('get_untagged_files')
+def untagged_files(ctx: Context) -> Case:
+    return Case(_once(data.get_untagged_files))
+
+
+# -- Gallery
+
+
+@scenario('thumbnails')
+def thumbnails(ctx: Context) -> Case:
+    # Imported here so that the data-layer scenarios don't need to spin up Qt
+    from PySide2.QtCore import QThreadPool
+    from PySide2.QtGui import QPixmap
+    from PySide2.QtWidgets import QApplication
+
+    from imgtag.widgets.gallery import GalleryView, IconWorker
+
+    app = QApplication.instance() or QApplication([])
+    filepaths = _sample(ctx, ctx.filepaths)
+
+    def run() -> int:
+        thread_pool = QThreadPool()
+        results: List[tuple] = []
+        for filepath in filepaths:
+            worker = IconWorker(filepath, GalleryView.thumbnail_height)
+            worker.signal.result.connect(results.append)
+            thread_pool.start(worker)
+        thread_pool.waitForDone()
+        app.processEvents()
+        # Pixmaps can only be created on the GUI thread, as the gallery model does
+        for (_filepath, image, _label) in results:
+            QPixmap.fromImage(image)
+        return len(results)
+
+    return Case(run)
+
+
+@scenario('backup.stepped')
+def backup_stepped(ctx: Context) -> Case:
+    dest = os.path.join(os.path.dirname(ctx.db_filepath), 'backup.db')
+    return Case(_once(lambda: backup_db(dest, src=ctx.db_filepath, shards=get_shards())))
+
+
+@scenario('backup.compact')
+def backup_compact(ctx: Context) -> Case:
+    dest = os.path.join(os.path.dirname(ctx.db_filepath), 'backup.db')
+    return Case(
+        _once(lambda: backup_db(dest, compact=True, src=ctx.db_filepath, shards=get_shards())))
+
+
+@scenario('backup.export_tags')
+def backup_export_tags(ctx: Context) -> Case:
+    dest = os.path.join(os.path.dirname(ctx.db_filepath), 'tags.tsv')
+    return Case(lambda: export_tags(dest, src=ctx.db_filepath))
+
+
+@scenario('analytics.compute')
+def analytics_compute(ctx: Context) -> Case:
+    return Case(_once(compute_stats))
+
+
+# -- Helpers
+
+
+def _once(func: Callable) -> Callable[[], int]:
+    def run() -> int:
+        func()
+        return 1
+
+    return run
+
+
+def _sample(ctx: Context, population: list, k: int = SAMPLE_SIZE) -> list:
+    return random.Random(ctx.seed).sample(population, min(k, len(population)))
+
+
+def _set_paths(paths: Dict[str, str]):
+    with data.db.atomic():
+        for filename, path in paths.items():
+            File.update(path=path).where(File.name == filename).execute()
@@ -0,0 +1,145 @@
+"""Generates synthetic image libraries (databases and directory trees) for benchmarking."""
+
+import itertools
+import os
+import random
+import shutil
+import struct
+import time
+import zlib
+from typing import Dict, List
+
+from imgtag.data import File, FileTag, Tag, chunks, db, init_db
+
+# Seconds per (non-leap) year
+YEAR = 365 * 24 * 3600
+
+
+def make_filenames(n_files: int) -> List[str]:
+    """Returns deterministic unique image filenames."""
+    return [f'img_{i:08d}.png' for i in range(n_files)]
+
+
+def make_tagnames(n_tags: int) -> List[str]:
+    """Returns deterministic unique tag names, in descending order of popularity."""
+    return [f'tag_{i:06d}' for i in range(n_tags)]
+
+
+def zipf_weights(n: int, s: float) -> List[float]:
+    """Returns (unnormalized) Zipf weights for ranks 1..n with exponent s."""
+    return [1 / (rank**s) for rank in range(1, n + 1)]
+
+
+def generate_database(db_filepath: str,
+                      n_files: int,
+                      n_tags: int,
+                      tags_per_file: int,
+                      zipf_s: float = 1.1,
+                      seed: int = 0) -> List[str]:
+    """Creates a fresh database at the given path and binds the data layer to it.
+
+    Each file gets between 0 and 2 * `tags_per_file` distinct tags, drawn from a Zipf distribution
+    over the tag vocabulary so that a few tags are very common and most are rare. Returns the
+    generated filenames.
+    """
+    if os.path.exists(db_filepath):
+        os.remove(db_filepath)
+    bind_database(db_filepath)
+    init_db()
+
+    rng = random.Random(seed)
+    filenames = make_filenames(n_files)
+    tagnames = make_tagnames(n_tags)
+    tag_ids = list(range(1, n_tags + 1))
+    cum_weights = list(itertools.accumulate(zipf_weights(n_tags, zipf_s)))
+
+    with db.atomic():
+        for rows in chunks([{'name': name} for name in filenames]):
+            File.insert_many(rows).execute()
+        for rows in chunks([{'name': name} for name in tagnames]):
+            Tag.insert_many(rows).execute()
+
+    # IDs are assigned sequentially from 1 on a fresh database
+    filetags: List[Dict[str, int]] = []
+    for file_id in range(1, n_files + 1):
+        n = rng.randint(0, 2 * tags_per_file)
+        chosen = set(rng.choices(tag_ids, cum_weights=cum_weights, k=n))
+        filetags.extend({'fil': file_id, 'tag': tag_id} for tag_id in sorted(chosen))
+    with db.atomic():
+        for rows in chunks(filetags):
+            FileTag.insert_many(rows).execute()
+
+    return filenames
+
+
+def shard_database(shard_dir: str,
+                   shard_by: str,
+                   filepaths: List[str],
+                   n_years: int = 5,
+                   seed: int = 0):
+    """Records the files' paths and spreads their modification times over the last `n_years`
+    years, then moves their tags into fresh shards (see `imgtag.shards`).
+    """
+    rng = random.Random(seed)
+    now = time.time()
+    rows = [(filepath, now - rng.random() * n_years * YEAR, os.path.basename(filepath))
+            for filepath in filepaths]
+    with db.atomic():
+        db.connection().executemany('UPDATE file SET path = ?, mtime = ? WHERE name = ?', rows)
+    if os.path.exists(shard_dir):
+        shutil.rmtree(shard_dir)
+    init_db(shard_by, shard_dir)
+
+
+def bind_database(db_filepath: str):
+    """Points the data layer at the given database file."""
+    if not db.is_closed():
+        db.close()
+    db.init(db_filepath)
+
+
+def generate_tree(root_dir: str,
+                  filenames: List[str],
+                  n_dirs: int,
+                  max_depth: int = 3,
+                  image_size: int = 64,
+                  seed: int = 0) -> List[str]:
+    """Writes a small PNG for each filename into a random directory tree under `root_dir`.
+
+    Returns the full paths of the written images.
+    """
+    rng = random.Random(seed)
+    dirpaths = [root_dir]
+    for i in range(n_dirs):
+        parent = rng.choice([d for d in dirpaths if _depth(root_dir, d) < max_depth])
+        dirpaths.append(os.path.join(parent, f'dir_{i:05d}'))
+    for dirpath in dirpaths:
+        os.makedirs(dirpath, exist_ok=True)
+
+    filepaths = []
+    for filename in filenames:
+        filepath = os.path.join(rng.choice(dirpaths), filename)
+        color = (rng.randrange(256), rng.randrange(256), rng.randrange(256))
+        with open(filepath, 'wb') as f:
+            f.write(make_png(image_size, image_size, color))
+        filepaths.append(filepath)
+    return filepaths
+
+
+def make_png(width: int, height: int, color: tuple) -> bytes:
+    """Encodes a solid-color RGB PNG without any imaging dependencies."""
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return (struct.pack('>I', len(data)) + kind + data +
+                struct.pack('>I',
+                            zlib.crc32(kind + data) & 0xffffffff))
+
+    # Each scanline is prefixed with a filter type byte (0 = none)
+    scanline = b'\x00' + bytes(color) * width
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) +
+            chunk(b'IDAT', zlib.compress(scanline * height)) + chunk(b'IEND', b''))
+
+
+def _depth(root_dir: str, dirpath: str) -> int:
+    relpath = os.path.relpath(dirpath, root_dir)
+    return 0 if relpath == '.' else relpath.count(os.sep) + 1
@@ -1,12 +1,22 @@
 #!/usr/bin/env python
 """Helper script for working directly with the database."""
 
-import shutil
 import sys
 from argparse import ArgumentParser
 
-from imgtag.data import DB_FILEPATH, File, FileTag, Tag, db, get_all_tags
+from imgtag.accel import TagIndex
+from imgtag.analytics import compute_stats, format_stats
+from imgtag.backup import backup_db, diff_tag_exports, export_tags, take_snapshot
+from imgtag.data import (DB_FILEPATH, add_tag_alias, add_tag_implication, drop_tables,
+                         get_all_tags, get_tag_aliases, get_tag_implications, init_db,
+                         remove_tag_alias, remove_tag_implication)
 from imgtag.logger import get_logger
+from imgtag.metadata import refresh_metadata
+from imgtag.roots import get_roots
+from imgtag.settings import (ACCEL_SNAPSHOT_DIR, BACKUP_COMPACT, BACKUP_EXPORT_TAGS, BACKUP_KEEP,
+                             BACKUP_SNAPSHOT_DIR, DB_SHARD_DIR, METADATA_WORKERS)
+from imgtag.shards import get_shards, merge_shards
+from imgtag.untagged import iter_untagged
 
 logger = get_logger(__name__)
 
@@ -18,9 +28,65 @@ def main():
     parser.add_argument('--reset', help='Reset the database', action='store_true')
     parser.add_argument('--cleanup', help='Cleanup the database', action='store_true')
     parser.add_argument('--list-tags', help='List all tags', action='store_true')
+    parser.add_argument('--stats',
+                        help='Show tag and library statistics (listing the top N tags and '
+                        'least covered directories)',
+                        nargs='?',
+                        const=20,
+                        type=int,
+                        metavar='N')
+    parser.add_argument('--alias',
+                        help='Make ALIAS an alias of TAG',
+                        nargs=2,
+                        metavar=('ALIAS', 'TAG'))
+    parser.add_argument('--unalias', help='Remove an alias', metavar='ALIAS')
+    parser.add_argument('--imply',
+                        help='Make TAG imply IMPLIED (retags existing files)',
+                        nargs=2,
+                        metavar=('TAG', 'IMPLIED'))
+    parser.add_argument('--unimply',
+                        help='Remove an implication (keeps existing tags)',
+                        nargs=2,
+                        metavar=('TAG', 'IMPLIED'))
+    parser.add_argument('--build-index',
+                        help='Build a snapshot of the in-memory tag index',
+                        action='store_true')
+    parser.add_argument('--refresh-metadata',
+                        help='Read attributes of new or changed images under the root directories',
+                        action='store_true')
+    parser.add_argument('--list-untagged',
+                        help='List images under the root directories without tags',
+                        action='store_true')
+    parser.add_argument('--list-rules',
+                        help='List all aliases and implications',
+                        action='store_true')
+    parser.add_argument('--backup',
+                        help='Back up the database to PATH (safe while the app is running)',
+                        metavar='PATH')
+    parser.add_argument('--compact',
+                        help='Vacuum the backup (with --backup or --snapshot)',
+                        action='store_true')
+    parser.add_argument('--snapshot',
+                        help='Take a snapshot now, deleting the oldest beyond the retention limit',
+                        action='store_true')
+    parser.add_argument('--export-tags',
+                        help='Write all (filename, tag) pairs to PATH, sorted',
+                        metavar='PATH')
+    parser.add_argument('--diff-tags',
+                        help='List tags removed (-) and added (+) between two tag exports',
+                        nargs=2,
+                        metavar=('OLD', 'NEW'))
+    parser.add_argument('--merge-shards',
+                        help='Move all file tags from the shards back into the main database',
+                        action='store_true')
 
     args = parser.parse_args()
 
+    if args.merge_shards:
+        n_rows = merge_shards(DB_FILEPATH, DB_SHARD_DIR)
+        print(f'Merged {n_rows} file tag(s); set shard_by = none before starting the app')
+        sys.exit()
+
     if args.reset:
         reset_db()
         sys.exit()
@@ -30,11 +96,79 @@ def main():
         sys.exit()
 
     if args.list_tags:
+        init_db()
         print(f'{"Tag".ljust(20)} # Files')
         for name, count in get_all_tags():
             print(f'{name.ljust(20)} {count}')
         sys.exit()
 
+    if args.stats is not None:
+        init_db()
+        print(format_stats(compute_stats(), args.stats))
+        sys.exit()
+
+    if args.alias or args.unalias or args.imply or args.unimply or args.list_rules:
+        init_db()
+        try:
+            if args.alias:
+                add_tag_alias(*args.alias)
+            if args.unalias:
+                remove_tag_alias(args.unalias)
+            if args.imply:
+                add_tag_implication(*args.imply)
+            if args.unimply:
+                remove_tag_implication(*args.unimply)
+        except ValueError as e:
+            logger.error(e)
+            sys.exit(1)
+        if args.list_rules:
+            for alias, tagname in get_tag_aliases():
+                print(f'{alias} = {tagname}')
+            for tagname, implied_tagname in get_tag_implications():
+                print(f'{tagname} -> {implied_tagname}')
+        sys.exit()
+
+    if args.build_index:
+        init_db()
+        TagIndex.build().save(ACCEL_SNAPSHOT_DIR)
+        sys.exit()
+
+    if args.list_untagged:
+        init_db()
+        for filepath in iter_untagged([root.path for root in get_roots()]):
+            print(filepath)
+        sys.exit()
+
+    if args.refresh_metadata:
+        init_db()
+        refresh_metadata([root.path for root in get_roots()], METADATA_WORKERS)
+        sys.exit()
+
+    if args.backup:
+        init_db()
+        backup_db(args.backup, args.compact, shards=get_shards())
+        sys.exit()
+
+    if args.snapshot:
+        init_db()
+        take_snapshot(BACKUP_SNAPSHOT_DIR,
+                      max(BACKUP_KEEP, 1),
+                      args.compact or BACKUP_COMPACT,
+                      BACKUP_EXPORT_TAGS,
+                      force=True,
+                      shards=get_shards())
+        sys.exit()
+
+    if args.export_tags:
+        init_db()
+        export_tags(args.export_tags)
+        sys.exit()
+
+    if args.diff_tags:
+        for change, filename, tagname in diff_tag_exports(*args.diff_tags):
+            print(f'{change} {filename}\t{tagname}')
+        sys.exit()
+
     parser.print_usage()
 
 
@@ -45,14 +179,13 @@ def reset_db():
         print('Aborting')
         sys.exit()
 
-    db_filepath_backup = f'{DB_FILEPATH}.back'
-    shutil.copy(DB_FILEPATH, db_filepath_backup)
-    logger.info(f'Backed up database to {db_filepath_backup}')
+    # Sets up the shards (if any) to be backed up and emptied too
+    init_db()
+    backup_db(f'{DB_FILEPATH}.back', shards=get_shards())
 
-    db.connect()
-    db.drop_tables([FileTag, File, Tag])
+    drop_tables()
     logger.debug('Dropped all tables')
-    db.create_tables([File, Tag, FileTag])
+    init_db()
     logger.debug('Created all tables')
 
 
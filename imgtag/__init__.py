@@ -1 +1,6 @@
-from .main_window import MainWindow
+def __getattr__(name: str):
+    # Imported on first use, so that the data layer can be used without Qt
+    if name == 'MainWindow':
+        from .main_window import MainWindow
+        return MainWindow
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -0,0 +1,281 @@
+"""Provides an optional in-memory accelerator for tag queries.
+
+Postings (the sorted file IDs for each tag) are held in flat NumPy arrays in CSR form, i.e. the
+postings for tag `t` are `file_ids[offsets[t]:offsets[t + 1]]`, so they can be snapshotted to disk
+and memory-mapped back at startup instead of being re-read from SQLite. Queries are answered by
+filtering the smallest candidate set through boolean bitmaps indexed by file ID.
+
+Writes made through `data` are applied via a filetag observer, as small per-tag overlays on top of
+the (read-only, possibly memory-mapped) arrays; overlays are merged when a snapshot is saved.
+"""
+
+import itertools
+import json
+import os
+import shutil
+import threading
+from collections import defaultdict
+from typing import Dict, List, Optional, Set
+
+import numpy as np
+
+from .data import (File, FileTagPairs, Tag, add_filetag_observer, chunks, db, get_change_counts,
+                   get_tag_ids, remove_filetag_observer)
+from .diagnostics import timed
+from .logger import get_logger
+
+logger = get_logger(__name__)
+
+SNAPSHOT_ARRAYS = ['offsets', 'file_ids', 'name_offsets', 'name_bytes', 'ranks']
+SNAPSHOT_META = 'meta.json'
+
+# The process-wide index, if enabled (see `init_index`)
+_index: Optional['TagIndex'] = None
+
+
+class TagIndex(object):
+    """Tag postings for fast multi-tag queries."""
+    def __init__(self, arrays: Dict[str, np.ndarray]):
+        self._lock = threading.Lock()
+        self._offsets = arrays['offsets']
+        self._file_ids = arrays['file_ids']
+        # File names are stored as one UTF-8 blob, also in CSR form and indexed by file ID
+        self._name_offsets = arrays['name_offsets']
+        self._name_bytes = arrays['name_bytes']
+        # Position of each file in name order (or -1 for unknown IDs), for sorting results
+        self._ranks = arrays['ranks']
+
+        # Changes since the arrays were built
+        self._added: Dict[int, Set[int]] = defaultdict(set)
+        self._removed: Dict[int, Set[int]] = defaultdict(set)
+        # Names of files added since the arrays were built
+        self._new_names: Dict[int, str] = {}
+        # Postings may refer to files newer than the names, if written to while building
+        self._size = max(len(self._ranks),
+                         int(self._file_ids.max()) + 1 if len(self._file_ids) else 0)
+
+    # -- Construction
+
+    @classmethod
+    @timed
+    def build(cls) -> 'TagIndex':
+        """Builds the index from the database."""
+        # In one transaction, so that writes in between can't leave the postings referring to files
+        # or tags the rest doesn't know about
+        with db.atomic():
+            cursor = db.execute_sql('SELECT tag_id, fil_id FROM filetag ORDER BY tag_id, fil_id')
+            pairs = np.fromiter(itertools.chain.from_iterable(cursor),
+                                dtype=np.int64).reshape(-1, 2)
+            n_tags = (Tag.select(Tag.id).order_by(Tag.id.desc()).scalar() or 0) + 1
+            arrays = _name_arrays()
+        counts = np.bincount(pairs[:, 0], minlength=n_tags)
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+
+        arrays.update(offsets=offsets, file_ids=pairs[:, 1].astype(np.uint32))
+        logger.info(f'Built tag index with {len(pairs)} postings for {n_tags - 1} tags')
+        return cls(arrays)
+
+    @classmethod
+    @timed
+    def load(cls, dirpath: str) -> Optional['TagIndex']:
+        """Memory-maps a snapshot, or returns None if it is missing or out of date."""
+        try:
+            with open(os.path.join(dirpath, SNAPSHOT_META)) as f:
+                meta = json.load(f)
+            arrays = {
+                name: np.load(os.path.join(dirpath, f'{name}.npy'), mmap_mode='r')
+                for name in SNAPSHOT_ARRAYS
+            }
+        except (OSError, ValueError) as e:
+            logger.info(f'No usable tag index snapshot at {dirpath} ({e})')
+            return None
+        if meta.get('version') != _db_version():
+            logger.info('Tag index snapshot is out of date')
+            return None
+        logger.info(f'Loaded tag index snapshot from {dirpath}')
+        return cls(arrays)
+
+    @timed
+    def save(self, dirpath: str):
+        """Writes a snapshot (with all changes merged in) to the given directory."""
+        with self._lock:
+            arrays = self._merged_arrays()
+            version = _db_version()
+        tmp_dirpath = f'{dirpath}.tmp'
+        shutil.rmtree(tmp_dirpath, ignore_errors=True)
+        os.makedirs(tmp_dirpath)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_dirpath, f'{name}.npy'), array)
+        with open(os.path.join(tmp_dirpath, SNAPSHOT_META), 'w') as f:
+            json.dump({'version': version}, f)
+        shutil.rmtree(dirpath, ignore_errors=True)
+        os.rename(tmp_dirpath, dirpath)
+        logger.info(f'Saved tag index snapshot to {dirpath}')
+
+    # -- Public
+
+    @timed
+    def search(self,
+               tagnames: List[str],
+               excluded_tagnames: List[str] = [],
+               alternative_tagnames: List[List[str]] = []) -> List[str]:
+        """Same as `data.get_files_with_tags`, but answered from memory."""
+        tag_ids = get_tag_ids(
+            set(tagnames) | set(excluded_tagnames) | set(itertools.chain(*alternative_tagnames)))
+        if any(tagname not in tag_ids for tagname in tagnames):
+            return []
+
+        with self._lock:
+            # Each required term as a sorted array of file IDs, smallest first
+            required = [self._postings(tag_ids[tagname]) for tagname in tagnames]
+            for group in alternative_tagnames:
+                union = self._bitmap(
+                    [self._postings(tag_ids[name]) for name in group if name in tag_ids])
+                required.append(np.flatnonzero(union))
+            if not required:
+                return []
+            required.sort(key=len)
+
+            candidates = required[0]
+            for file_ids in required[1:]:
+                if len(candidates) == 0:
+                    break
+                candidates = candidates[self._bitmap([file_ids])[candidates]]
+            excluded = [
+                self._postings(tag_ids[name]) for name in excluded_tagnames if name in tag_ids
+            ]
+            if excluded and len(candidates):
+                candidates = candidates[~self._bitmap(excluded)[candidates]]
+            return self._sorted_names(candidates)
+
+    def on_filetags_changed(self, added: FileTagPairs, removed: FileTagPairs):
+        """Applies committed writes (see `data.add_filetag_observer`)."""
+        with self._lock:
+            for file_id, tag_id in added:
+                self._removed[tag_id].discard(file_id)
+                self._added[tag_id].add(file_id)
+                self._size = max(self._size, file_id + 1)
+            for file_id, tag_id in removed:
+                self._added[tag_id].discard(file_id)
+                self._removed[tag_id].add(file_id)
+
+    # -- Helpers
+
+    def _postings(self, tag_id: int) -> np.ndarray:
+        """Returns the sorted IDs of all files with the given tag."""
+        if tag_id + 1 < len(self._offsets):
+            file_ids = np.asarray(self._file_ids[self._offsets[tag_id]:self._offsets[tag_id + 1]])
+        else:
+            file_ids = np.zeros(0, dtype=np.uint32)
+        if self._added.get(tag_id):
+            file_ids = np.union1d(file_ids, np.fromiter(self._added[tag_id], dtype=np.uint32))
+        if self._removed.get(tag_id):
+            file_ids = np.setdiff1d(file_ids,
+                                    np.fromiter(self._removed[tag_id], dtype=np.uint32),
+                                    assume_unique=True)
+        return file_ids.astype(np.int64)
+
+    def _bitmap(self, postings: List[np.ndarray]) -> np.ndarray:
+        """Returns a boolean array indexed by file ID that is set for any of the given files."""
+        bitmap = np.zeros(self._size, dtype=bool)
+        for file_ids in postings:
+            bitmap[file_ids] = True
+        return bitmap
+
+    def _sorted_names(self, file_ids: np.ndarray) -> List[str]:
+        in_arrays = file_ids < len(self._ranks)
+        ranks = np.full(len(file_ids), -1, dtype=np.int64)
+        ranks[in_arrays] = self._ranks[file_ids[in_arrays]]
+        if np.all(ranks >= 0):
+            names = (self._name(file_id) for file_id in file_ids[np.argsort(ranks, kind='stable')])
+            return [name for name in names if name is not None]
+
+        # Some files are newer than the arrays, so their position in name order isn't known
+        missing = [
+            int(file_id) for file_id, rank in zip(file_ids, ranks)
+            if rank < 0 and file_id not in self._new_names
+        ]
+        for chunk in chunks(missing):
+            self._new_names.update(
+                File.select(File.id, File.name).where(File.id.in_(chunk)).tuples())
+        # Files that no longer exist are left out
+        names = (self._name(file_id) for file_id in file_ids)
+        return sorted(name for name in names if name is not None)
+
+    def _name(self, file_id: int) -> Optional[str]:
+        """Returns the file's name, or None if it is unknown (i.e. the arrays are stale)."""
+        if file_id in self._new_names:
+            return self._new_names[file_id]
+        if file_id + 1 >= len(self._name_offsets):
+            return None
+        start, end = self._name_offsets[file_id], self._name_offsets[file_id + 1]
+        # IDs without a file have an empty name
+        return bytes(self._name_bytes[start:end]).decode('utf-8') if end > start else None
+
+    def _merged_arrays(self) -> Dict[str, np.ndarray]:
+        n_tags = max([len(self._offsets) - 1] + [tag_id + 1 for tag_id in self._added])
+        postings = [self._postings(tag_id) for tag_id in range(n_tags)]
+        offsets = np.zeros(n_tags + 1, dtype=np.int64)
+        np.cumsum([len(file_ids) for file_ids in postings], out=offsets[1:])
+        file_ids = (np.concatenate(postings) if postings else np.zeros(0)).astype(np.uint32)
+
+        if self._new_names or self._size > len(self._ranks):
+            arrays = _name_arrays()
+        else:
+            arrays = {
+                'name_offsets': self._name_offsets,
+                'name_bytes': self._name_bytes,
+                'ranks': self._ranks
+            }
+        arrays.update(offsets=offsets, file_ids=file_ids)
+        return arrays
+
+
+# -- Public
+
+
+def init_index(snapshot_dirpath: str) -> TagIndex:
+    """Loads (or builds) the process-wide index and keeps it in sync with writes."""
+    global _index
+    if _index:
+        remove_filetag_observer(_index.on_filetags_changed)
+    _index = TagIndex.load(snapshot_dirpath) or TagIndex.build()
+    add_filetag_observer(_index.on_filetags_changed)
+    return _index
+
+
+def get_index() -> Optional[TagIndex]:
+    """Returns the process-wide index, if it has been initialized."""
+    return _index
+
+
+# -- Helpers
+
+
+def _name_arrays() -> Dict[str, np.ndarray]:
+    rows = list(File.select(File.id, File.name).order_by(File.id).tuples())
+    size = (rows[-1][0] + 1) if rows else 1
+    lengths = np.zeros(size, dtype=np.int64)
+    encoded = [name.encode('utf-8') for _, name in rows]
+    ids = np.array([file_id for file_id, _ in rows], dtype=np.int64)
+    lengths[ids] = [len(name) for name in encoded]
+    name_offsets = np.zeros(size + 1, dtype=np.int64)
+    np.cumsum(lengths, out=name_offsets[1:])
+    # IDs without a file (e.g. deleted) get an empty name, which is fine since they have no tags
+
+    ranks = np.full(size, -1, dtype=np.int64)
+    order = sorted(range(len(rows)), key=lambda i: rows[i][1])
+    ranks[ids[order]] = np.arange(len(rows))
+
+    return {
+        'name_offsets': name_offsets,
+        'name_bytes': np.frombuffer(b''.join(encoded), dtype=np.uint8),
+        'ranks': ranks,
+    }
+
+
+def _db_version() -> List[list]:
+    """Returns the change counts of files and file tags, used to detect out-of-date snapshots."""
+    # As lists, to compare equal to the snapshot's JSON
+    return [list(count) for count in get_change_counts()]
@@ -0,0 +1,186 @@
+"""Computes library-wide statistics: tag frequencies, tags per image, growth over time and tagging
+coverage by directory.
+
+Everything is fetched in bulk, once, into NumPy arrays: the files, and the number of tags per file
+and files per tag (each a single aggregate query answered from a covering index, which is much
+faster than fetching every file tag, and run on every shard in parallel if sharded). Every
+statistic is then a vectorized `bincount`/`unique` over them, so there are no per-tag or
+per-directory queries.
+"""
+
+import itertools
+import os
+from typing import List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from .data import db
+from .diagnostics import timed
+from .logger import get_logger
+from .shards import get_shards
+
+logger = get_logger(__name__)
+
+# Directory shown for files whose path isn't known
+UNKNOWN_DIRECTORY = '(unknown)'
+
+
+class LibraryStats(NamedTuple):
+    """Statistics for the whole library."""
+    n_files: int
+    n_tagged_files: int
+    n_tags: int
+    n_filetags: int
+    # (tag name, number of files), most used first
+    tag_counts: List[Tuple[str, int]]
+    # Number of tags used by 0 files, 1 file, 2-3 files, 4-7 files, etc.
+    tag_frequency_buckets: np.ndarray
+    # Number of files with 0, 1, 2, etc. tags
+    tags_per_file: np.ndarray
+    # (month, files added, of which tagged, cumulative files), by modification time, oldest first
+    growth: List[Tuple[str, int, int, int]]
+    # (directory, files, tagged files), least covered first
+    directories: List[Tuple[str, int, int]]
+
+    @property
+    def coverage(self) -> float:
+        return self.n_tagged_files / self.n_files if self.n_files else 0.0
+
+
+# -- Public
+
+
+@timed
+def compute_stats() -> LibraryStats:
+    """Computes all statistics from the database."""
+    file_rows = _fetch_counts('SELECT fil_id, COUNT(*) FROM filetag GROUP BY fil_id')
+    tag_rows = _fetch_counts('SELECT tag_id, COUNT(*) FROM filetag GROUP BY tag_id')
+    tags = db.execute_sql('SELECT id, name FROM tag').fetchall()
+    files = db.execute_sql('SELECT id, path, mtime FROM file').fetchall()
+    file_ids = np.fromiter((file_id for file_id, _, _ in files), dtype=np.int64, count=len(files))
+    tag_ids = np.fromiter((tag_id for tag_id, _ in tags), dtype=np.int64, count=len(tags))
+
+    # Tags per file (including untagged files)
+    per_file = _scatter(file_rows, file_ids)
+    tagged = per_file > 0
+
+    # Files per tag
+    per_tag = _scatter(tag_rows, tag_ids)
+    order = np.argsort(-per_tag, kind='stable')
+    tag_counts = [(tags[i][1], int(per_tag[i])) for i in order]
+    # Bucket 0 is unused tags, and bucket `b` is [2^(b-1), 2^b)
+    buckets = np.zeros(len(per_tag), dtype=np.int64)
+    used = per_tag > 0
+    buckets[used] = np.floor(np.log2(per_tag[used])).astype(np.int64) + 1
+    tag_frequency_buckets = np.bincount(buckets, minlength=1)
+
+    return LibraryStats(n_files=len(file_ids),
+                        n_tagged_files=int(tagged.sum()),
+                        n_tags=len(tags),
+                        n_filetags=int(per_tag.sum()),
+                        tag_counts=tag_counts,
+                        tag_frequency_buckets=tag_frequency_buckets,
+                        tags_per_file=np.bincount(per_file, minlength=1),
+                        growth=_growth(files, tagged),
+                        directories=_directories(files, tagged))
+
+
+def format_stats(stats: LibraryStats, top: int = 20) -> str:
+    """Returns a human-readable report of the statistics, listing the `top` tags and least covered
+    directories.
+    """
+    lines: List[str] = [
+        f'Files: {stats.n_files} ({stats.n_tagged_files} tagged, {stats.coverage:.1%})',
+        f'Tags: {stats.n_tags}',
+        f'File tags: {stats.n_filetags}',
+        '',
+    ]
+
+    lines.append(f'{"Tag".ljust(32)} {"# Files":>9} {"Share":>9}')
+    for name, count in stats.tag_counts[:top]:
+        share = count / stats.n_tagged_files if stats.n_tagged_files else 0.0
+        lines.append(f'{name.ljust(32)} {count:>9} {share:>9.1%}')
+    lines.append('')
+
+    lines.append(f'{"Files per tag".ljust(32)} {"# Tags":>9}')
+    for bucket, count in enumerate(stats.tag_frequency_buckets):
+        lines.append(f'{_bucket_label(bucket).ljust(32)} {count:>9}')
+    lines.append('')
+
+    lines.append(f'{"Tags per file".ljust(32)} {"# Files":>9}')
+    for n_tags, count in enumerate(stats.tags_per_file):
+        if count:
+            lines.append(f'{str(n_tags).ljust(32)} {count:>9}')
+    lines.append('')
+
+    lines.append(f'{"Month (modified)".ljust(32)} {"Added":>9} {"Tagged":>9} {"Total":>9}')
+    for month, added, n_tagged, total in stats.growth:
+        lines.append(f'{month.ljust(32)} {added:>9} {n_tagged:>9} {total:>9}')
+    lines.append('')
+
+    lines.append(f'{"Directory (least covered)".ljust(32)} {"Files":>9} {"Tagged":>9} '
+                 f'{"Coverage":>9}')
+    for dirpath, n_files, n_tagged in stats.directories[:top]:
+        lines.append(f'{_shorten(dirpath, 32).ljust(32)} {n_files:>9} {n_tagged:>9} '
+                     f'{n_tagged / n_files:>9.1%}')
+
+    return '\n'.join(lines)
+
+
+# -- Helpers
+
+
+def _fetch_counts(sql: str) -> np.ndarray:
+    """Returns the (ID, count) rows of the query, from every shard if sharded."""
+    shards = get_shards()
+    rows = (itertools.chain.from_iterable(shards.fan_out(sql)) if shards else db.execute_sql(sql))
+    values = np.fromiter(itertools.chain.from_iterable(rows), dtype=np.int64)
+    return values.reshape(-1, 2)
+
+
+def _scatter(counts: np.ndarray, ids: np.ndarray) -> np.ndarray:
+    """Returns the counts for the given IDs, from (ID, count) rows (zero for missing IDs, and
+    summed for repeated ones).
+    """
+    n = int(max(ids.max(initial=0), counts[:, 0].max(initial=0))) + 1
+    dense = np.zeros(n, dtype=np.int64)
+    np.add.at(dense, counts[:, 0], counts[:, 1])
+    return dense[ids]
+
+
+def _growth(files: List[Tuple[int, Optional[str], Optional[float]]],
+            tagged: np.ndarray) -> List[Tuple[str, int, int, int]]:
+    mtimes = np.array([mtime for _, _, mtime in files], dtype=np.float64)
+    known = ~np.isnan(mtimes)
+    months = mtimes[known].astype('datetime64[s]').astype('datetime64[M]')
+    unique_months, inverse = np.unique(months, return_inverse=True)
+    added = np.bincount(inverse, minlength=len(unique_months))
+    added_tagged = np.bincount(inverse, weights=tagged[known], minlength=len(unique_months))
+    return [
+        (str(month), int(n), int(n_tagged), int(total))
+        for month, n, n_tagged, total in zip(unique_months, added, added_tagged, np.cumsum(added))
+    ]
+
+
+def _directories(files: List[Tuple[int, Optional[str], Optional[float]]],
+                 tagged: np.ndarray) -> List[Tuple[str, int, int]]:
+    dirpaths = np.array(
+        [path.rpartition(os.sep)[0] if path else UNKNOWN_DIRECTORY for _, path, _ in files])
+    unique_dirpaths, inverse = np.unique(dirpaths, return_inverse=True)
+    n_files = np.bincount(inverse, minlength=len(unique_dirpaths))
+    n_tagged = np.bincount(inverse, weights=tagged,
+                           minlength=len(unique_dirpaths)).astype(np.int64)
+    # Least covered first, then largest first
+    order = np.lexsort((-n_files, n_tagged / np.maximum(n_files, 1)))
+    return [(str(unique_dirpaths[i]), int(n_files[i]), int(n_tagged[i])) for i in order]
+
+
+def _bucket_label(bucket: int) -> str:
+    if bucket == 0:
+        return '0'
+    low, high = 2**(bucket - 1), 2**bucket - 1
+    return str(low) if low == high else f'{low}-{high}'
+
+
+def _shorten(text: str, width: int) -> str:
+    return text if len(text) <= width else '...' + text[-(width - 3):]
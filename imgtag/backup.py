@@ -0,0 +1,298 @@
+"""Backs up the database while the app is running, and exports tags in a diffable format.
+
+Backups use SQLite's online backup API, copying a few pages at a time so that writers are only
+ever blocked briefly, and are written to a temporary file that is renamed into place when complete
+(so a backup is never torn). When sharded, each shard is backed up the same way into a directory
+next to the backup (see `shard_backup_dir`). Snapshots are timestamped backups taken on a schedule,
+of which only the newest few are kept, each optionally with a tag export alongside.
+"""
+
+import glob
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from typing import Callable, Iterator, List, Optional, Tuple
+
+from .diagnostics import timed
+from .logger import get_logger
+from .settings import DB_FILEPATH
+from .shards import ShardSet, get_shards, list_shard_files, shard_filepath
+
+logger = get_logger(__name__)
+
+# Pages copied per backup step (-1 copies everything in one step)
+BACKUP_PAGES_PER_STEP = 256
+# Seconds to sleep between steps, letting other connections at the database
+BACKUP_STEP_SLEEP = 0.005
+# Seconds to wait for a lock before giving up
+BACKUP_TIMEOUT = 30
+# Times a stepped copy may start over (after another connection writes) before the steps are made
+# larger, ending in a single step that can't be interrupted
+BACKUP_MAX_RESTARTS = 3
+
+SNAPSHOT_PREFIX = 'imgtag-'
+SNAPSHOT_TIME_FORMAT = '%Y%m%d-%H%M%S'
+SNAPSHOT_EXT = '.db'
+TAG_EXPORT_EXT = '.tags.tsv'
+SHARD_BACKUP_EXT = '.shards'
+
+# Minimum SQLite version for `VACUUM INTO`
+_VACUUM_INTO_VERSION = (3, 27, 0)
+
+# Only one snapshot at a time, however they are triggered
+_snapshot_lock = threading.Lock()
+
+# (filename, tagname)
+TagRow = Tuple[str, str]
+# (change, filename, tagname), where change is '+' or '-'
+TagDiff = Tuple[str, str, str]
+
+# -- Backups
+
+
+@timed
+def backup_db(dest: str,
+              compact: bool = False,
+              pages_per_step: int = BACKUP_PAGES_PER_STEP,
+              progress: Optional[Callable[[int, int], None]] = None,
+              src: str = DB_FILEPATH,
+              shards: Optional[ShardSet] = None):
+    """Copies the database (and the given shards, if sharded) to the given path, without stopping
+    writes to it.
+
+    With `compact`, the copy is also vacuumed (via `VACUUM INTO` where available), leaving out free
+    pages. `progress` is called with the number of pages remaining and the total after each step.
+
+    Shards are copied first, each on its own, so the main database only appears once the backup is
+    complete (but it isn't a single point-in-time copy of all of them).
+    """
+    if shards:
+        shard_dir = shard_backup_dir(dest)
+        shutil.rmtree(shard_dir, ignore_errors=True)
+        os.makedirs(shard_dir)
+        for name in shards.names:
+            _backup_file(shards.filepath(name), shard_filepath(shard_dir, shards.by, name),
+                         compact, pages_per_step, None)
+    _backup_file(src, dest, compact, pages_per_step, progress)
+    logger.info(f'Backed up database to {dest} ({os.path.getsize(dest)} bytes)'
+                f'{f" with {len(shards.names)} shard(s)" if shards else ""}')
+
+
+def shard_backup_dir(backup_filepath: str) -> str:
+    """Returns the directory with the shards backed up along with the given backup."""
+    return backup_filepath + SHARD_BACKUP_EXT
+
+
+# -- Snapshots
+
+
+def take_snapshot(snapshot_dir: str,
+                  keep: int,
+                  compact: bool = False,
+                  export: bool = True,
+                  force: bool = False,
+                  src: str = DB_FILEPATH,
+                  shards: Optional[ShardSet] = None) -> Optional[str]:
+    """Backs up the database to a new timestamped file in the directory, then deletes all but the
+    newest `keep` snapshots. Returns the path of the snapshot, or None if none was taken.
+
+    Unless `force`, skips the snapshot if the database (or any shard) hasn't changed since the
+    latest one. Also skips it if another snapshot is in progress.
+    """
+    if not _snapshot_lock.acquire(blocking=False):
+        logger.info('Snapshot already in progress; skipping')
+        return None
+    try:
+        snapshots = list_snapshots(snapshot_dir)
+        # Tag edits only touch the shards, if sharded
+        src_filepaths = [src] + ([shards.filepath(name)
+                                  for name in shards.names] if shards else [])
+        modified_at = max(os.path.getmtime(filepath) for filepath in src_filepaths)
+        if not force and snapshots and modified_at <= os.path.getmtime(snapshots[-1]):
+            logger.debug('Database unchanged since the latest snapshot; skipping')
+            return None
+        os.makedirs(snapshot_dir, exist_ok=True)
+        stamp = time.strftime(SNAPSHOT_TIME_FORMAT)
+        filepath = os.path.join(snapshot_dir, f'{SNAPSHOT_PREFIX}{stamp}{SNAPSHOT_EXT}')
+        backup_db(filepath, compact, src=src, shards=shards)
+        if export:
+            # From the snapshot (and its shards) rather than the live database, so they match
+            export_tags(_export_path(filepath), filepath)
+        prune_snapshots(snapshot_dir, keep)
+        return filepath
+    finally:
+        _snapshot_lock.release()
+
+
+def list_snapshots(snapshot_dir: str) -> List[str]:
+    """Returns the paths of all snapshots in the directory, oldest first."""
+    # The timestamps sort chronologically
+    return sorted(glob.glob(os.path.join(snapshot_dir, f'{SNAPSHOT_PREFIX}*{SNAPSHOT_EXT}')))
+
+
+def prune_snapshots(snapshot_dir: str, keep: int) -> List[str]:
+    """Deletes all but the newest `keep` snapshots (and their tag exports), returning the paths of
+    the deleted snapshots.
+    """
+    snapshots = list_snapshots(snapshot_dir)
+    expired = snapshots[:max(len(snapshots) - keep, 0)]
+    for filepath in expired:
+        _remove(filepath)
+        _remove(_export_path(filepath))
+        shutil.rmtree(shard_backup_dir(filepath), ignore_errors=True)
+        logger.info(f'Deleted expired snapshot {filepath}')
+    return expired
+
+
+# -- Tag exports
+
+
+@timed
+def export_tags(dest: str, src: str = DB_FILEPATH) -> int:
+    """Writes every (filename, tag) pair in the database to a file, returning the number of pairs.
+
+    The file has one tab-separated pair per line, sorted, so that exports of two snapshots can be
+    compared line by line (see `diff_tag_exports`), or with `diff`. If sharded, the file tags are
+    read from the shards backed up with `src` (if it's a backup), or else from the live ones.
+    """
+    tmp_dest = f'{dest}.tmp'
+    conn = sqlite3.connect(src, timeout=BACKUP_TIMEOUT)
+    try:
+        if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'filetag'"
+                            ).fetchone():
+            shards = _backed_up_shards(src) or get_shards()
+            if shards:
+                shards.attach(conn)
+        rows = conn.execute('SELECT file.name, tag.name FROM filetag '
+                            'JOIN file ON file.id = filetag.fil_id '
+                            'JOIN tag ON tag.id = filetag.tag_id '
+                            'ORDER BY file.name, tag.name')
+        n_rows = 0
+        with open(tmp_dest, 'w', encoding='utf-8', newline='\n') as f:
+            for filename, tagname in rows:
+                f.write(f'{filename}\t{tagname}\n')
+                n_rows += 1
+    finally:
+        conn.close()
+    os.replace(tmp_dest, dest)
+    logger.info(f'Exported {n_rows} tag(s) to {dest}')
+    return n_rows
+
+
+def read_tag_export(filepath: str) -> Iterator[TagRow]:
+    with open(filepath, encoding='utf-8') as f:
+        for line in f:
+            filename, tagname = line.rstrip('\n').split('\t')
+            yield filename, tagname
+
+
+def diff_tag_exports(old_filepath: str, new_filepath: str) -> Iterator[TagDiff]:
+    """Lazily yields the tags removed ('-') and added ('+') between two exports, in order.
+
+    Both exports are streamed side by side, so this takes a single pass and constant memory.
+    """
+    old_rows, new_rows = read_tag_export(old_filepath), read_tag_export(new_filepath)
+    old, new = next(old_rows, None), next(new_rows, None)
+    while old is not None or new is not None:
+        if old is not None and (new is None or old < new):
+            yield ('-', *old)
+            old = next(old_rows, None)
+        elif new is not None and (old is None or new < old):
+            yield ('+', *new)
+            new = next(new_rows, None)
+        else:
+            old, new = next(old_rows, None), next(new_rows, None)
+
+
+# -- Helpers
+
+
+class _TooManyRestarts(Exception):
+    pass
+
+
+def _backup_file(src: str, dest: str, compact: bool, pages_per_step: int,
+                 progress: Optional[Callable[[int, int], None]]):
+    tmp_dest = f'{dest}.tmp'
+    _remove(tmp_dest)
+    # NOTE: A separate connection, so that the copy doesn't hold up the app's own connections
+    conn = sqlite3.connect(src, timeout=BACKUP_TIMEOUT)
+    try:
+        if compact and sqlite3.sqlite_version_info >= _VACUUM_INTO_VERSION:
+            conn.execute('VACUUM INTO ?', (tmp_dest, ))
+        else:
+            _copy(conn, tmp_dest, pages_per_step, progress)
+            if compact:
+                _vacuum(tmp_dest)
+    except BaseException:
+        _remove(tmp_dest)
+        raise
+    finally:
+        conn.close()
+    os.replace(tmp_dest, dest)
+
+
+def _backed_up_shards(backup_filepath: str) -> Optional[ShardSet]:
+    shard_files = list_shard_files(shard_backup_dir(backup_filepath))
+    if not shard_files:
+        return None
+    return ShardSet(shard_files[0][0], shard_backup_dir(backup_filepath),
+                    [name for _, name in shard_files])
+
+
+def _copy(conn: sqlite3.Connection, dest: str, pages_per_step: int,
+          progress: Optional[Callable[[int, int], None]]):
+    """Copies the database in steps, letting writers in between them.
+
+    Since any write from another connection makes the copy start over, a busy database could keep
+    it going forever, so the steps grow after every few restarts.
+    """
+    while True:
+        last_remaining, restarts = None, 0
+
+        def on_step(_status: int, remaining: int, total: int):
+            nonlocal last_remaining, restarts
+            if last_remaining is not None and remaining > last_remaining:
+                restarts += 1
+                if restarts > BACKUP_MAX_RESTARTS:
+                    raise _TooManyRestarts()
+            last_remaining = remaining
+            if progress:
+                progress(remaining, total)
+            time.sleep(BACKUP_STEP_SLEEP)
+
+        dest_conn = sqlite3.connect(dest)
+        try:
+            conn.backup(dest_conn, pages=pages_per_step, progress=on_step)
+            return
+        except _TooManyRestarts:
+            pages_per_step = -1 if pages_per_step >= _page_count(conn) else pages_per_step * 4
+            logger.info(f'Backup restarted {restarts} times due to writes; '
+                        f'retrying with {pages_per_step} page(s) per step')
+        finally:
+            dest_conn.close()
+
+
+def _page_count(conn: sqlite3.Connection) -> int:
+    return conn.execute('PRAGMA page_count').fetchone()[0]
+
+
+def _vacuum(filepath: str):
+    conn = sqlite3.connect(filepath)
+    try:
+        conn.execute('VACUUM')
+    finally:
+        conn.close()
+
+
+def _export_path(snapshot_filepath: str) -> str:
+    return snapshot_filepath[:-len(SNAPSHOT_EXT)] + TAG_EXPORT_EXT
+
+
+def _remove(filepath: str):
+    try:
+        os.remove(filepath)
+    except FileNotFoundError:
+        pass
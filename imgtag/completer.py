@@ -0,0 +1,49 @@
+"""Provides a tag completer backed by the tag search index."""
+
+from typing import List, Tuple
+
+from PySide2.QtCore import QStringListModel
+from PySide2.QtWidgets import QCompleter
+
+from .data import search_tags
+
+# Query operators that may prefix a tag (see `query`)
+TAG_PREFIXES = '-~'
+
+
+class TagCompleter(QCompleter):
+    """Completes the last tag of a multi-tag entry using substring and fuzzy matching.
+
+    Instead of prefix-filtering a fixed list, the model is refilled from `search_tags` whenever the
+    text changes, so new tags and misspellings are handled without loading the whole vocabulary.
+    """
+    max_suggestions = 20
+
+    def __init__(self, tagnames: List[str]):
+        super().__init__()
+        self._model = QStringListModel(tagnames[:self.max_suggestions])
+        self.setModel(self._model)
+        # The model is already filtered
+        self.setCompletionMode(QCompleter.UnfilteredPopupCompletion)
+
+    # -- Public
+
+    def update_completions(self, text: str):
+        """Refills the model with matches for the last tag in the given text."""
+        word = self._split(text)[1]
+        self._model.setStringList(search_tags(word, limit=self.max_suggestions) if word else [])
+
+    # Override
+    def pathFromIndex(self, index) -> str:
+        # Only replace the last tag (keeping any operator), not the whole text
+        head, _word, prefix = self._split(self.widget().text())
+        return head + prefix + index.data()
+
+    # -- Helpers
+
+    def _split(self, text: str) -> Tuple[str, str, str]:
+        """Splits the text into everything before the last tag, the last tag, and its operator."""
+        head, _, word = text.rpartition(' ')
+        head = head + ' ' if head else ''
+        prefix = word[0] if word and word[0] in TAG_PREFIXES else ''
+        return head, word[len(prefix):], prefix
@@ -0,0 +1,294 @@
+"""Provides related-tag suggestions and result-set facets from a tag co-occurrence matrix.
+
+The matrix is stored sparsely as sorted `tag * n + other` keys with counts (both orderings of each
+pair, so the row for a tag is a contiguous slice) and is built vectorized from all file tags, in
+chunks of files to bound memory. File tags are also kept in CSR form by file, so facet counts for
+any set of files are a single gather and `bincount`.
+
+Writes made through `data` are applied incrementally via a filetag observer. The index is built
+off the GUI thread (see `init_cooccurrence`), so it isn't available straight after startup.
+"""
+
+import itertools
+import threading
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+
+from .data import File, FileTagPairs, Tag, add_filetag_observer, chunks, db, get_tag_ids
+from .diagnostics import timed
+from .logger import get_logger
+
+logger = get_logger(__name__)
+
+# Files per chunk when building the matrix
+BUILD_CHUNK_SIZE = 50000
+
+# The process-wide index, if enabled and built (see `init_cooccurrence`)
+_index: Optional['CooccurrenceIndex'] = None
+# Guards the two below
+_changes_lock = threading.Lock()
+# Writes committed while (re)building, to be replayed onto the new index
+_changes_while_building: Optional[List[Tuple[FileTagPairs, FileTagPairs]]] = None
+_observing = False
+
+
+class CooccurrenceIndex(object):
+    """A sparse tag x tag co-occurrence matrix plus per-file tags."""
+    def __init__(self, file_offsets: np.ndarray, file_tags: np.ndarray, name_hashes: np.ndarray,
+                 name_file_ids: np.ndarray, n_tags: int):
+        self._lock = threading.Lock()
+        # Tags of file `f` are `file_tags[file_offsets[f]:file_offsets[f + 1]]`
+        self._file_offsets = file_offsets
+        self._file_tags = file_tags
+        # Sorted hashes of all filenames, and the corresponding file IDs, for vectorized lookups
+        self._name_hashes = name_hashes
+        self._name_file_ids = name_file_ids
+
+        self._n = n_tags
+        self._keys, self._counts = _count_pairs(file_offsets, file_tags, n_tags)
+
+        # Changes since the arrays were built
+        self._added_tags: Dict[int, Set[int]] = defaultdict(set)
+        self._removed_tags: Dict[int, Set[int]] = defaultdict(set)
+        # Tag -> other tag -> change in count
+        self._delta: Dict[int, Counter] = defaultdict(Counter)
+
+    @classmethod
+    @timed
+    def build(cls) -> 'CooccurrenceIndex':
+        """Builds the index from the database."""
+        cursor = db.execute_sql('SELECT fil_id, tag_id FROM filetag ORDER BY fil_id, tag_id')
+        pairs = np.fromiter(itertools.chain.from_iterable(cursor), dtype=np.int64).reshape(-1, 2)
+        n_files = (File.select(File.id).order_by(File.id.desc()).scalar() or 0) + 1
+        n_tags = (Tag.select(Tag.id).order_by(Tag.id.desc()).scalar() or 0) + 1
+        counts = np.bincount(pairs[:, 0], minlength=n_files)
+        file_offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=file_offsets[1:])
+
+        files = list(File.select(File.id, File.name).tuples())
+        name_hashes = np.array([hash(name) for _, name in files], dtype=np.int64)
+        name_file_ids = np.array([file_id for file_id, _ in files], dtype=np.int64)
+        order = np.argsort(name_hashes)
+
+        index = cls(file_offsets, pairs[:, 1].copy(), name_hashes[order], name_file_ids[order],
+                    n_tags)
+        logger.info(f'Built tag co-occurrence matrix with {len(index._keys)} nonzero entries')
+        return index
+
+    # -- Public
+
+    @timed
+    def related_tags(self, tagnames: List[str], k: int = 10) -> List[Tuple[str, int]]:
+        """Returns the `k` tags that most often co-occur with the given tags (summed over all of
+        them), excluding the tags themselves, with their co-occurrence counts.
+        """
+        tag_ids = get_tag_ids(tagnames)
+        with self._lock:
+            scores: Counter = Counter()
+            for tag_id in tag_ids.values():
+                scores.update(self._row(tag_id))
+        for tag_id in tag_ids.values():
+            scores.pop(tag_id, None)
+        return _named([(tag_id, count) for tag_id, count in scores.most_common(k) if count > 0])
+
+    @timed
+    def facets(self,
+               filenames: List[str],
+               k: int = 20,
+               excluded_tagnames: Iterable[str] = ()) -> List[Tuple[str, int]]:
+        """Returns the `k` most common tags among the given files, with the number of files."""
+        file_ids = self._file_ids(filenames)
+        with self._lock:
+            in_arrays = file_ids[file_ids + 1 < len(self._file_offsets)]
+            starts = self._file_offsets[in_arrays]
+            lengths = self._file_offsets[in_arrays + 1] - starts
+            # Gather all tags of all files at once
+            positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(
+                lengths.sum())
+            counts = np.bincount(self._file_tags[positions], minlength=self._n).astype(np.int64)
+
+            # Apply changes for the (few) files that have been retagged since building
+            for file_id in set(file_ids.tolist()) & (set(self._added_tags)
+                                                     | set(self._removed_tags)):
+                for tag_id in self._added_tags.get(file_id, ()):
+                    counts = _grow(counts, tag_id + 1)
+                    counts[tag_id] += 1
+                for tag_id in self._removed_tags.get(file_id, ()):
+                    counts[tag_id] -= 1
+
+        for tag_id in get_tag_ids(excluded_tagnames).values():
+            if tag_id < len(counts):
+                counts[tag_id] = 0
+        top = np.argsort(-counts, kind='stable')[:k]
+        return _named([(int(tag_id), int(counts[tag_id])) for tag_id in top if counts[tag_id] > 0])
+
+    def on_filetags_changed(self, added: FileTagPairs, removed: FileTagPairs):
+        """Applies committed writes (see `data.add_filetag_observer`).
+
+        Changes that are already reflected (e.g. adding a tag the file has) are ignored, so writes
+        that raced with building can safely be applied again.
+        """
+        with self._lock:
+            # Only changes relative to the arrays are recorded, so that e.g. adding then removing a
+            # new tag leaves neither an addition nor a removal behind
+            for file_id, tag_id in added:
+                others = self._tags(file_id)
+                if tag_id in others:
+                    continue
+                if self._in_arrays(file_id, tag_id):
+                    self._removed_tags[file_id].discard(tag_id)
+                else:
+                    self._added_tags[file_id].add(tag_id)
+                self._update(tag_id, others, 1)
+            for file_id, tag_id in removed:
+                others = self._tags(file_id)
+                if tag_id not in others:
+                    continue
+                others.discard(tag_id)
+                if self._in_arrays(file_id, tag_id):
+                    self._removed_tags[file_id].add(tag_id)
+                else:
+                    self._added_tags[file_id].discard(tag_id)
+                self._update(tag_id, others, -1)
+
+    # -- Helpers
+
+    def _row(self, tag_id: int) -> Dict[int, int]:
+        """Returns the co-occurrence counts of the given tag with every other tag."""
+        start, end = np.searchsorted(self._keys, [tag_id * self._n, (tag_id + 1) * self._n])
+        row = dict(
+            zip((self._keys[start:end] - tag_id * self._n).tolist(),
+                self._counts[start:end].tolist()))
+        for other, delta in self._delta.get(tag_id, {}).items():
+            row[other] = row.get(other, 0) + delta
+        return row
+
+    def _tags(self, file_id: int) -> Set[int]:
+        tags: Set[int] = set()
+        if file_id + 1 < len(self._file_offsets):
+            tags.update(
+                self._file_tags[self._file_offsets[file_id]:self._file_offsets[file_id +
+                                                                               1]].tolist())
+        tags |= self._added_tags.get(file_id, set())
+        tags -= self._removed_tags.get(file_id, set())
+        return tags
+
+    def _in_arrays(self, file_id: int, tag_id: int) -> bool:
+        if file_id + 1 >= len(self._file_offsets):
+            return False
+        # Tags are sorted within each file
+        tags = self._file_tags[self._file_offsets[file_id]:self._file_offsets[file_id + 1]]
+        position = np.searchsorted(tags, tag_id)
+        return bool(position < len(tags) and tags[position] == tag_id)
+
+    def _update(self, tag_id: int, others: Set[int], delta: int):
+        for other in others:
+            self._delta[tag_id][other] += delta
+            self._delta[other][tag_id] += delta
+
+    def _file_ids(self, filenames: List[str]) -> np.ndarray:
+        hashes = np.array([hash(name) for name in filenames], dtype=np.int64)
+        # Pad so that hashes beyond the last one still index a (non-matching) entry
+        name_hashes = np.append(self._name_hashes, 0)
+        positions = np.searchsorted(self._name_hashes, hashes)
+        found = name_hashes[positions] == hashes
+        file_ids = self._name_file_ids[positions[found]]
+
+        # Files created since building aren't in the arrays
+        missing = [name for name, is_found in zip(filenames, found) if not is_found]
+        new_ids: List[int] = []
+        for chunk in chunks(missing):
+            new_ids.extend(
+                file_id
+                for (file_id, ) in File.select(File.id).where(File.name.in_(chunk)).tuples())
+        return np.concatenate([file_ids, np.array(new_ids, dtype=np.int64)])
+
+
+# -- Public
+
+
+def init_cooccurrence() -> CooccurrenceIndex:
+    """Builds the process-wide index and keeps it in sync with writes.
+
+    Slow for large libraries, so it's meant to be run in the background; writes committed while
+    building are replayed onto the new index before it replaces the previous one (if any).
+    """
+    global _index, _changes_while_building, _observing
+    with _changes_lock:
+        if not _observing:
+            add_filetag_observer(_on_filetags_changed)
+            _observing = True
+        _changes_while_building = []
+    try:
+        index = CooccurrenceIndex.build()
+    except Exception:
+        with _changes_lock:
+            _changes_while_building = None
+        raise
+    with _changes_lock:
+        for added, removed in _changes_while_building:
+            index.on_filetags_changed(added, removed)
+        _changes_while_building = None
+        _index = index
+    return index
+
+
+def get_cooccurrence() -> Optional[CooccurrenceIndex]:
+    """Returns the process-wide index, if it has been initialized."""
+    return _index
+
+
+# -- Helpers
+
+
+def _on_filetags_changed(added: FileTagPairs, removed: FileTagPairs):
+    with _changes_lock:
+        if _changes_while_building is not None:
+            _changes_while_building.append((added, removed))
+        if _index:
+            _index.on_filetags_changed(added, removed)
+
+
+def _count_pairs(file_offsets: np.ndarray, file_tags: np.ndarray,
+                 n_tags: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Counts every ordered pair of distinct tags on the same file, returning sorted pair keys
+    (`tag * n_tags + other`) and counts.
+    """
+    keys = np.zeros(0, dtype=np.int64)
+    counts = np.zeros(0, dtype=np.int64)
+    n_files = len(file_offsets) - 1
+    for chunk_start in range(0, n_files, BUILD_CHUNK_SIZE):
+        offsets = file_offsets[chunk_start:min(chunk_start + BUILD_CHUNK_SIZE, n_files) + 1]
+        sizes = np.diff(offsets)
+        # For each tag position: the number of tags on its file, and the file's first position
+        position_sizes = np.repeat(sizes, sizes)
+        position_starts = np.repeat(offsets[:-1], sizes)
+        # Pair each position with every position of the same file, including itself
+        lefts = np.repeat(np.arange(offsets[0], offsets[-1]), position_sizes)
+        block_starts = np.cumsum(position_sizes) - position_sizes
+        rights = (np.repeat(position_starts, position_sizes) + np.arange(len(lefts)) -
+                  np.repeat(block_starts, position_sizes))
+        distinct = lefts != rights
+        chunk_keys = file_tags[lefts[distinct]] * n_tags + file_tags[rights[distinct]]
+
+        # Merge with the counts so far
+        all_keys = np.concatenate([keys, chunk_keys])
+        all_counts = np.concatenate([counts, np.ones(len(chunk_keys), dtype=np.int64)])
+        keys, inverse = np.unique(all_keys, return_inverse=True)
+        counts = np.bincount(inverse.ravel(), weights=all_counts).astype(np.int64)
+    return keys, counts
+
+
+def _named(counts: List[Tuple[int, int]]) -> List[Tuple[str, int]]:
+    names = dict(
+        Tag.select(Tag.id, Tag.name).where(Tag.id.in_([tag_id for tag_id, _ in counts
+                                                       ])).tuples()) if counts else {}
+    return [(names[tag_id], count) for tag_id, count in counts if tag_id in names]
+
+
+def _grow(array: np.ndarray, size: int) -> np.ndarray:
+    if len(array) >= size:
+        return array
+    return np.concatenate([array, np.zeros(size - len(array), dtype=array.dtype)])
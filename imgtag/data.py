@@ -1,15 +1,27 @@
 """Defines all data-layer models and query logic."""
 
+import collections
+import contextlib
+import functools
+import itertools
 import logging
+import operator
 import os
-from typing import Any, Dict, List, Tuple
+import threading
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple
 
 import peewee as pw
 from beaker.cache import CacheManager
 from beaker.util import parse_cache_config_options
+from playhouse.migrate import SqliteMigrator, migrate
 
+from . import diagnostics
+from .diagnostics import timed
 from .logger import get_logger
-from .settings import DB_FILEPATH, LOG_LEVEL, ROOT_DIR
+from .roots import get_roots, resolve_filepaths
+from .settings import DB_FILEPATH, DB_SHARD_BY, DB_SHARD_DIR, LOG_LEVEL
+from .shards import ShardSet, get_shards, init_shards, list_shard_files
+from .utils import normalize_tagname
 
 logger = get_logger(__name__)
 
@@ -18,7 +30,22 @@ logger_pw = get_logger('peewee')
 logger_pw.addHandler(logging.StreamHandler())
 logger_pw.setLevel(LOG_LEVEL)
 
-db = pw.SqliteDatabase(DB_FILEPATH)
+
+class InstrumentedSqliteDatabase(pw.SqliteDatabase):
+    """A SQLite database that counts every executed statement (see `diagnostics`)."""
+    def execute_sql(self, sql, *args, **kwargs):
+        diagnostics.record_query(sql)
+        return super().execute_sql(sql, *args, **kwargs)
+
+    def _add_conn_hooks(self, conn):
+        super()._add_conn_hooks(conn)
+        # Every connection (one per thread) needs the shards attached
+        shards = get_shards()
+        if shards:
+            shards.attach(conn)
+
+
+db = InstrumentedSqliteDatabase(DB_FILEPATH)
 
 # beaker caching via decorator API
 cache = CacheManager(**parse_cache_config_options({
@@ -28,6 +55,36 @@ cache = CacheManager(**parse_cache_config_options({
     'cache.lock_dir': '.beaker_cache/lock',
 }))
 
+# Per-thread miss counters, used to tell cache hits from misses
+_cache_misses = threading.local()
+
+
+def cached(namespace: str, **kwargs) -> Callable:
+    """Like `cache.cache`, but also records cache hits and misses (see `diagnostics`).
+
+    The decorated function can be passed to `cache.invalidate` as usual.
+    """
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def miss(*args):
+            setattr(_cache_misses, namespace, getattr(_cache_misses, namespace, 0) + 1)
+            return func(*args)
+
+        beaker_cached = cache.cache(namespace, **kwargs)(miss)
+
+        # NOTE: This also copies the attributes beaker needs for invalidation
+        @functools.wraps(beaker_cached)
+        def wrapper(*args):
+            misses = getattr(_cache_misses, namespace, 0)
+            result = beaker_cached(*args)
+            diagnostics.record_cache(namespace, hit=getattr(_cache_misses, namespace, 0) == misses)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
 # -- Models
 
 
@@ -40,6 +97,16 @@ class File(BaseModel):
     name = pw.CharField(unique=True)
     # Cached path for faster loads
     path = pw.CharField(null=True)
+    # Image attributes, filled in by `metadata.refresh_metadata` (see `set_file_attributes`)
+    width = pw.IntegerField(null=True, index=True)
+    height = pw.IntegerField(null=True, index=True)
+    size = pw.IntegerField(null=True, index=True)
+    mtime = pw.FloatField(null=True, index=True)
+    format = pw.CharField(null=True, index=True)
+    # User rating (1-5), or null if unrated
+    rating = pw.IntegerField(null=True, index=True)
+    # Shard holding the file's tags, if sharded (assigned when first tagged, see `_file_shards`)
+    shard = pw.CharField(null=True)
 
 
 class Tag(BaseModel):
@@ -50,16 +117,335 @@ class FileTag(BaseModel):
     fil = pw.ForeignKeyField(File)
     tag = pw.ForeignKeyField(Tag)
 
+    class Meta:
+        indexes = ((('fil', 'tag'), True), )
+
+
+class TagAlias(BaseModel):
+    """An alternative name that is replaced by the target tag whenever it is used."""
+    alias = pw.CharField(unique=True)
+    tag = pw.ForeignKeyField(Tag)
+
+
+class TagImplication(BaseModel):
+    """A rule that any file tagged with `tag` is also tagged with `implied`."""
+    tag = pw.ForeignKeyField(Tag)
+    implied = pw.ForeignKeyField(Tag)
+
+    class Meta:
+        indexes = ((('tag', 'implied'), True), )
+
+
+class TagClosure(BaseModel):
+    """The transitive closure of all implications, so that applying them is a single lookup."""
+    tag = pw.ForeignKeyField(Tag)
+    implied = pw.ForeignKeyField(Tag)
+
+    class Meta:
+        indexes = ((('tag', 'implied'), True), )
+
+
+MODELS = [File, Tag, FileTag, TagAlias, TagImplication, TagClosure]
+
+# File columns that can be filtered and sorted on (see `get_files_with_tags`)
+FILE_ATTRIBUTES = ['width', 'height', 'size', 'mtime', 'format', 'rating']
+# Comparison operators for filters
+FILTER_OPS: Dict[str, Callable[[Any, Any], Any]] = {
+    '=': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+# (attribute, operator, value), e.g. ('width', '>', 3000)
+FileFilter = Tuple[str, str, Any]
+
+# Rows per bulk insert (keeps us under SQLite's bound variable limit)
+INSERT_CHUNK_SIZE = 300
+
+# Trigram full-text index over tag names, kept in sync with the tag table by triggers
+TAG_INDEX_TABLE = 'tag_fts'
+TAG_INDEX_SQL = [
+    f"""CREATE VIRTUAL TABLE {TAG_INDEX_TABLE}
+        USING fts5(name, content='tag', content_rowid='id', tokenize='trigram')""",
+    f"""CREATE TRIGGER IF NOT EXISTS {TAG_INDEX_TABLE}_ai AFTER INSERT ON tag BEGIN
+        INSERT INTO {TAG_INDEX_TABLE}(rowid, name) VALUES (new.id, new.name);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {TAG_INDEX_TABLE}_ad AFTER DELETE ON tag BEGIN
+        INSERT INTO {TAG_INDEX_TABLE}({TAG_INDEX_TABLE}, rowid, name)
+            VALUES ('delete', old.id, old.name);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {TAG_INDEX_TABLE}_au AFTER UPDATE ON tag BEGIN
+        INSERT INTO {TAG_INDEX_TABLE}({TAG_INDEX_TABLE}, rowid, name)
+            VALUES ('delete', old.id, old.name);
+        INSERT INTO {TAG_INDEX_TABLE}(rowid, name) VALUES (new.id, new.name);
+    END""",
+    # Per-trigram document frequencies, used to skip overly common trigrams in fuzzy search
+    f"CREATE VIRTUAL TABLE {TAG_INDEX_TABLE}_vocab USING fts5vocab({TAG_INDEX_TABLE}, 'row')",
+]
+
+# Counts of rows inserted, updated or deleted per table, kept by triggers (so that they count every
+# write, whichever connection made it), to tell when anything derived from them is out of date
+CHANGE_COUNTER_TABLE = 'change_counter'
+
+
+def change_counter_sql(
+    table: str, events: Sequence[str] = ('INSERT', 'UPDATE', 'DELETE')) -> List[str]:
+    """Returns the statements counting changes to the table, in the table's own database."""
+    return [
+        f'CREATE TABLE IF NOT EXISTS {CHANGE_COUNTER_TABLE} '
+        '(name TEXT NOT NULL PRIMARY KEY, count INTEGER NOT NULL)',
+        f"INSERT OR IGNORE INTO {CHANGE_COUNTER_TABLE} (name, count) VALUES ('{table}', 0)",
+    ] + [
+        f"""CREATE TRIGGER IF NOT EXISTS {table}_count_{event.lower()} AFTER {event} ON {table}
+            BEGIN
+                UPDATE {CHANGE_COUNTER_TABLE} SET count = count + 1 WHERE name = '{table}';
+            END""" for event in events
+    ]
+
+
+# Set by init_db(); without the index (SQLite < 3.34), tag search falls back to table scans
+_has_tag_index = False
+
+# (file ID, tag ID) pairs
+FileTagPairs = List[Tuple[int, int]]
+
+# Callbacks notified of every committed change to file tags, see `add_filetag_observer`
+_filetag_observers: List[Callable[[FileTagPairs, FileTagPairs], None]] = []
+
+# Per-thread state of the current `batched_writes` block, if any
+_batch = threading.local()
+
+# Shard name -> model of the shard's `filetag` table, if sharded (see `_init_shards`)
+_shard_models: Dict[str, Any] = {}
+
+# -- Setup
+
+
+def init_db(shard_by: str = DB_SHARD_BY, shard_dir: str = DB_SHARD_DIR):
+    """Creates any missing tables and indexes, and sets up sharding (see `shards`).
+
+    Safe to call on every startup.
+    """
+    global _has_tag_index
+    db.connect(reuse_if_open=True)
+    if _needs_filetag_dedup():
+        # Databases created before (file, tag) was unique may contain duplicates
+        FileTag.delete().where(
+            FileTag.id.not_in(
+                FileTag.select(pw.fn.MIN(FileTag.id)).group_by(FileTag.fil,
+                                                               FileTag.tag))).execute()
+    _add_missing_columns(File)
+    if shard_by == 'none':
+        if list_shard_files(shard_dir):
+            raise ValueError(f'Sharding is disabled but {shard_dir} has shards; merge them '
+                             f'first (db_helper.py --merge-shards)')
+        db.create_tables(MODELS)
+        _execute_all(change_counter_sql(FileTag._meta.table_name))
+    else:
+        # NOTE: The main database's own `filetag` table only exists until its rows are moved
+        db.create_tables([model for model in MODELS if model is not FileTag])
+        _init_shards(shard_by, shard_dir)
+    # Files are updated all the time (e.g. cached paths), but only their IDs and names matter
+    _execute_all(change_counter_sql(File._meta.table_name, ['INSERT', 'DELETE']))
+    try:
+        if TAG_INDEX_TABLE not in db.get_tables():
+            with db.atomic():
+                for sql in TAG_INDEX_SQL:
+                    db.execute_sql(sql)
+                db.execute_sql(
+                    f"INSERT INTO {TAG_INDEX_TABLE}({TAG_INDEX_TABLE}) VALUES ('rebuild')")
+            logger.info('Built tag search index')
+        _has_tag_index = True
+    except pw.OperationalError as e:
+        logger.warning(f'Tag search index not available ({e}); falling back to table scans')
+        _has_tag_index = False
+
+
+def _execute_all(statements: List[str]):
+    with db.atomic():
+        for sql in statements:
+            db.execute_sql(sql)
+
+
+def _add_missing_columns(model):
+    """Adds any columns defined on the model but missing from its (existing) table."""
+    table = model._meta.table_name
+    if table not in db.get_tables():
+        return
+    existing = {column.name for column in db.get_columns(table)}
+    missing = [field for field in model._meta.sorted_fields if field.column_name not in existing]
+    if missing:
+        migrator = SqliteMigrator(db)
+        with db.atomic():
+            migrate(*[migrator.add_column(table, field.column_name, field) for field in missing])
+        logger.info(f'Added column(s) {[field.name for field in missing]} to {table}')
+
+
+def _init_shards(shard_by: str, shard_dir: str):
+    """Sets up the shards, moving any file tags still in the main database into them."""
+    if shard_by == 'root':
+        names = [root.name for root in get_roots()]
+    else:
+        names = [
+            year for (year, ) in db.execute_sql(
+                "SELECT DISTINCT strftime('%Y', mtime, 'unixepoch', 'localtime') FROM file "
+                'WHERE mtime IS NOT NULL')
+        ]
+    shards = init_shards(shard_by, shard_dir, names, change_counter_sql(FileTag._meta.table_name))
+    shards.attach(db.connection())
+    _shard_models.clear()
+    _shard_models.update({name: _shard_model(schema) for name, schema in shards.schemas.items()})
+
+    if FileTag._meta.table_name in db.get_tables():
+        with db.atomic():
+            _file_shards([
+                file_id
+                for (file_id, ) in db.execute_sql('SELECT DISTINCT fil_id FROM main.filetag')
+            ])
+            for name, schema in shards.schemas.items():
+                db.execute_sql(
+                    f'INSERT OR IGNORE INTO {schema}.filetag (fil_id, tag_id) '
+                    'SELECT filetag.fil_id, filetag.tag_id FROM main.filetag '
+                    'JOIN file ON file.id = filetag.fil_id WHERE file.shard = ?', (name, ))
+            db.execute_sql('DROP TABLE main.filetag')
+        logger.info(f'Moved file tags into {len(shards.names)} shard(s)')
+
+
+def _shard_model(schema: str) -> Any:
+    """Returns a model of the `filetag` table in the given (attached) shard."""
+    meta = type('Meta', (), {'table_name': FileTag._meta.table_name, 'schema': schema})
+    return type(
+        f'FileTag_{schema}', (BaseModel, ), {
+            '__module__': __name__,
+            'Meta': meta,
+            'fil': pw.ForeignKeyField(File, backref='+'),
+            'tag': pw.ForeignKeyField(Tag, backref='+'),
+        })
+
+
+def _needs_filetag_dedup() -> bool:
+    table = FileTag._meta.table_name
+    if table not in db.get_tables():
+        return False
+    return not any(index.unique and index.columns == ['fil_id', 'tag_id']
+                   for index in db.get_indexes(table))
+
+
+def get_change_counts() -> List[Tuple[str, int]]:
+    """Returns the number of changes ever made to files and file tags, per table (in the main
+    database and each shard).
+
+    These only ever grow, so unlike row counts or maximum IDs, they always change after a write.
+    """
+    schemas = ['main']
+    shards = get_shards()
+    if shards:
+        schemas.extend(shards.schemas.values())
+    return [(f'{schema}.{name}', count) for schema in schemas for name, count in db.execute_sql(
+        f'SELECT name, count FROM {schema}.{CHANGE_COUNTER_TABLE} ORDER BY name')]
+
+
+def clear_caches():
+    """Clears all cached query results, e.g. after bulk changes."""
+    for func in (get_file_path, get_file_tags, count_files_with_tag):
+        _clear_cache(func)
+    _after_commit(clear_caches)
+
+
+@contextlib.contextmanager
+def batched_writes():
+    """Runs all writes in the block in a single transaction.
+
+    Observer notifications (and cache invalidations, since other threads may re-cache old values in
+    the meantime) are deferred until the outermost block commits, and dropped if it rolls back.
+    """
+    outermost = not getattr(_batch, 'active', False)
+    if outermost:
+        _batch.active = True
+        _batch.callbacks = []
+    n_callbacks = len(_batch.callbacks)
+    try:
+        with db.atomic():
+            yield
+    except BaseException:
+        del _batch.callbacks[n_callbacks:]
+        raise
+    finally:
+        if outermost:
+            _batch.active = False
+    if outermost:
+        for callback in _batch.callbacks:
+            callback()
+
+
+def add_filetag_observer(callback: Callable[[FileTagPairs, FileTagPairs], None]):
+    """Registers a callback that is called with the (file ID, tag ID) pairs added and removed by
+    every write, after it is committed.
+
+    This lets in-memory indexes stay in sync without reloading. Note that callbacks are called on
+    whichever thread did the write.
+    """
+    _filetag_observers.append(callback)
+
+
+def remove_filetag_observer(callback: Callable[[FileTagPairs, FileTagPairs], None]):
+    _filetag_observers.remove(callback)
+
+
+def _notify_filetags(added: FileTagPairs = [], removed: FileTagPairs = []):
+    if not added and not removed:
+        return
+    if getattr(_batch, 'active', False):
+        _batch.callbacks.append(functools.partial(_notify_filetags, added, removed))
+        return
+    for callback in list(_filetag_observers):
+        callback(added, removed)
+
+
+def _invalidate(func: Callable, *args):
+    """Like `cache.invalidate`, but invalidates again after the current batch commits (if any)."""
+    cache.invalidate(func, *args)
+    _after_commit(functools.partial(cache.invalidate, func, *args))
+
+
+def _clear_cache(func: Any):
+    """Clears all cached results of a function decorated with `cached`."""
+    cache.get_cache(func._arg_namespace).clear()
+
+
+def _after_commit(callback: Callable[[], None]):
+    if getattr(_batch, 'active', False):
+        _batch.callbacks.append(callback)
+
+
+def drop_tables():
+    """Drops all tables and indexes."""
+    db.connect(reuse_if_open=True)
+    db.execute_sql(f'DROP TABLE IF EXISTS {TAG_INDEX_TABLE}_vocab')
+    db.execute_sql(f'DROP TABLE IF EXISTS {TAG_INDEX_TABLE}')
+    if _shard_models:
+        # `filetag` is the view over the shards, which are emptied instead
+        for model in _shard_models.values():
+            model.delete().execute()
+        db.drop_tables([model for model in MODELS if model is not FileTag])
+        db.execute_sql('DROP TABLE IF EXISTS main.filetag')
+    else:
+        db.drop_tables(MODELS)
+
 
 # -- File
 
 
-@cache.cache('get_file_path', duration=3600)
+@timed
+@cached('get_file_path', duration=3600)
 def get_file_path(filename: str) -> str:
     fil, _created = File.get_or_create(name=filename)
     if fil.path and os.path.exists(fil.path):
         return fil.path
-    path = _resolve_filepath(ROOT_DIR, filename)
+    path = _resolve_filepath(filename)
     if path:
         set_file_path(filename, path)
         return path
@@ -67,6 +453,7 @@ def get_file_path(filename: str) -> str:
     return ''
 
 
+@timed
 def set_file_path(filename: str, path: str):
     cache.invalidate(get_file_path, 'get_file_path', filename)
 
@@ -75,54 +462,92 @@ def set_file_path(filename: str, path: str):
     return fil.save()
 
 
-def get_file_paths(root_path: str, filenames: List[str]) -> List[str]:
+@timed
+def get_file_paths(filenames: List[str]) -> List[str]:
     """Returns the full paths for the given filenames.
 
-    If the path is not cached in the database or is invalid, manually resolves the path and updates
-    the database.
-    """
-    paths = []
-    for filename, filepath in ((filename, get_file_path(filename)) for filename in filenames):
-        # NOTE: Need to check if path is valid in case we get an outdated cached path
-        if not filepath or not os.path.exists(filepath):
-            filepath = _resolve_filepath(root_path, filename)
-            if filepath:
-                set_file_path(filename, filepath)
-                logger.debug(f'Saved filepath for {filename}')
-        paths.append(filepath)
-    return paths
-
-
-def _resolve_filepath(root_path: str, filename: str) -> str:
-    """Returns the path of the _first_ matching filename.
-
-    If the file is not found, returns an empty string.
-    """
-    # TODO: Is there a more efficient way of doing this? Maybe with glob?
-    for dirpath, _, filenames in os.walk(root_path):
-        for fname in filenames:
-            if fname == filename:
-                filepath = os.path.join(dirpath, fname)
-                logger.debug(f'Found {filename} at {filepath}')
-                return filepath
-    logger.info(f'Filename {filename} not found - removing from database')
-    delete_file(filename)
-    return ''
+    If the path is not cached in the database or is invalid, resolves the path (see `roots`) and
+    updates the database. Such files are resolved together, so that roots are rescanned at most
+    once.
+    """
+    stored: Dict[str, str] = {}
+    for chunk in chunks(filenames):
+        query = File.select(File.name, File.path).where(File.name.in_(chunk))
+        stored.update(query.where(File.path.is_null(False)).tuples())
+    # NOTE: Need to check if path is valid in case we get an outdated cached path
+    unresolved = {
+        filename
+        for filename in filenames if filename not in stored or not os.path.exists(stored[filename])
+    }
+    resolved = _resolve_filepaths(sorted(unresolved)) if unresolved else {}
+    for filename, filepath in resolved.items():
+        set_file_path(filename, filepath)
+        logger.debug(f'Saved filepath for {filename}')
+    return [
+        resolved.get(filename, '') if filename in unresolved else stored[filename]
+        for filename in filenames
+    ]
+
+
+def _resolve_filepath(filename: str) -> str:
+    """Returns the path of the file under the highest priority root containing it (see
+    `_resolve_filepaths`), or an empty string.
+    """
+    return _resolve_filepaths([filename]).get(filename, '')
 
 
+def _resolve_filepaths(filenames: List[str]) -> Dict[str, str]:
+    """Returns the paths of the files under the highest priority root containing each of them.
+
+    Files that are definitely missing, i.e. not found in a fresh scan of every root, are removed
+    from the database. Otherwise (e.g. if a root is unavailable, or was scanned recently and the
+    file may have been added since) they are kept.
+    """
+    filepaths, definitely_missing = resolve_filepaths(filenames)
+    for filename in filenames:
+        if filename in filepaths:
+            logger.debug(f'Found {filename} at {filepaths[filename]}')
+        elif definitely_missing:
+            logger.info(f'Filename {filename} not found - removing from database')
+            delete_file(filename)
+        else:
+            logger.info(f'Filename {filename} not found, but roots are unavailable or were not '
+                        f'rescanned')
+    return filepaths
+
+
+@timed
 def delete_file(filename: str) -> int:
     """Deletes the given file, along with all tag associations, and returns the number of rows
     deleted.
     """
-    cache.invalidate(get_file_tags, 'get_file_tags', filename)
+    _invalidate(get_file_tags, 'get_file_tags', filename)
 
-    return File.delete().where(File.name == filename).execute()
+    with db.atomic():
+        fil = File.get_or_none(name=filename)
+        if not fil:
+            return 0
+        model = _filetag_model(fil.id)
+        removed = list(model.select(model.fil, model.tag).where(model.fil == fil).tuples())
+        model.delete().where(model.fil == fil).execute()
+        n_rows = fil.delete_instance()
+    _notify_filetags(removed=removed)
+    return n_rows
 
 
 # -- Tag
 
 
+@timed
 def get_all_tags() -> List[Tuple[str, int]]:
+    shards = get_shards()
+    if shards:
+        # Counted on every shard in parallel
+        counts: Dict[int, int] = collections.Counter()
+        for rows in shards.fan_out('SELECT tag_id, COUNT(*) FROM filetag GROUP BY tag_id'):
+            counts.update(dict(rows))
+        return [(name, counts[tag_id])
+                for tag_id, name in Tag.select(Tag.id, Tag.name).order_by(Tag.name.asc()).tuples()]
     query = (Tag.select(Tag.name,
                         pw.fn.COUNT(FileTag.id).alias('file_count')).join(
                             FileTag,
@@ -130,10 +555,62 @@ def get_all_tags() -> List[Tuple[str, int]]:
     return [(tag.name, tag.file_count) for tag in query]
 
 
+def get_tag_ids(tagnames: Iterable[str]) -> Dict[str, int]:
+    """Returns the IDs of the given tags (that exist), by name."""
+    ids: Dict[str, int] = {}
+    for chunk in chunks(set(tagnames)):
+        ids.update(Tag.select(Tag.name, Tag.id).where(Tag.name.in_(chunk)).tuples())
+    return ids
+
+
+@timed
+def search_tags(term: str, limit: int = 20) -> List[str]:
+    """Returns up to `limit` tag names matching the given term.
+
+    Substring matches come first (prefix matches, then shorter names), followed by fuzzy matches
+    ranked by trigram similarity, e.g. `sunset` also finds `sun_set` and `sunsets`.
+    """
+    term = normalize_tagname(term)
+    if not term:
+        return []
+    if not _has_tag_index or len(term) < 3:
+        # Trigrams need at least three characters
+        # NOTE: instr() rather than LIKE, since underscores are LIKE wildcards
+        names = [tag.name for tag in Tag.select(Tag.name).where(pw.fn.instr(Tag.name, term) > 0)]
+        return sorted(names, key=lambda name: _substring_rank(term, name))[:limit]
+
+    names = [
+        row[0] for row in db.execute_sql(
+            f'SELECT name FROM {TAG_INDEX_TABLE} WHERE {TAG_INDEX_TABLE} MATCH ? '
+            'ORDER BY length(name) LIMIT ?', (_fts_phrase(term), limit * 5))
+    ]
+    results = sorted(names, key=lambda name: _substring_rank(term, name))[:limit]
+    if len(results) >= limit:
+        return results
+
+    # Fuzzy: any shared (selective) trigram, then rerank by similarity
+    trigrams = _selective_trigrams(term)
+    similarity_trigrams = _trigrams(term.replace('_', ''))
+    candidates = [
+        row[0] for row in db.execute_sql(
+            f'SELECT name FROM {TAG_INDEX_TABLE} WHERE {TAG_INDEX_TABLE} MATCH ? '
+            'ORDER BY rank LIMIT ?', (' OR '.join(_fts_phrase(t)
+                                                  for t in trigrams), FUZZY_CANDIDATES))
+    ] if trigrams else []
+    seen = set(results)
+    # Ignore underscores when scoring so that e.g. `sun_set` is a close match for `sunset`
+    scored = [(_similarity(similarity_trigrams, _trigrams(name.replace('_', ''))), name)
+              for name in candidates if name not in seen]
+    results.extend(name for score, name in sorted(scored, key=lambda s: (-s[0], s[1]))
+                   if score >= FUZZY_THRESHOLD)
+    return results[:limit]
+
+
 # -- FileTag
 
 
-@cache.cache('get_file_tags', duration=3600)
+@timed
+@cached('get_file_tags', duration=3600)
 def get_file_tags(filename: str) -> List[Tuple[str, int]]:
     tags = (Tag.select(Tag.name).join(FileTag).join(File).where(File.name == filename).order_by(
         Tag.name.asc()))
@@ -142,6 +619,7 @@ def get_file_tags(filename: str) -> List[Tuple[str, int]]:
     return [(tag.name, count_files_with_tag(tag.name)) for tag in tags]
 
 
+@timed
 def get_files_with_tag(tagname: str) -> List[str]:
     tag = Tag.get_or_none(name=tagname)
     if not tag:
@@ -150,10 +628,41 @@ def get_files_with_tag(tagname: str) -> List[str]:
         [fil.name for fil in File.select(File.name).join(FileTag).where(FileTag.tag == tag)])
 
 
-def get_files_with_tags(tagnames: List[str], excluded_tagnames: List[str] = []) -> List[str]:
-    results = set(get_files_with_tag(tagnames[0]))
-    for tagname in tagnames[1:]:
-        filenames = set(get_files_with_tag(tagname))
+@timed
+def get_files_with_any_tag(tagnames: List[str]) -> List[str]:
+    """Returns all files having at least one of the given tags."""
+    if not tagnames:
+        return []
+    query = (File.select(File.name).join(FileTag).join(Tag).where(
+        Tag.name.in_(tagnames)).distinct())
+    return sorted([fil.name for fil in query])
+
+
+@timed
+def get_files_with_tags(tagnames: List[str],
+                        excluded_tagnames: List[str] = [],
+                        alternative_tagnames: List[List[str]] = [],
+                        filters: List[FileFilter] = [],
+                        sort: Optional[str] = None,
+                        descending: bool = False) -> List[str]:
+    """Returns all files having all of `tagnames`, none of `excluded_tagnames`, and at least one
+    tag from each group in `alternative_tagnames`.
+
+    Files can also be filtered and sorted by attributes (see `FILE_ATTRIBUTES`); otherwise they
+    are sorted by name.
+    """
+    if filters or sort:
+        return _query_files(tagnames, excluded_tagnames, alternative_tagnames, filters, sort,
+                            descending)
+    shards = get_shards()
+    if shards:
+        return _query_shards(shards, tagnames, excluded_tagnames, alternative_tagnames)
+    candidates = ([set(get_files_with_tag(tagname)) for tagname in tagnames] +
+                  [set(get_files_with_any_tag(group)) for group in alternative_tagnames])
+    if not candidates:
+        return []
+    results = candidates[0]
+    for filenames in candidates[1:]:
         results = results.intersection(filenames)
     # Filter out files with at least one excluded tag
     for tagname in excluded_tagnames:
@@ -162,43 +671,479 @@ def get_files_with_tags(tagnames: List[str], excluded_tagnames: List[str] = [])
     return sorted(list(results))
 
 
-def add_file_tag(filename: str, tagname: str):
-    cache.invalidate(get_file_tags, 'get_file_tags', filename)
-    cache.invalidate(count_files_with_tag, 'count_files_with_tag', tagname)
+@timed
+def add_file_tag(filename: str, tagname: str, with_implied: bool = True) -> List[str]:
+    """Adds the given tag to the file, along with all tags it implies (unless `with_implied` is
+    False).
+
+    Aliases are replaced by their target tag. Returns the names of the tags that were actually
+    added, i.e. that the file didn't already have.
+    """
+    tagname = resolve_tagname(tagname)
+    _invalidate(get_file_tags, 'get_file_tags', filename)
+    _invalidate(count_files_with_tag, 'count_files_with_tag', tagname)
+
+    with db.atomic():
+        fil, _ = File.get_or_create(name=filename)
+        tag, _ = Tag.get_or_create(name=tagname)
+        implied = _implied_tags([tag.id]) if with_implied else {}
+        added = _insert_filetags([(fil.id, tag.id)] + [(fil.id, tag_id) for tag_id in implied])
+    for implied_tagname in implied.values():
+        _invalidate(count_files_with_tag, 'count_files_with_tag', implied_tagname)
+    _notify_filetags(added=added)
 
-    fil, _ = File.get_or_create(name=filename)
-    tag, _ = Tag.get_or_create(name=tagname)
-    _, filetag_created = FileTag.get_or_create(fil=fil, tag=tag)
-    if filetag_created:
+    if (fil.id, tag.id) in added:
         logger.info(f'Added tag {tagname} to {filename}')
     else:
         logger.info(f'{filename} already has tag {tagname}; nothing to do')
+    added_implied = sorted(implied[tag_id] for _, tag_id in added if tag_id in implied)
+    if added_implied:
+        logger.info(f'Added implied tag(s) {added_implied} to {filename}')
+    return ([tagname] if (fil.id, tag.id) in added else []) + added_implied
 
 
+@timed
 def remove_file_tag(filename: str, tagname: str) -> int:
     # NOTE: We don't bother invalidating cached tag counts for other images
     #       since it doesn't seem to justify the extra computational work
-    cache.invalidate(get_file_tags, 'get_file_tags', filename)
-    cache.invalidate(count_files_with_tag, 'count_files_with_tag', tagname)
+    _invalidate(get_file_tags, 'get_file_tags', filename)
+    _invalidate(count_files_with_tag, 'count_files_with_tag', tagname)
 
     fil = File.get_or_none(name=filename)
     tag = Tag.get_or_none(name=tagname)
-    n_rows = FileTag.delete().where((FileTag.fil == fil) & (FileTag.tag == tag)).execute()
+    model = _filetag_model(fil.id) if fil else FileTag
+    n_rows = model.delete().where((model.fil == fil) & (model.tag == tag)).execute()
+    if n_rows:
+        _notify_filetags(removed=[(fil.id, tag.id)])
     logger.info(f'Removed tag {tagname} from {filename} ({n_rows} row(s) modified)')
     return n_rows
 
 
+def _query_files(tagnames: List[str], excluded_tagnames: List[str],
+                 alternative_tagnames: List[List[str]], filters: List[FileFilter],
+                 sort: Optional[str], descending: bool) -> List[str]:
+    """Same as `get_files_with_tags`, but as a single query so that filtering and sorting by
+    attributes can use the indexes on `File`.
+    """
+    def with_any(names: List[str]) -> pw.SelectQuery:
+        return FileTag.select(FileTag.fil).join(Tag).where(Tag.name.in_(names))
+
+    query = File.select(File.name)
+    for tagname in tagnames:
+        query = query.where(File.id.in_(with_any([tagname])))
+    for group in alternative_tagnames:
+        query = query.where(File.id.in_(with_any(group)))
+    if excluded_tagnames:
+        query = query.where(File.id.not_in(with_any(excluded_tagnames)))
+    for attribute, op, value in filters:
+        query = query.where(FILTER_OPS[op](getattr(File, attribute), value))
+    if sort:
+        field = getattr(File, sort)
+        query = query.order_by(field.desc() if descending else field.asc(), File.name.asc())
+    else:
+        query = query.order_by(File.name.asc())
+    return [name for (name, ) in query.tuples()]
+
+
+def _query_shards(shards: ShardSet, tagnames: List[str], excluded_tagnames: List[str],
+                  alternative_tagnames: List[List[str]]) -> List[str]:
+    """Same as `get_files_with_tags` (without filters or sorting), as a single compound query run
+    on every shard in parallel.
+    """
+    names = set(tagnames) | set(excluded_tagnames)
+    for group in alternative_tagnames:
+        names.update(group)
+    tag_ids = get_tag_ids(names)
+    if any(tagname not in tag_ids for tagname in tagnames):
+        return []
+
+    selects: List[str] = []
+    params: List[int] = []
+    for group in [[tagname] for tagname in tagnames] + alternative_tagnames:
+        ids = [tag_ids[name] for name in group if name in tag_ids]
+        if not ids:
+            return []
+        selects.append(f'SELECT fil_id FROM filetag WHERE tag_id IN ({", ".join("?" * len(ids))})')
+        params.extend(ids)
+    if not selects:
+        return []
+    sql = ' INTERSECT '.join(selects)
+    excluded_ids = [tag_ids[name] for name in excluded_tagnames if name in tag_ids]
+    if excluded_ids:
+        sql += (' EXCEPT SELECT fil_id FROM filetag '
+                f'WHERE tag_id IN ({", ".join("?" * len(excluded_ids))})')
+        params.extend(excluded_ids)
+
+    file_ids = sorted({file_id for rows in shards.fan_out(sql, params) for (file_id, ) in rows})
+    filenames: List[str] = []
+    for chunk in chunks(file_ids):
+        filenames.extend(name
+                         for (name, ) in File.select(File.name).where(File.id.in_(chunk)).tuples())
+    return sorted(filenames)
+
+
+@timed
+def get_tagged_filenames() -> Set[str]:
+    """Returns the names of all files with at least one tag, in a single (index-only) query."""
+    return {name for (name, ) in File.select(File.name).where(pw.fn.EXISTS(_file_tags())).tuples()}
+
+
+@timed
+def get_untagged_files() -> List[str]:
+    """Returns all files known to the database (e.g. from `metadata`) that have no tags."""
+    query = File.select(File.name).where(~pw.fn.EXISTS(_file_tags())).order_by(File.name)
+    return [name for (name, ) in query.tuples()]
+
+
+def _file_tags() -> pw.SelectQuery:
+    # Correlated subquery, answered from the unique (fil, tag) index
+    return FileTag.select(pw.SQL('1')).where(FileTag.fil == File.id)
+
+
 # TODO caching + invalidation
+@timed
 def get_file_metadata(filename: str) -> Dict[str, Any]:
-    [fil] = File.select(pw.fn.Count(FileTag.id).alias('tag_count')).join(
-        FileTag, pw.JOIN.LEFT_OUTER).where(File.name == filename)
-    return {'tag_count': fil.tag_count}
+    fil = File.select(File.id, File.shard,
+                      *[getattr(File, attribute)
+                        for attribute in FILE_ATTRIBUTES]).where(File.name == filename).first()
+    return {
+        'tag_count': _count_file_tags(fil) if fil else 0,
+        **{attribute: getattr(fil, attribute, None)
+           for attribute in FILE_ATTRIBUTES}
+    }
+
+
+@timed
+def set_file_rating(filename: str, rating: Optional[int]):
+    """Sets the file's rating (1-5), or clears it if None."""
+    if rating is not None and not 1 <= rating <= 5:
+        raise ValueError(f'Invalid rating {rating}')
+    File.insert(name=filename, rating=rating).on_conflict(conflict_target=[File.name],
+                                                          preserve=[File.rating]).execute()
+    logger.info(f'Set rating of {filename} to {rating}')
+
+
+def get_file_stats() -> Dict[str, Tuple[Optional[int], Optional[float]]]:
+    """Returns the stored size and modification time of every file, to detect changed files."""
+    return {
+        name: (size, mtime)
+        for name, size, mtime in File.select(File.name, File.size, File.mtime).tuples()
+    }
+
+
+@timed
+def set_file_attributes(rows: List[Dict[str, Any]]):
+    """Stores the path and attributes of many files at once, creating them as needed.
+
+    Each row has a `name`, `path` and all of `FILE_ATTRIBUTES` except `rating`.
+    """
+    fields = [File.path] + [getattr(File, a) for a in FILE_ATTRIBUTES if a != 'rating']
+    with db.atomic():
+        # Rows are wider than usual, so use smaller chunks
+        for chunk in chunks(rows, INSERT_CHUNK_SIZE // 3):
+            File.insert_many(chunk).on_conflict(conflict_target=[File.name],
+                                                preserve=fields).execute()
+    _clear_cache(get_file_path)
+
+
+# -- Tag rules
+
+
+@timed
+def resolve_tagname(tagname: str) -> str:
+    """Returns the target of the given alias, or the tag name itself if it isn't an alias."""
+    alias = TagAlias.select(TagAlias, Tag).join(Tag).where(TagAlias.alias == tagname).first()
+    return alias.tag.name if alias else tagname
+
+
+@timed
+def resolve_tagnames(tagnames: List[str]) -> List[str]:
+    """Like `resolve_tagname`, but for many tags in a single query."""
+    if not tagnames:
+        return []
+    targets = {
+        alias.alias: alias.tag.name
+        for alias in TagAlias.select(TagAlias, Tag).join(Tag).where(TagAlias.alias.in_(tagnames))
+    }
+    return [targets.get(tagname, tagname) for tagname in tagnames]
+
+
+def get_tag_aliases() -> List[Tuple[str, str]]:
+    query = TagAlias.select(TagAlias, Tag).join(Tag).order_by(TagAlias.alias.asc())
+    return [(alias.alias, alias.tag.name) for alias in query]
+
+
+def get_tag_implications() -> List[Tuple[str, str]]:
+    implied = Tag.alias()
+    query = (TagImplication.select(Tag.name, implied.name.alias('implied_name')).join(
+        Tag, on=TagImplication.tag).switch(TagImplication).join(
+            implied, on=TagImplication.implied).order_by(Tag.name, implied.name).objects())
+    return [(row.name, row.implied_name) for row in query]
+
+
+@timed
+def add_tag_alias(alias: str, tagname: str):
+    """Makes `alias` an alternative name for `tagname`.
+
+    If `alias` is already in use as a tag, its files are re-tagged with `tagname` (and its
+    implications), its rules are moved over, and the old tag is deleted.
+    """
+    tagname = resolve_tagname(tagname)
+    if alias == tagname:
+        raise ValueError(f'Cannot alias {alias} to itself')
+
+    with db.atomic():
+        tag, _ = Tag.get_or_create(name=tagname)
+        # Point any aliases of the alias straight at the new target
+        TagAlias.update(tag=tag).where(
+            TagAlias.tag.in_(Tag.select(Tag.id).where(Tag.name == alias))).execute()
+        TagAlias.insert(alias=alias, tag=tag).on_conflict_replace().execute()
+
+        added: FileTagPairs = []
+        removed: FileTagPairs = []
+        old_tag = Tag.get_or_none(name=alias)
+        if old_tag:
+            removed = list(
+                FileTag.select(FileTag.fil, FileTag.tag).where(FileTag.tag == old_tag).tuples())
+            added = _insert_filetags([(file_id, tag.id) for file_id, _ in removed])
+            # Move the old tag's rules over (skipping any that would become self-implications)
+            db.execute_sql(
+                'INSERT OR IGNORE INTO tagimplication (tag_id, implied_id) '
+                'SELECT ?, implied_id FROM tagimplication WHERE tag_id = ? AND implied_id != ? '
+                'UNION SELECT tag_id, ? FROM tagimplication WHERE implied_id = ? AND tag_id != ?',
+                (tag.id, old_tag.id, tag.id, tag.id, old_tag.id, tag.id))
+            for model in _filetag_models():
+                model.delete().where(model.tag == old_tag).execute()
+            TagImplication.delete().where((TagImplication.tag == old_tag)
+                                          | (TagImplication.implied == old_tag)).execute()
+            old_tag.delete_instance()
+            _rebuild_closure()
+            added.extend(_apply_implications([tag.id]))
+    clear_caches()
+    _notify_filetags(added, removed)
+    logger.info(f'Aliased {alias} to {tagname}')
+
+
+@timed
+def remove_tag_alias(alias: str) -> int:
+    return TagAlias.delete().where(TagAlias.alias == alias).execute()
+
+
+@timed
+def add_tag_implication(tagname: str, implied_tagname: str):
+    """Adds a rule that `tagname` implies `implied_tagname`.
+
+    The closure is updated incrementally, and all files tagged with `tagname` (or anything that
+    implies it) are re-tagged in a single batched statement.
+    """
+    tagname, implied_tagname = resolve_tagnames([tagname, implied_tagname])
+    if tagname == implied_tagname:
+        raise ValueError(f'{tagname} cannot imply itself')
+
+    with db.atomic():
+        tag, _ = Tag.get_or_create(name=tagname)
+        implied, _ = Tag.get_or_create(name=implied_tagname)
+        if TagClosure.get_or_none(tag=implied, implied=tag):
+            raise ValueError(f'{implied_tagname} already implies {tagname}')
+        TagImplication.insert(tag=tag, implied=implied).on_conflict_ignore().execute()
+
+        # Everything implying the tag now also implies everything the implied tag implies
+        ancestors = [tag.id] + [
+            row.tag_id
+            for row in TagClosure.select(TagClosure.tag).where(TagClosure.implied == tag)
+        ]
+        descendants = [implied.id] + list(_implied_tags([implied.id]))
+        for rows in chunks([{
+                'tag': ancestor,
+                'implied': descendant
+        } for ancestor in ancestors for descendant in descendants]):
+            TagClosure.insert_many(rows).on_conflict_ignore().execute()
+        added = _apply_implications(ancestors)
+    clear_caches()
+    _notify_filetags(added=added)
+    logger.info(f'Added implication {tagname} -> {implied_tagname}')
+
+
+@timed
+def remove_tag_implication(tagname: str, implied_tagname: str) -> int:
+    """Removes the given implication rule.
+
+    Tags already applied by the rule are left in place.
+    """
+    tagname, implied_tagname = resolve_tagnames([tagname, implied_tagname])
+    tag = Tag.get_or_none(name=tagname)
+    implied = Tag.get_or_none(name=implied_tagname)
+    with db.atomic():
+        n_rows = TagImplication.delete().where((TagImplication.tag == tag)
+                                               & (TagImplication.implied == implied)).execute()
+        if n_rows:
+            _rebuild_closure()
+    logger.info(f'Removed implication {tagname} -> {implied_tagname}')
+    return n_rows
+
+
+def _implied_tags(tag_ids: List[int]) -> Dict[int, str]:
+    """Returns the IDs and names of all tags transitively implied by the given tags."""
+    if not tag_ids:
+        return {}
+    query = (Tag.select(Tag.id, Tag.name).join(TagClosure, on=TagClosure.implied).where(
+        TagClosure.tag.in_(tag_ids)).distinct())
+    return {tag.id: tag.name for tag in query}
+
+
+def _apply_implications(tag_ids: List[int]) -> FileTagPairs:
+    """Adds the implied tags to every file tagged with any of the given tags, and returns the
+    pairs added.
+    """
+    missing = db.execute_sql(
+        'SELECT DISTINCT filetag.fil_id, tagclosure.implied_id FROM filetag '
+        'JOIN tagclosure ON tagclosure.tag_id = filetag.tag_id '
+        f'WHERE filetag.tag_id IN ({", ".join("?" * len(tag_ids))}) AND NOT EXISTS ('
+        '    SELECT 1 FROM filetag AS existing '
+        '    WHERE existing.fil_id = filetag.fil_id AND existing.tag_id = tagclosure.implied_id)',
+        tag_ids).fetchall()
+    return _insert_filetags([(file_id, tag_id) for file_id, tag_id in missing])
+
+
+def _rebuild_closure():
+    """Recomputes the whole closure table from the implication rules."""
+    edges: Dict[int, Set[int]] = {}
+    for rule in TagImplication.select(TagImplication.tag, TagImplication.implied):
+        edges.setdefault(rule.tag_id, set()).add(rule.implied_id)
+
+    rows = []
+    for tag_id in edges:
+        seen: Set[int] = set()
+        stack = list(edges[tag_id])
+        while stack:
+            implied_id = stack.pop()
+            if implied_id not in seen and implied_id != tag_id:
+                seen.add(implied_id)
+                stack.extend(edges.get(implied_id, ()))
+        rows.extend({'tag': tag_id, 'implied': implied_id} for implied_id in seen)
+
+    TagClosure.delete().execute()
+    for chunk in chunks(rows):
+        TagClosure.insert_many(chunk).execute()
 
 
 # -- Misc
 
+# Candidates considered, and minimum trigram similarity required, for fuzzy tag matches
+FUZZY_CANDIDATES = 200
+FUZZY_THRESHOLD = 0.3
+# Trigrams shared by more tags than this are too common to find fuzzy match candidates with
+FUZZY_MAX_DOC_FREQ = 2000
+
 
-@cache.cache('count_files_with_tag', duration=3600)
+@timed
+@cached('count_files_with_tag', duration=3600)
 def count_files_with_tag(tagname: str) -> int:
     tag = Tag.get_or_none(name=tagname)
     return FileTag.select().where(FileTag.tag == tag).count() if tag else 0
+
+
+def chunks(items: Iterable, size: int = INSERT_CHUNK_SIZE) -> Iterator[list]:
+    """Splits the items into lists of at most `size`, e.g. to keep queries under SQLite's bound
+    variable limit.
+    """
+    iterator = iter(items)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _substring_rank(term: str, name: str) -> Tuple[bool, int, str]:
+    return (not name.startswith(term), len(name), name)
+
+
+def _fts_phrase(text: str) -> str:
+    return '"' + text.replace('"', '""') + '"'
+
+
+def _selective_trigrams(term: str) -> List[str]:
+    """Returns the trigrams of the term that occur in the index, excluding very common ones.
+
+    Matching on common trigrams (e.g. a shared `tag_` prefix) would touch most of the vocabulary,
+    so those are dropped as long as at least one rarer trigram remains.
+    """
+    trigrams = sorted(_trigrams(term))
+    placeholders = ', '.join('?' * len(trigrams))
+    doc_freqs = sorted((doc, trigram) for trigram, doc in db.execute_sql(
+        f'SELECT term, doc FROM {TAG_INDEX_TABLE}_vocab WHERE term IN ({placeholders})', trigrams))
+    selective = [trigram for doc, trigram in doc_freqs if doc <= FUZZY_MAX_DOC_FREQ]
+    return selective or [trigram for _, trigram in doc_freqs[:1]]
+
+
+def _trigrams(text: str) -> Set[str]:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def _similarity(a: Set[str], b: Set[str]) -> float:
+    """Jaccard similarity of two trigram sets."""
+    return len(a & b) / len(a | b) if a or b else 0.0
+
+
+def _insert_filetags(pairs: FileTagPairs) -> FileTagPairs:
+    """Inserts the given (file ID, tag ID) pairs, and returns those that didn't already exist."""
+    added: FileTagPairs = []
+    for model, file_ids in _group_by_filetag_model({file_id for file_id, _ in pairs}).items():
+        file_ids_set = set(file_ids)
+        pairs_set = {pair for pair in pairs if pair[0] in file_ids_set}
+        for chunk in chunks(sorted(file_ids)):
+            pairs_set.difference_update(
+                model.select(model.fil, model.tag).where(model.fil.in_(chunk)).tuples())
+        for chunk in chunks([{'fil': file_id, 'tag': tag_id} for file_id, tag_id in pairs_set]):
+            model.insert_many(chunk).on_conflict_ignore().execute()
+        added.extend(pairs_set)
+    return sorted(added)
+
+
+def _filetag_model(file_id: int) -> Any:
+    """Returns the model of the `filetag` table holding the file's tags.
+
+    When sharded, that is the file's shard, so that writing to it only locks that shard (writing
+    through the view would lock all of them).
+    """
+    return next(iter(_group_by_filetag_model([file_id])))
+
+
+def _count_file_tags(fil: File) -> int:
+    # Counted in the file's own shard, as joining the view over all shards would scan every one
+    model = _shard_models.get(fil.shard) if _shard_models else FileTag
+    return model.select().where(model.fil == fil.id).count() if model else 0
+
+
+def _filetag_models() -> List[Any]:
+    return list(_shard_models.values()) or [FileTag]
+
+
+def _group_by_filetag_model(file_ids: Iterable[int]) -> Dict[Any, List[int]]:
+    if not _shard_models:
+        return {FileTag: list(file_ids)}
+    groups: Dict[Any, List[int]] = collections.defaultdict(list)
+    for file_id, name in _file_shards(file_ids).items():
+        groups[_shard_models[name]].append(file_id)
+    return groups
+
+
+def _file_shards(file_ids: Iterable[int]) -> Dict[int, str]:
+    """Returns the shard of each file, first assigning shards to those without one."""
+    shards = get_shards()
+    assert shards
+    result: Dict[int, str] = {}
+    assigned: Dict[str, List[int]] = collections.defaultdict(list)
+    for chunk in chunks(sorted(set(file_ids))):
+        query = File.select(File.id, File.name, File.path, File.mtime,
+                            File.shard).where(File.id.in_(chunk))
+        for file_id, name, path, mtime, shard in query.tuples():
+            if shard not in shards.schemas:
+                shard = shards.shard_of(name, path, mtime)
+                assigned[shard].append(file_id)
+            result[file_id] = shard
+    for shard, ids in assigned.items():
+        for chunk in chunks(ids):
+            File.update(shard=shard).where(File.id.in_(chunk)).execute()
+    return result
@@ -0,0 +1,151 @@
+"""Decides how images are decoded, keeping memory use bounded however large or animated they are.
+
+- Images above `DECODE_MAX_PIXELS` are decoded downscaled (which for JPEGs skips decoding at full
+  resolution altogether), and thumbnails are decoded straight to thumbnail size. Formats that can't
+  decode scaled (e.g. PNG and GIF) are decoded at full size first, which is accounted for
+- Only the first frame of an animation is ever decoded here (viewers stream the rest, see
+  `ImageView`)
+- All decodes share a global budget of decoded bytes: a decode that would go over it waits until
+  others have finished, and one that wouldn't fit in the whole budget waits to run alone
+"""
+
+import math
+import threading
+from typing import NamedTuple, Optional
+
+from PySide2.QtCore import QSize, Qt
+from PySide2.QtGui import QImage, QImageIOHandler, QImageReader
+
+from . import diagnostics
+from .logger import get_logger
+from .settings import DECODE_BUDGET_MB, DECODE_MAX_PIXELS
+
+logger = get_logger(__name__)
+
+# Decoded images are (at most) 32 bits per pixel
+BYTES_PER_PIXEL = 4
+
+
+class DecodePlan(NamedTuple):
+    """How an image will be decoded."""
+    # Original dimensions (invalid if unreadable)
+    size: QSize
+    # Dimensions to decode to
+    scaled_size: QSize
+    # Whether the reader decodes at the original size before scaling (it can't decode scaled)
+    full_decode: bool = False
+
+    @property
+    def nbytes(self) -> int:
+        """The peak number of bytes decoded, including the full image if decoded first."""
+        nbytes = _nbytes(self.scaled_size)
+        if self.full_decode:
+            nbytes += _nbytes(self.size)
+        return nbytes
+
+
+class DecodeBudget(object):
+    """A count of decoded bytes in flight, shared by all decoding threads."""
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._reserved = 0
+        self._cond = threading.Condition()
+
+    @property
+    def reserved(self) -> int:
+        with self._cond:
+            return self._reserved
+
+    def reserve(self, nbytes: int, wait: bool = True):
+        """Reserves the given number of bytes, first waiting (if `wait`) until they fit.
+
+        A reservation larger than the whole budget only waits until nothing else is reserved, and
+        one that doesn't wait (e.g. on the GUI thread) may go over the budget.
+        """
+        with self._cond:
+            if wait:
+                self._cond.wait_for(
+                    lambda: self._reserved == 0 or self._reserved + nbytes <= self.max_bytes)
+            self._reserved += nbytes
+            diagnostics.set_gauge('decoding.reserved_bytes', self._reserved)
+
+    def release(self, nbytes: int):
+        with self._cond:
+            self._reserved -= nbytes
+            diagnostics.set_gauge('decoding.reserved_bytes', self._reserved)
+            self._cond.notify_all()
+
+
+_budget = DecodeBudget(DECODE_BUDGET_MB * 1024 * 1024)
+
+# -- Public
+
+
+def get_budget() -> DecodeBudget:
+    return _budget
+
+
+def plan_decode(reader: QImageReader, max_height: Optional[int] = None) -> DecodePlan:
+    """Returns how to decode the image, from its header alone.
+
+    The image is downscaled to fit `max_height` (if given) and `DECODE_MAX_PIXELS`.
+    """
+    size = reader.size()
+    if not size.isValid():
+        return DecodePlan(size, size)
+    scale = 1.0
+    if max_height and size.height() > max_height:
+        scale = max_height / size.height()
+    n_pixels = size.width() * size.height() * scale * scale
+    if n_pixels > DECODE_MAX_PIXELS:
+        scale *= math.sqrt(DECODE_MAX_PIXELS / n_pixels)
+    scaled_size = size
+    if scale < 1:
+        scaled_size = size.scaled(max(int(size.width() * scale), 1),
+                                  max(int(size.height() * scale), 1), Qt.KeepAspectRatio)
+    # Otherwise `QImageReader` decodes the whole image and then scales it
+    full_decode = scaled_size != size and not reader.supportsOption(QImageIOHandler.ScaledSize)
+    return DecodePlan(size, scaled_size, full_decode)
+
+
+def is_animated(filepath: str) -> bool:
+    """Whether the image has more than one frame (or an unknown number)."""
+    reader = QImageReader(filepath)
+    return reader.supportsAnimation() and reader.imageCount() != 1
+
+
+def decode_image(filepath: str, max_height: Optional[int] = None, wait: bool = True) -> QImage:
+    """Decodes the (first frame of the) image within the budget, downscaled as needed (see
+    `plan_decode`). Returns a null image if it can't be read.
+
+    Pass `wait=False` on the GUI thread, where blocking on other decodes would freeze the UI.
+    """
+    reader = QImageReader(filepath)
+    plan = plan_decode(reader, max_height)
+    if not plan.size.isValid():
+        logger.warning(f'Failed to read {filepath} ({reader.errorString()})')
+        return QImage()
+    if plan.nbytes > _budget.max_bytes:
+        logger.info(f'Decoding {filepath} ({plan.size.width()}x{plan.size.height()}) alone: '
+                    f'needs {plan.nbytes // 2**20} MB, more than the decoding budget')
+
+    if plan.scaled_size != plan.size:
+        reader.setScaledSize(plan.scaled_size)
+        if not max_height:
+            logger.debug(f'Decoding {filepath} downscaled from {plan.size.width()}x'
+                         f'{plan.size.height()} to {plan.scaled_size.width()}x'
+                         f'{plan.scaled_size.height()}')
+
+    _budget.reserve(plan.nbytes, wait)
+    try:
+        # NOTE: Reads the first frame only
+        return reader.read()
+    finally:
+        _budget.release(plan.nbytes)
+
+
+# -- Helpers
+
+
+def _nbytes(size: QSize) -> int:
+    return size.width() * size.height() * BYTES_PER_PIXEL
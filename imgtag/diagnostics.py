@@ -0,0 +1,262 @@
+"""Provides lightweight runtime instrumentation for hot paths.
+
+Collects function latency histograms, SQL query counts per UI action, cache hit rates and gauges
+(e.g. thread pool queue depth). Everything is kept in memory and is cheap enough to leave on
+permanently; use `report()` or `dump()` to inspect it.
+"""
+
+import bisect
+import functools
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List
+
+from .logger import get_logger
+
+logger = get_logger(__name__)
+
+# Upper bounds (in milliseconds) of the latency histogram buckets; the last bucket is unbounded
+BUCKET_BOUNDS_MS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500]
+
+_lock = threading.Lock()
+# Per-thread stack of UI actions currently in progress
+_local = threading.local()
+
+
+class LatencyHistogram(object):
+    """A fixed-bucket latency histogram."""
+    def __init__(self):
+        self.counts = [0] * (len(BUCKET_BOUNDS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def record(self, ms: float):
+        self.counts[bisect.bisect_left(BUCKET_BOUNDS_MS, ms)] += 1
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    @property
+    def mean_ms(self) -> float:
+        return self.total_ms / self.count if self.count else 0.0
+
+    def percentile_ms(self, pct: float) -> float:
+        """Returns the upper bound of the bucket containing the given percentile."""
+        threshold = self.count * pct / 100
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= threshold:
+                return BUCKET_BOUNDS_MS[i] if i < len(BUCKET_BOUNDS_MS) else self.max_ms
+        return 0.0
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            'count': self.count,
+            'mean_ms': self.mean_ms,
+            'p50_ms': self.percentile_ms(50),
+            'p95_ms': self.percentile_ms(95),
+            'max_ms': self.max_ms,
+            'buckets': {
+                f'<={bound}': count
+                for bound, count in zip(BUCKET_BOUNDS_MS + ['inf'], self.counts) if count
+            },
+        }
+
+
+class ActionStats(object):
+    """SQL query counts for a single kind of UI action."""
+    def __init__(self):
+        self.count = 0
+        self.total_queries = 0
+        self.max_queries = 0
+        self.last_queries = 0
+        self.latency = LatencyHistogram()
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            'count': self.count,
+            'mean_queries': self.total_queries / self.count if self.count else 0,
+            'max_queries': self.max_queries,
+            'last_queries': self.last_queries,
+            'latency': self.latency.as_dict(),
+        }
+
+
+class CacheStats(object):
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hit_rate}
+
+
+class Gauge(object):
+    def __init__(self):
+        self.value = 0
+        self.max_value = 0
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {'value': self.value, 'max': self.max_value}
+
+
+_latencies: Dict[str, LatencyHistogram] = defaultdict(LatencyHistogram)
+_actions: Dict[str, ActionStats] = defaultdict(ActionStats)
+_caches: Dict[str, CacheStats] = defaultdict(CacheStats)
+_gauges: Dict[str, Gauge] = defaultdict(Gauge)
+_query_count = 0
+
+# -- Recording
+
+
+def timed(func: Callable) -> Callable:
+    """Decorator that records the latency of every call to the given function."""
+    name = func.__qualname__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            ms = (time.perf_counter() - start) * 1000
+            with _lock:
+                _latencies[name].record(ms)
+
+    return wrapper
+
+
+@contextmanager
+def action(name: str) -> Iterator[None]:
+    """Context manager that attributes all SQL queries issued on this thread to a UI action."""
+    stack = _action_stack()
+    stack.append([name, 0])
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        ms = (time.perf_counter() - start) * 1000
+        _, n_queries = stack.pop()
+        with _lock:
+            stats = _actions[name]
+            stats.count += 1
+            stats.total_queries += n_queries
+            stats.max_queries = max(stats.max_queries, n_queries)
+            stats.last_queries = n_queries
+            stats.latency.record(ms)
+        if stack:
+            # Nested actions also count towards the enclosing one
+            stack[-1][1] += n_queries
+
+
+def record_query(sql: str):
+    """Counts an executed SQL statement towards the current UI action, if any."""
+    global _query_count
+    with _lock:
+        _query_count += 1
+    stack = _action_stack()
+    if stack:
+        stack[-1][1] += 1
+
+
+def record_cache(namespace: str, hit: bool):
+    with _lock:
+        stats = _caches[namespace]
+        if hit:
+            stats.hits += 1
+        else:
+            stats.misses += 1
+
+
+def set_gauge(name: str, value: int):
+    with _lock:
+        gauge = _gauges[name]
+        gauge.value = value
+        gauge.max_value = max(gauge.max_value, value)
+
+
+# -- Reporting
+
+
+def snapshot() -> Dict[str, Any]:
+    """Returns all collected statistics as a JSON-serializable dict."""
+    with _lock:
+        return {
+            'queries': _query_count,
+            'latencies': {name: hist.as_dict()
+                          for name, hist in sorted(_latencies.items())},
+            'actions': {name: stats.as_dict()
+                        for name, stats in sorted(_actions.items())},
+            'caches': {name: stats.as_dict()
+                       for name, stats in sorted(_caches.items())},
+            'gauges': {name: gauge.as_dict()
+                       for name, gauge in sorted(_gauges.items())},
+        }
+
+
+def report() -> str:
+    """Returns a human-readable summary of all collected statistics."""
+    snap = snapshot()
+    lines: List[str] = [f'Total SQL queries: {snap["queries"]}', '']
+
+    lines.append(f'{"Function".ljust(32)} {"Calls":>8} {"Mean ms":>9} {"p95 ms":>9} '
+                 f'{"Max ms":>9}')
+    for name, hist in snap['latencies'].items():
+        lines.append(f'{name.ljust(32)} {hist["count"]:>8} {hist["mean_ms"]:>9.2f} '
+                     f'{hist["p95_ms"]:>9.2f} {hist["max_ms"]:>9.2f}')
+    lines.append('')
+
+    lines.append(f'{"UI action".ljust(32)} {"Count".rjust(8)} {"Queries":>9} {"Max q.":>9} '
+                 f'{"Mean ms":>9}')
+    for name, stats in snap['actions'].items():
+        lines.append(f'{name.ljust(32)} {stats["count"]:>8} {stats["mean_queries"]:>9.1f} '
+                     f'{stats["max_queries"]:>9} {stats["latency"]["mean_ms"]:>9.2f}')
+    lines.append('')
+
+    lines.append(f'{"Cache".ljust(32)} {"Hits":>8} {"Misses":>9} {"Hit rate":>9}')
+    for name, stats in snap['caches'].items():
+        lines.append(f'{name.ljust(32)} {stats["hits"]:>8} {stats["misses"]:>9} '
+                     f'{stats["hit_rate"]:>9.1%}')
+    lines.append('')
+
+    lines.append(f'{"Gauge".ljust(32)} {"Value":>8} {"Max":>9}')
+    for name, gauge in snap['gauges'].items():
+        lines.append(f'{name.ljust(32)} {gauge["value"]:>8} {gauge["max"]:>9}')
+
+    return '\n'.join(lines)
+
+
+def dump(filepath: str):
+    """Writes all collected statistics to the given file as JSON."""
+    with open(filepath, 'w') as f:
+        json.dump(snapshot(), f, indent=2)
+    logger.info(f'Dumped diagnostics to {filepath}')
+
+
+def reset():
+    global _query_count
+    with _lock:
+        _latencies.clear()
+        _actions.clear()
+        _caches.clear()
+        _gauges.clear()
+        _query_count = 0
+
+
+# -- Helpers
+
+
+def _action_stack() -> List[list]:
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
@@ -1,9 +1,20 @@
 """Provides the top-level window widget."""
 
-from PySide2.QtWidgets import QAction, QApplication, QMainWindow, QTabWidget
+import threading
 
+from PySide2.QtCore import QTimer
+from PySide2.QtGui import QKeySequence
+from PySide2.QtWidgets import (QAction, QApplication, QFileDialog, QMainWindow, QMessageBox,
+                               QTabWidget)
+
+from . import diagnostics
+from .backup import take_snapshot
+from .settings import (BACKUP_COMPACT, BACKUP_EXPORT_TAGS, BACKUP_INTERVAL_MINUTES, BACKUP_KEEP,
+                       BACKUP_SNAPSHOT_DIR)
+from .shards import get_shards
 from .state import GlobalState
 from .tabs import FileTab, GalleryTab
+from .widgets import DiagnosticsView, StatsView
 
 
 class MainWindow(QMainWindow):
@@ -14,14 +25,59 @@ class MainWindow(QMainWindow):
         super().__init__()
 
         self.global_state = GlobalState()
+        # Make sure queued tag edits are written before exiting
+        QApplication.instance().aboutToQuit.connect(self.global_state.write_queue.close)
 
         self.setWindowTitle(self.title)
         self._make_menubar()
         self.setCentralWidget(self._central_widget())
 
+        signals = self.global_state.tag_edit_signals
+        signals.edited.connect(self._update_edit_actions)
+        # Failed edits are dropped from the journal
+        signals.written.connect(self._update_edit_actions)
+        signals.failed.connect(self._show_write_error)
+        self._update_edit_actions()
+
+        # Periodic database snapshots
+        self._snapshot_timer = QTimer(self)
+        self._snapshot_timer.timeout.connect(self._take_snapshot)
+        if BACKUP_KEEP > 0 and BACKUP_INTERVAL_MINUTES > 0:
+            self._snapshot_timer.start(int(BACKUP_INTERVAL_MINUTES * 60 * 1000))
+
     def _make_menubar(self):
         menubar = self.menuBar()
 
+        edit_menu = menubar.addMenu('&Edit')
+
+        self._undo_action = QAction('&Undo tag edit', self)
+        self._undo_action.setShortcut(QKeySequence.Undo)
+        self._undo_action.triggered.connect(self.global_state.write_queue.undo)
+        edit_menu.addAction(self._undo_action)
+
+        self._redo_action = QAction('&Redo tag edit', self)
+        self._redo_action.setShortcut(QKeySequence.Redo)
+        self._redo_action.triggered.connect(self.global_state.write_queue.redo)
+        edit_menu.addAction(self._redo_action)
+
+        diagnostics_menu = menubar.addMenu('&Diagnostics')
+
+        stats_action = QAction('&Library statistics', self)
+        stats_action.triggered.connect(self._show_stats)
+        diagnostics_menu.addAction(stats_action)
+
+        show_action = QAction('&Show statistics', self)
+        show_action.triggered.connect(self._show_diagnostics)
+        diagnostics_menu.addAction(show_action)
+
+        dump_action = QAction('&Dump to file...', self)
+        dump_action.triggered.connect(self._dump_diagnostics)
+        diagnostics_menu.addAction(dump_action)
+
+        reset_action = QAction('&Reset statistics', self)
+        reset_action.triggered.connect(diagnostics.reset)
+        diagnostics_menu.addAction(reset_action)
+
         quit_action = QAction('&Quit', self)
         quit_action.setShortcut('Ctrl+Q')
         quit_action.triggered.connect(QApplication.quit)
@@ -37,3 +93,35 @@ class MainWindow(QMainWindow):
         tabs.addTab(self._gallery_tab, self._gallery_tab.title)
 
         return tabs
+
+    # -- Callbacks
+
+    def _update_edit_actions(self, _filenames=[]):
+        self._undo_action.setEnabled(self.global_state.write_queue.can_undo)
+        self._redo_action.setEnabled(self.global_state.write_queue.can_redo)
+
+    def _show_write_error(self, message: str):
+        QMessageBox.warning(self, 'Tag edits not saved', message)
+
+    def _take_snapshot(self):
+        # In the background, since copying a large database takes a while
+        threading.Thread(target=take_snapshot,
+                         args=(BACKUP_SNAPSHOT_DIR, BACKUP_KEEP, BACKUP_COMPACT,
+                               BACKUP_EXPORT_TAGS),
+                         kwargs={
+                             'shards': get_shards()
+                         },
+                         name='snapshot',
+                         daemon=True).start()
+
+    def _show_stats(self):
+        StatsView(self).exec_()
+
+    def _show_diagnostics(self):
+        DiagnosticsView(self).exec_()
+
+    def _dump_diagnostics(self):
+        filepath, _ = QFileDialog.getSaveFileName(self, 'Dump diagnostics', 'diagnostics.json',
+                                                  'JSON (*.json)')
+        if filepath:
+            diagnostics.dump(filepath)
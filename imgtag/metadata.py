@@ -0,0 +1,141 @@
+"""Extracts image attributes (dimensions, size, modification time, format) from file headers.
+
+Only the first few bytes of each image are read (there is no decoding), in a pool of worker
+processes, and only for files whose size or modification time has changed since the last refresh.
+"""
+
+import itertools
+import multiprocessing
+import os
+import struct
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, BinaryIO, Dict, List, Optional, Tuple
+
+from .data import chunks, get_file_stats, set_file_attributes
+from .diagnostics import timed
+from .logger import get_logger
+from .utils import is_image_file
+
+logger = get_logger(__name__)
+
+# Files per task sent to a worker process
+TASK_CHUNK_SIZE = 64
+# Files per database write
+WRITE_CHUNK_SIZE = 1000
+# Give up looking for the frame header in JPEGs after this many bytes
+JPEG_MAX_SCAN = 1 << 20
+
+# (format, width, height)
+Header = Tuple[str, int, int]
+
+# JPEG start-of-frame markers (the others in 0xc0-0xcf are DHT, JPG and DAC)
+_JPEG_SOF_MARKERS = set(range(0xc0, 0xd0)) - {0xc4, 0xc8, 0xcc}
+# JPEG markers without a length field
+_JPEG_STANDALONE_MARKERS = set(range(0xd0, 0xda)) | {0x01}
+
+
+@timed
+def refresh_metadata(root_dirs: List[str], max_workers: Optional[int] = None) -> int:
+    """Extracts and stores attributes for all new or changed images under the root directories,
+    returning the number of files updated.
+    """
+    known = get_file_stats()
+    changed = []
+    seen = set()
+    walks = itertools.chain.from_iterable(os.walk(root_dir) for root_dir in root_dirs)
+    for dirpath, _dirnames, filenames in walks:
+        for filename in filenames:
+            # Files are identified by name, so only the first of any duplicates counts
+            if not is_image_file(filename) or filename in seen:
+                continue
+            seen.add(filename)
+            filepath = os.path.join(dirpath, filename)
+            try:
+                stat = os.stat(filepath)
+            except OSError:
+                continue
+            if known.get(filename) != (stat.st_size, stat.st_mtime):
+                changed.append(filepath)
+    logger.info(f'Found {len(changed)} new or changed image(s) out of {len(seen)}')
+    if not changed:
+        return 0
+
+    # NOTE: Spawn rather than fork, since this may be called from a thread of the GUI process
+    with ProcessPoolExecutor(max_workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        rows = pool.map(read_attributes, changed, chunksize=TASK_CHUNK_SIZE)
+        for chunk in chunks(filter(None, rows), WRITE_CHUNK_SIZE):
+            set_file_attributes(chunk)
+    logger.info(f'Refreshed attributes of {len(changed)} image(s)')
+    return len(changed)
+
+
+def read_attributes(filepath: str) -> Optional[Dict[str, Any]]:
+    """Returns the attributes of an image file as a row for `data.set_file_attributes`, or None if
+    it can't be read.
+    """
+    try:
+        stat = os.stat(filepath)
+        with open(filepath, 'rb') as f:
+            header = read_header(f)
+    except OSError as e:
+        logger.warning(f'Failed to read {filepath} ({e})')
+        return None
+    image_format, width, height = header or (None, None, None)
+    return {
+        'name': os.path.split(filepath)[-1],
+        'path': filepath,
+        'width': width,
+        'height': height,
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'format': image_format,
+    }
+
+
+def read_header(f: BinaryIO) -> Optional[Header]:
+    """Returns the format and dimensions of a PNG, GIF or JPEG image, or None if unrecognized."""
+    head = f.read(32)
+    if head.startswith(b'\x89PNG\r\n\x1a\n') and head[12:16] == b'IHDR':
+        width, height = struct.unpack('>II', head[16:24])
+        return 'png', width, height
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        width, height = struct.unpack('<HH', head[6:10])
+        return 'gif', width, height
+    if head.startswith(b'\xff\xd8'):
+        f.seek(2)
+        size = _jpeg_size(f)
+        return ('jpeg', *size) if size else None
+    return None
+
+
+# -- Helpers
+
+
+def _jpeg_size(f: BinaryIO) -> Optional[Tuple[int, int]]:
+    """Scans JPEG segments up to the first start-of-frame, returning its (width, height)."""
+    while f.tell() < JPEG_MAX_SCAN:
+        byte = f.read(1)
+        if not byte:
+            return None
+        if byte != b'\xff':
+            continue
+        marker = f.read(1)
+        # Skip fill bytes
+        while marker == b'\xff':
+            marker = f.read(1)
+        if not marker:
+            return None
+        if marker[0] in _JPEG_STANDALONE_MARKERS or marker[0] == 0:
+            continue
+        length_bytes = f.read(2)
+        if len(length_bytes) < 2:
+            return None
+        (length, ) = struct.unpack('>H', length_bytes)
+        if marker[0] in _JPEG_SOF_MARKERS:
+            frame = f.read(5)
+            if len(frame) < 5:
+                return None
+            _precision, height, width = struct.unpack('>BHH', frame)
+            return width, height
+        f.seek(length - 2, os.SEEK_CUR)
+    return None
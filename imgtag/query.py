@@ -0,0 +1,110 @@
+"""Parses and runs gallery search queries.
+
+Query syntax (whitespace-separated terms):
+
+- `tag`: files must have the tag
+- `-tag`: files must not have the tag
+- `~term`: files must have at least one tag fuzzily matching the term (see `search_tags`)
+- `tag1|tag2|...`: files must have at least one of the tags
+- `attribute:value`, `attribute:>value`, etc.: files' attribute must compare as given, where the
+  attribute is one of `data.FILE_ATTRIBUTES` and the operator one of `data.FILTER_OPS` (default
+  `=`); sizes may have a K/M/G suffix and modification times may be dates (`2020-05-16`)
+- `sort:attribute` (or `sort:-attribute` for descending): sorts by the attribute instead of name
+"""
+
+import datetime
+import re
+import time
+from typing import Any, List, NamedTuple, Optional
+
+from .accel import get_index
+from .data import (FILE_ATTRIBUTES, FILTER_OPS, FileFilter, get_files_with_tags, resolve_tagnames,
+                   search_tags)
+from .logger import get_logger
+
+logger = get_logger(__name__)
+
+# Maximum number of tags a single fuzzy term expands to
+FUZZY_EXPANSION_LIMIT = 50
+
+# Longest operators first so that e.g. `>=` isn't parsed as `>`
+ATTRIBUTE_TERM_PATTERN = re.compile(r'^(?P<attribute>{}):(?P<op>{})?(?P<value>.+)$'.format(
+    '|'.join(FILE_ATTRIBUTES + ['sort']),
+    '|'.join(re.escape(op) for op in sorted(FILTER_OPS, key=len, reverse=True))))
+
+SIZE_SUFFIXES = {'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30}
+
+
+class Query(NamedTuple):
+    tagnames: List[str]
+    excluded_tagnames: List[str]
+    alternative_tagnames: List[List[str]]
+    fuzzy_terms: List[str]
+    filters: List[FileFilter]
+    sort: Optional[str]
+    descending: bool
+
+
+def parse_query(text: str) -> Query:
+    terms = text.strip().lower().split()
+    matches = [ATTRIBUTE_TERM_PATTERN.match(t) for t in terms]
+    attribute_terms = [match.groupdict() for match in matches if match]
+    terms = [t for t, match in zip(terms, matches) if not match]
+
+    filters = []
+    sort, descending = None, False
+    for term in attribute_terms:
+        attribute, op, value = term['attribute'], term['op'] or '=', term['value']
+        if attribute == 'sort':
+            descending = value.startswith('-')
+            sort = value.lstrip('-')
+            if sort not in FILE_ATTRIBUTES:
+                logger.warning(f'Cannot sort by {sort}')
+                sort, descending = None, False
+            continue
+        try:
+            filters.append((attribute, op, _parse_value(attribute, value)))
+        except ValueError:
+            logger.warning(f'Ignoring invalid value {value} for {attribute}')
+
+    return Query(
+        tagnames=[t for t in terms if not t.startswith(('-', '~')) and '|' not in t],
+        excluded_tagnames=[t[1:] for t in terms if t.startswith('-') and len(t) > 1],
+        alternative_tagnames=[[name for name in t.split('|') if name] for t in terms
+                              if '|' in t and not t.startswith(('-', '~'))],
+        fuzzy_terms=[t[1:] for t in terms if t.startswith('~') and len(t) > 1],
+        filters=filters,
+        sort=sort,
+        descending=descending,
+    )
+
+
+def search_files(text: str) -> List[str]:
+    """Returns the sorted filenames matching the given query text."""
+    query = parse_query(text)
+    alternatives = ([resolve_tagnames(group) for group in query.alternative_tagnames] +
+                    [search_tags(term, limit=FUZZY_EXPANSION_LIMIT) for term in query.fuzzy_terms])
+    tagnames = resolve_tagnames(query.tagnames)
+    excluded_tagnames = resolve_tagnames(query.excluded_tagnames)
+
+    index = get_index()
+    # Attributes aren't in the index
+    if index and not query.filters and not query.sort:
+        return index.search(tagnames, excluded_tagnames, alternatives)
+    return get_files_with_tags(tagnames, excluded_tagnames, alternatives, query.filters,
+                               query.sort, query.descending)
+
+
+def _parse_value(attribute: str, text: str) -> Any:
+    """Converts a filter value to the type of the attribute, raising ValueError if invalid."""
+    if attribute == 'format':
+        return 'jpeg' if text == 'jpg' else text
+    if attribute == 'mtime':
+        try:
+            # Local midnight
+            return time.mktime(datetime.date.fromisoformat(text).timetuple())
+        except ValueError:
+            return float(text)
+    if attribute == 'size' and text[-1:] in SIZE_SUFFIXES:
+        return int(float(text[:-1]) * SIZE_SUFFIXES[text[-1]])
+    return int(text)
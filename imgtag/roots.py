@@ -0,0 +1,223 @@
+"""Indexes the image files under each configured root directory, for resolving file paths.
+
+Each root is scanned by its own thread, listing up to `Root.concurrency` directories in parallel
+(which matters on high-latency network mounts). Lookups try roots in priority order and only
+rescan a root when a file can't be found in any up-to-date index. A file only counts as missing if
+it isn't found in a fresh scan of every root, since it may have been added after the last one.
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, List, Optional, Tuple
+
+from . import diagnostics
+from .diagnostics import timed
+from .logger import get_logger
+from .settings import ROOTS, Root
+from .utils import is_image_file
+
+logger = get_logger(__name__)
+
+# The path index of every root, sorted by priority (see `init_roots`)
+_indexes: Optional[List['RootIndex']] = None
+_indexes_lock = threading.Lock()
+
+
+class RootIndex(object):
+    """Maps the names of all images under a root to their paths."""
+    def __init__(self, root: Root):
+        self.root = root
+        self._lock = threading.Lock()
+        # Held while scanning, so that concurrent lookups wait for one scan rather than start more
+        self._scan_lock = threading.Lock()
+        self._paths: Dict[str, str] = {}
+        self._scanned_at: Optional[float] = None
+
+    # -- Public
+
+    @property
+    def available(self) -> bool:
+        """Whether the root exists, e.g. isn't an unmounted network share."""
+        return os.path.isdir(self.root.path)
+
+    @property
+    def stale(self) -> bool:
+        with self._lock:
+            return (self._scanned_at is None
+                    or time.time() - self._scanned_at > self.root.stale_after)
+
+    def lookup(self, filename: str) -> Optional[str]:
+        """Returns the indexed path of the file, if any (which may no longer exist)."""
+        with self._lock:
+            return self._paths.get(filename)
+
+    def mark_stale(self):
+        with self._lock:
+            self._scanned_at = None
+
+    def scanned_since(self, since: float) -> bool:
+        """Whether a scan started at or after the given time has completed."""
+        with self._lock:
+            return self._scanned_at is not None and self._scanned_at >= since
+
+    def scan(self, if_stale: bool = False):
+        """Rescans the root (unless `if_stale` and it has been scanned recently)."""
+        with self._scan_lock:
+            if if_stale and not self.stale:
+                # Someone else scanned while we waited
+                return
+            started_at = time.time()
+            paths = self._scan()
+            with self._lock:
+                self._paths = paths
+                self._scanned_at = started_at
+        diagnostics.set_gauge(f'roots.{self.root.name}.files', len(paths))
+        diagnostics.set_gauge(f'roots.{self.root.name}.scan_ms',
+                              int((time.time() - started_at) * 1000))
+        logger.info(f'Indexed {len(paths)} image(s) under {self.root.path} '
+                    f'in {time.time() - started_at:.1f}s')
+
+    # -- Helpers
+
+    @timed
+    def _scan(self) -> Dict[str, str]:
+        paths: Dict[str, str] = {}
+        if not self.available:
+            logger.warning(f'Root {self.root.name} ({self.root.path}) is not available')
+            return paths
+        with ThreadPoolExecutor(self.root.concurrency,
+                                thread_name_prefix=f'scan-{self.root.name}') as pool:
+            pending = {pool.submit(_list_dir, self.root.path)}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    dirpaths, filepaths = future.result()
+                    pending |= {pool.submit(_list_dir, dirpath) for dirpath in dirpaths}
+                    for filepath in filepaths:
+                        filename = os.path.basename(filepath)
+                        # Directories are listed in any order, so break ties between duplicate
+                        # filenames deterministically
+                        if filename not in paths or filepath < paths[filename]:
+                            paths[filename] = filepath
+        return paths
+
+
+# -- Public
+
+
+def init_roots(roots: List[Root]) -> List[RootIndex]:
+    """Sets up (empty) path indexes for the given roots, replacing any existing ones."""
+    global _indexes
+    with _indexes_lock:
+        _indexes = _make_indexes(roots)
+        return _indexes
+
+
+def get_root_indexes() -> List[RootIndex]:
+    """Returns the path index of every root, in priority order (the configured roots by
+    default).
+    """
+    global _indexes
+    with _indexes_lock:
+        if _indexes is None:
+            _indexes = _make_indexes(ROOTS)
+        return _indexes
+
+
+def get_roots() -> List[Root]:
+    return [index.root for index in get_root_indexes()]
+
+
+def scan_roots(wait_for: bool = False) -> List[threading.Thread]:
+    """Scans all roots concurrently, one thread per root."""
+    threads = [
+        threading.Thread(target=index.scan, name=f'scan-{index.root.name}', daemon=True)
+        for index in get_root_indexes()
+    ]
+    for thread in threads:
+        thread.start()
+    if wait_for:
+        for thread in threads:
+            thread.join()
+    return threads
+
+
+@timed
+def resolve_filepaths(filenames: List[str]) -> Tuple[Dict[str, str], bool]:
+    """Returns the paths of the files that can be found, searching the roots in priority order.
+
+    Also returns whether the files that weren't found are definitely missing, i.e. whether all
+    roots are available and have just been scanned.
+    """
+    started_at = time.time()
+    indexes = get_root_indexes()
+    filepaths: Dict[str, str] = {}
+    for index in indexes:
+        _lookup(index, [name for name in filenames if name not in filepaths], filepaths)
+
+    # Not in any up-to-date index, so rescan out-of-date roots (at most once for all files)
+    for index in indexes:
+        missing = [name for name in filenames if name not in filepaths]
+        if not missing:
+            break
+        if index.stale:
+            index.scan(if_stale=True)
+            _lookup(index, missing, filepaths)
+    # Roots scanned before this may not have the files yet
+    return filepaths, all(index.available and index.scanned_since(started_at) for index in indexes)
+
+
+def find_filepath(filename: str) -> Optional[str]:
+    """Returns the indexed path of the file in the highest priority root containing it, without
+    rescanning (so it may be outdated, or missing if the roots haven't been scanned yet).
+    """
+    for index in get_root_indexes():
+        filepath = index.lookup(filename)
+        if filepath:
+            return filepath
+    return None
+
+
+def root_of(filepath: str) -> Optional[Root]:
+    """Returns the (highest priority) root containing the given path, if any."""
+    filepath = os.path.abspath(filepath)
+    for index in get_root_indexes():
+        root_path = os.path.abspath(index.root.path)
+        if os.path.commonpath([root_path, filepath]) == root_path:
+            return index.root
+    return None
+
+
+# -- Helpers
+
+
+def _lookup(index: RootIndex, filenames: List[str], filepaths: Dict[str, str]):
+    """Adds the paths of the given files in the index to `filepaths`, if they still exist."""
+    for filename in filenames:
+        filepath = index.lookup(filename)
+        if filepath and os.path.exists(filepath):
+            filepaths[filename] = filepath
+        elif filepath:
+            # The file has been moved or deleted since the root was scanned
+            index.mark_stale()
+
+
+def _make_indexes(roots: List[Root]) -> List[RootIndex]:
+    return [RootIndex(root) for root in sorted(roots, key=lambda r: (r.priority, r.name))]
+
+
+def _list_dir(dirpath: str) -> Tuple[List[str], List[str]]:
+    """Returns the subdirectories and images in the directory."""
+    dirpaths, filepaths = [], []
+    try:
+        with os.scandir(dirpath) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    dirpaths.append(entry.path)
+                elif is_image_file(entry.name):
+                    filepaths.append(entry.path)
+    except OSError as e:
+        logger.warning(f'Failed to list {dirpath} ({e})')
+    return dirpaths, filepaths
@@ -3,6 +3,7 @@
 import configparser
 import logging
 import os
+from typing import List, NamedTuple
 
 PROJECT_ROOT = os.path.abspath(os.path.join(os.path.realpath(__file__), '..', '..'))
 
@@ -14,10 +15,65 @@ config.read(CONFIG_FILEPATH)
 
 # Database
 DB_FILEPATH = os.path.join(PROJECT_ROOT, config['database']['filename'])
+# Splitting file tags across databases (see `shards`): 'none', 'root' or 'year'
+DB_SHARD_BY = config.get('database', 'shard_by', fallback='none')
+DB_SHARD_DIR = os.path.join(PROJECT_ROOT, config.get('database', 'shard_dir', fallback='shards'))
+
+
+class Root(NamedTuple):
+    """A directory tree containing images."""
+    name: str
+    path: str
+    # Roots with lower priorities are searched first
+    priority: int
+    # Directories listed in parallel when scanning
+    concurrency: int
+    # Seconds after which the root's path index is rescanned on a miss
+    stale_after: float
+
+
+def _root(name: str, section: configparser.SectionProxy, default_priority: int) -> Root:
+    return Root(name=name,
+                path=os.path.expanduser(section['path' if 'path' in section else 'root_dir']),
+                priority=section.getint('priority', fallback=default_priority),
+                concurrency=section.getint('concurrency', fallback=4),
+                stale_after=section.getfloat('stale_after', fallback=300))
+
 
 # Filesystem
-ROOT_DIR = os.path.expanduser(config['filesystem']['root_dir'])
 IMAGE_EXTS = config['filesystem']['image_extensions'].split(',')
+# Sorted by priority; the main root (`root_dir`) plus any `[root:<name>]` sections
+ROOTS: List[Root] = sorted(
+    ([_root('main', config['filesystem'], 0)] if 'root_dir' in config['filesystem'] else []) + [
+        _root(section[len('root:'):], config[section], 100)
+        for section in config.sections() if section.startswith('root:')
+    ],
+    key=lambda root: (root.priority, root.name))
+
+# Accelerator
+ACCEL_ENABLED = config.getboolean('accelerator', 'enabled', fallback=False)
+ACCEL_SNAPSHOT_DIR = os.path.join(PROJECT_ROOT,
+                                  config.get('accelerator', 'snapshot_dir', fallback='imgtag.idx'))
+
+# Suggestions
+SUGGESTIONS_ENABLED = config.getboolean('suggestions', 'enabled', fallback=True)
+
+# Metadata
+METADATA_REFRESH_ON_STARTUP = config.getboolean('metadata', 'refresh_on_startup', fallback=True)
+METADATA_WORKERS = config.getint('metadata', 'workers', fallback=0) or None
+
+# Decoding
+DECODE_MAX_PIXELS = config.getint('decoding', 'max_pixels', fallback=25000000)
+DECODE_BUDGET_MB = config.getint('decoding', 'budget_mb', fallback=256)
+DECODE_THREADS = config.getint('decoding', 'threads', fallback=4) or None
+
+# Backup
+BACKUP_INTERVAL_MINUTES = config.getfloat('backup', 'interval_minutes', fallback=60)
+BACKUP_KEEP = config.getint('backup', 'keep', fallback=24)
+BACKUP_SNAPSHOT_DIR = os.path.join(PROJECT_ROOT,
+                                   config.get('backup', 'snapshot_dir', fallback='backups'))
+BACKUP_COMPACT = config.getboolean('backup', 'compact', fallback=False)
+BACKUP_EXPORT_TAGS = config.getboolean('backup', 'export_tags', fallback=True)
 
 # Logging
 LOG_LEVEL = {
@@ -0,0 +1,216 @@
+"""Splits a library's file tags (by far its largest table) across several SQLite databases, one per
+root or per year of modification.
+
+The main database keeps everything else (files, tags and rules). Every connection to it ATTACHes
+all shards, and a temporary `filetag` view over their union shadows the main database's own table,
+so reads work unchanged. Writes go to the shard holding the file (see `data`), so they only lock
+that shard. A file's shard is recorded when it is first tagged and never changes.
+
+Queries that would scan every file tag (e.g. tag counts) are instead run against each shard in
+parallel, on separate connections, and the results merged (see `ShardSet.fan_out`).
+"""
+
+import glob
+import os
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from . import diagnostics
+from .logger import get_logger
+from .roots import find_filepath, root_of
+
+logger = get_logger(__name__)
+
+SHARD_BY_OPTIONS = ['none', 'root', 'year']
+# For files without a root or modification time, or whose root or year has no shard yet
+OTHER_SHARD = 'other'
+# SQLite's default limit on attached databases, which can't be raised at runtime (`setlimit` is
+# capped by the compile-time maximum, also 10 unless SQLite was built with a higher one)
+MAX_SHARDS = 10
+# Seconds to wait for a lock before giving up
+SHARD_TIMEOUT = 30
+
+# The same table (and indexes) as `data.FileTag`
+SHARD_SCHEMA_SQL = [
+    'CREATE TABLE IF NOT EXISTS filetag ('
+    'id INTEGER NOT NULL PRIMARY KEY, fil_id INTEGER NOT NULL, tag_id INTEGER NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS filetag_fil_id ON filetag (fil_id)',
+    'CREATE INDEX IF NOT EXISTS filetag_tag_id ON filetag (tag_id)',
+    'CREATE UNIQUE INDEX IF NOT EXISTS filetag_fil_id_tag_id ON filetag (fil_id, tag_id)',
+]
+
+# The active shards, if sharding is enabled (see `init_shards`)
+_shards: Optional['ShardSet'] = None
+
+
+class ShardSet(object):
+    """The shard databases of a library."""
+    def __init__(self, by: str, dirpath: str, names: Sequence[str]):
+        self.by = by
+        self.dirpath = dirpath
+        self.names = sorted({_safe_name(name) for name in names} | {OTHER_SHARD})
+        if len(self.names) > MAX_SHARDS:
+            raise ValueError(f'Too many shards in {dirpath} ({len(self.names)}, at most '
+                             f'{MAX_SHARDS}); merge them first (db_helper.py --merge-shards)')
+        # Shard name -> schema name in attached connections
+        self.schemas = {name: f'shard_{i}' for i, name in enumerate(self.names)}
+        self._pool = ThreadPoolExecutor(len(self.names), thread_name_prefix='shard')
+        # Per-thread connections for `fan_out`
+        self._local = threading.local()
+
+    # -- Public
+
+    def filepath(self, name: str) -> str:
+        return shard_filepath(self.dirpath, self.by, name)
+
+    def shard_of(self, filename: str, path: Optional[str], mtime: Optional[float]) -> str:
+        """Returns the shard for a file, given its path and modification time if known."""
+        path = path or find_filepath(filename)
+        if self.by == 'root':
+            root = root_of(path) if path else None
+            name = _safe_name(root.name) if root else OTHER_SHARD
+        else:
+            if mtime is None and path and os.path.exists(path):
+                mtime = os.path.getmtime(path)
+            name = time.strftime('%Y', time.localtime(mtime)) if mtime else OTHER_SHARD
+        return name if name in self.schemas else OTHER_SHARD
+
+    def create_missing(self, schema_sql: Sequence[str] = ()):
+        """Creates any missing shards, tables and indexes, plus those in `schema_sql`."""
+        os.makedirs(self.dirpath, exist_ok=True)
+        for name in self.names:
+            conn = sqlite3.connect(self.filepath(name))
+            try:
+                with conn:
+                    for sql in SHARD_SCHEMA_SQL + list(schema_sql):
+                        conn.execute(sql)
+            finally:
+                conn.close()
+
+    def attach(self, conn: sqlite3.Connection):
+        """Attaches all shards to a connection to the main database, shadowing its `filetag`
+        table with a view over all of them.
+        """
+        attached = {row[1] for row in conn.execute('PRAGMA database_list')}
+        for name, schema in self.schemas.items():
+            if schema not in attached:
+                conn.execute('ATTACH DATABASE ? AS ?', (self.filepath(name), schema))
+        union = ' UNION ALL '.join(f'SELECT id, fil_id, tag_id FROM {schema}.filetag'
+                                   for schema in self.schemas.values())
+        conn.execute(f'CREATE TEMP VIEW IF NOT EXISTS filetag AS {union}')
+
+    def fan_out(self, sql: str, params: Sequence = ()) -> List[list]:
+        """Runs a query against each shard's `filetag` table in parallel, returning the rows from
+        each shard.
+        """
+        def run(name: str) -> list:
+            diagnostics.record_query(sql)
+            return self._connection(name).execute(sql, params).fetchall()
+
+        return list(self._pool.map(run, self.names))
+
+    # -- Helpers
+
+    def _connection(self, name: str) -> sqlite3.Connection:
+        connections: Dict[str,
+                          sqlite3.Connection] = self._local.__dict__.setdefault('connections', {})
+        if name not in connections:
+            connections[name] = sqlite3.connect(self.filepath(name), timeout=SHARD_TIMEOUT)
+        return connections[name]
+
+
+# -- Public
+
+
+def init_shards(by: str, dirpath: str, names: Sequence[str],
+                schema_sql: Sequence[str] = ()) -> ShardSet:
+    """Sets up (and creates any missing) shards of the given kind, plus any that already exist.
+
+    If there are more names than shards can be attached, the newest years (or the first roots) get
+    their own shards and the rest share the `OTHER_SHARD`. `schema_sql` is run on every shard (as
+    well as creating the `filetag` table).
+    """
+    global _shards
+    if by not in SHARD_BY_OPTIONS[1:]:
+        raise ValueError(f'Invalid shard_by: {by} (options: {", ".join(SHARD_BY_OPTIONS)})')
+    other = {kind for kind, _ in list_shard_files(dirpath) if kind != by}
+    if other:
+        raise ValueError(f'{dirpath} has shards by {", ".join(sorted(other))}; merge them first '
+                         f'(db_helper.py --merge-shards)')
+    existing = [name for _, name in list_shard_files(dirpath)]
+    shards = ShardSet(by, dirpath, _fit_shards(by, names, existing))
+    shards.create_missing(schema_sql)
+    _shards = shards
+    logger.info(f'Using {len(shards.names)} shard(s) by {by}: {", ".join(shards.names)}')
+    return shards
+
+
+def get_shards() -> Optional[ShardSet]:
+    return _shards
+
+
+def shard_filepath(dirpath: str, by: str, name: str) -> str:
+    return os.path.join(dirpath, f'{by}-{name}.db')
+
+
+def list_shard_files(dirpath: str) -> List[Tuple[str, str]]:
+    """Returns the (kind, name) of every shard database in the directory."""
+    shards = []
+    for filepath in sorted(glob.glob(os.path.join(dirpath, '*-*.db'))):
+        kind, _, name = os.path.basename(filepath)[:-len('.db')].partition('-')
+        if kind in SHARD_BY_OPTIONS:
+            shards.append((kind, name))
+    return shards
+
+
+def merge_shards(db_filepath: str, dirpath: str) -> int:
+    """Moves all file tags from the shards in the directory back into the main database, deleting
+    the shards. Returns the number of file tags moved.
+    """
+    shard_files = list_shard_files(dirpath)
+    conn = sqlite3.connect(db_filepath, timeout=SHARD_TIMEOUT)
+    n_rows = 0
+    try:
+        for sql in SHARD_SCHEMA_SQL:
+            conn.execute(sql)
+        for kind, name in shard_files:
+            filepath = shard_filepath(dirpath, kind, name)
+            conn.execute('ATTACH DATABASE ? AS shard', (filepath, ))
+            with conn:
+                n_rows += conn.execute('INSERT OR IGNORE INTO main.filetag (fil_id, tag_id) '
+                                       'SELECT fil_id, tag_id FROM shard.filetag').rowcount
+            conn.execute('DETACH DATABASE shard')
+            os.remove(filepath)
+            logger.info(f'Merged shard {kind}-{name} into {db_filepath}')
+        if shard_files and 'shard' in {row[1] for row in conn.execute('PRAGMA table_info(file)')}:
+            with conn:
+                conn.execute('UPDATE file SET shard = NULL')
+    finally:
+        conn.close()
+    return n_rows
+
+
+# -- Helpers
+
+
+def _safe_name(name: str) -> str:
+    # Root names are user-defined, but end up in filenames
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', name)
+
+
+def _fit_shards(by: str, names: Sequence[str], existing: Sequence[str]) -> List[str]:
+    """Returns the existing shards plus as many new ones as can be attached alongside them."""
+    fitted = {_safe_name(name) for name in existing} | {OTHER_SHARD}
+    new = [name for name in dict.fromkeys(map(_safe_name, names)) if name not in fitted]
+    if by == 'year':
+        # Recent images are the ones being tagged
+        new.sort(reverse=True)
+    room = max(MAX_SHARDS - len(fitted), 0)
+    if len(new) > room:
+        logger.warning(f'At most {MAX_SHARDS} shards can be attached; file tags for '
+                       f'{", ".join(sorted(new[room:]))} go in the {OTHER_SHARD} shard')
+    return sorted(fitted.union(new[:room]))
@@ -3,10 +3,23 @@
 There should ideally be as little in this module as possible.
 """
 
-from PySide2.QtCore import QStringListModel
-from PySide2.QtWidgets import QCompleter
+from typing import Optional, Set
 
+from PySide2.QtCore import QObject, Signal
+
+from .completer import TagCompleter
 from .data import get_all_tags
+from .writes import WriteQueue
+
+
+# Signals must be defined on a QObject (or descendant)
+class TagEditSignals(QObject):
+    # Filenames with new pending edits (optimistic updates should be shown)
+    edited = Signal(list)
+    # Filenames whose edits have been written (or failed to)
+    written = Signal(list)
+    # Error message when edits failed to be written (and were dropped from undo/redo)
+    failed = Signal(str)
 
 
 class GlobalState(object):
@@ -14,12 +27,37 @@ class GlobalState(object):
 
     # TODO: Refactor settings into here
     def __init__(self):
-        self._tag_completer = QCompleter()
         # Sort by descending file count
         tagnames = [tag[0] for tag in sorted(get_all_tags(), key=lambda t: -t[1])]
-        self._tag_completer.setModel(QStringListModel(tagnames))
+        self._tag_completer = TagCompleter(tagnames)
+
+        self._tag_edit_signals = TagEditSignals()
+        # NOTE: Signals emitted from the writer thread are queued to the GUI thread
+        self._write_queue = WriteQueue(on_edited=self._on_tags_edited,
+                                       on_written=self._on_tags_written)
 
     @property
-    def tag_completer(self) -> QCompleter:
+    def tag_completer(self) -> TagCompleter:
         """A dropdown completer used for any tag entry widget."""
         return self._tag_completer
+
+    @property
+    def write_queue(self) -> WriteQueue:
+        """The queue through which all tag edits from the GUI are written."""
+        return self._write_queue
+
+    @property
+    def tag_edit_signals(self) -> TagEditSignals:
+        """Signals for views to refresh on tag edits."""
+        return self._tag_edit_signals
+
+    # -- Callbacks
+
+    def _on_tags_edited(self, filenames: Set[str]):
+        self._tag_edit_signals.edited.emit(sorted(filenames))
+
+    def _on_tags_written(self, filenames: Set[str], error: Optional[Exception]):
+        self._tag_edit_signals.written.emit(sorted(filenames))
+        if error:
+            self._tag_edit_signals.failed.emit(
+                f'Failed to save tag edits to {len(filenames)} file(s): {error}')
@@ -1,33 +1,78 @@
-from typing import Tuple
+import collections
+import itertools
+from typing import Deque, Iterator, Optional, Tuple
 
-from PySide2.QtCore import Qt
-from PySide2.QtWidgets import QGridLayout, QSplitter, QWidget
+from PySide2.QtCore import QObject, QRunnable, Qt, QThreadPool, Signal, Slot
+from PySide2.QtWidgets import QComboBox, QGridLayout, QLabel, QPushButton, QSplitter, QWidget
 
+from .. import diagnostics
+from ..roots import get_roots, root_of
 from ..state import GlobalState
+from ..untagged import iter_untagged
 from ..utils import is_image_file
-from ..widgets import FileTagView, FileTreeView, ImageView, wrap_image
+from ..widgets import FileTagView, FileTreeView, ImagePrefetcher, ImageView, wrap_image
 
 
 class FileTab(QWidget):
-    """Combines a filesystem view, tag adding entry, tag list, and image display."""
+    """Combines a filesystem view, tag adding entry, tag list, and image display.
+
+    Also works as a queue of untagged images: "Next untagged" steps through them in directory
+    order, with the following image decoded in the background. They are found a batch at a time on
+    a worker thread, as walking a large tree with few untagged images can take a while.
+    """
     title = 'Filesystem'
+    # Untagged images found per batch
+    untagged_batch_size = 10
 
     def __init__(self, global_state: GlobalState):
         super().__init__()
 
         self.global_state = global_state
 
-        layout, self._file_tree, self._tagging, self._image = self._layout()
+        # Untagged images still to find, and those found but not visited yet (the first of which is
+        # being prefetched)
+        self._untagged: Optional[Iterator[str]] = None
+        self._untagged_queue: Deque[str] = collections.deque()
+        self._all_untagged_found = False
+        self._finding_untagged = False
+        # Whether to select the next untagged image as soon as it is found
+        self._awaiting_untagged = False
+        self._n_untagged_visited = 0
+        self._thread_pool = QThreadPool()
+        self._thread_pool.setMaxThreadCount(1)
+        self._prefetcher = ImagePrefetcher()
+
+        (layout, self._file_tree, self._tagging, self._image, self._untagged_label,
+         self._root_selector) = self._layout()
         self.setLayout(layout)
 
     # -- Initialization
 
-    def _layout(self) -> Tuple[QGridLayout, FileTreeView, FileTagView, ImageView]:
+    def _layout(
+            self) -> Tuple[QGridLayout, FileTreeView, FileTagView, ImageView, QLabel, QComboBox]:
         layout = QGridLayout()
         layout.setContentsMargins(5, 5, 5, 5)
 
+        # Root selector (only useful with several roots)
+        root_selector = QComboBox()
+        for root in get_roots():
+            root_selector.addItem(f'{root.name} ({root.path})', root.path)
+        root_selector.activated.connect(self._on_root_selected)
+        root_selector.setVisible(root_selector.count() > 1)
+        layout.addWidget(root_selector, 0, 2)
+
+        # Untagged work queue
+        next_button = QPushButton('Next untagged')
+        next_button.setShortcut('Ctrl+N')
+        next_button.setToolTip('Select the next image without tags (Ctrl+N)')
+        next_button.clicked.connect(self._select_next_untagged)
+        layout.addWidget(next_button, 0, 0)
+        untagged_label = QLabel()
+        layout.addWidget(untagged_label, 0, 1)
+        layout.setColumnStretch(1, 1)
+
         splitter = QSplitter()
-        layout.addWidget(splitter, 0, 0, 0, 0)
+        layout.addWidget(splitter, 1, 0, 1, 3)
 
         left_splitter = QSplitter(Qt.Vertical)
         splitter.addWidget(left_splitter)
@@ -47,7 +92,9 @@ class FileTab(QWidget):
         # Initialize equal widths (needs to be set at the end)
         splitter.setSizes([1000000, 1000000])
 
-        return layout, file_tree, tagging, image
+        return layout, file_tree, tagging, image, untagged_label, root_selector
+
+    # -- Callbacks
 
     def _on_file_tree_selection_changed(self, new_selection, _old_selection):
         indices = new_selection.indexes()
@@ -55,5 +102,98 @@ class FileTab(QWidget):
             return
         filepath = self._file_tree.model().filePath(indices[0])
         if filepath and is_image_file(filepath):
-            self._tagging.load(filepath)
-            self._image.load(filepath)
+            with diagnostics.action('file.select'):
+                self._tagging.load(filepath)
+                self._image.load(filepath, self._prefetcher.take(filepath))
+
+    def _on_root_selected(self, index: int):
+        self._file_tree.set_root(self._root_selector.itemData(index))
+
+    def _select_next_untagged(self):
+        with diagnostics.action('file.next_untagged'):
+            if self._untagged is None:
+                # Start over, which also picks up any tags added since the last pass
+                self._untagged = iter_untagged([root.path for root in get_roots()])
+                self._untagged_queue.clear()
+                self._all_untagged_found = False
+                self._n_untagged_visited = 0
+
+            if not self._untagged_queue:
+                if self._all_untagged_found:
+                    self._untagged = None
+                    self._untagged_label.setText('No more untagged images')
+                else:
+                    # Selected once found
+                    self._awaiting_untagged = True
+                    self._untagged_label.setText('Finding untagged images...')
+                    self._find_untagged()
+                return
+            self._show_untagged(self._untagged_queue.popleft())
+
+    def _on_untagged_found(self, result: tuple):
+        untagged, filepaths, done = result
+        # Ignore passes that have been restarted since
+        if untagged is not self._untagged:
+            return
+        self._finding_untagged = False
+        self._untagged_queue.extend(filepaths)
+        self._all_untagged_found = done
+        if self._awaiting_untagged:
+            self._awaiting_untagged = False
+            self._select_next_untagged()
+        elif self._untagged_queue:
+            self._prefetcher.prefetch(self._untagged_queue[0])
+
+    # -- Helpers
+
+    def _show_untagged(self, filepath: str):
+        self._n_untagged_visited += 1
+        self._untagged_label.setText(f'Untagged image #{self._n_untagged_visited}')
+
+        # Decode the one after in the background while this one is being tagged, and find more
+        # before running out
+        if self._untagged_queue:
+            self._prefetcher.prefetch(self._untagged_queue[0])
+        if len(self._untagged_queue) < self.untagged_batch_size // 2:
+            self._find_untagged()
+
+        root = root_of(filepath)
+        if root and root.path != self._file_tree.root_path:
+            self._set_root(root.path)
+        index = self._file_tree.model().index(filepath)
+        self._file_tree.setCurrentIndex(index)
+        self._file_tree.scrollTo(index)
+
+    def _find_untagged(self):
+        if self._untagged is None or self._finding_untagged or self._all_untagged_found:
+            return
+        self._finding_untagged = True
+        worker = UntaggedWorker(self._untagged, self.untagged_batch_size)
+        worker.signal.result.connect(self._on_untagged_found)
+        self._thread_pool.start(worker)
+
+    def _set_root(self, path: str):
+        self._file_tree.set_root(path)
+        self._root_selector.setCurrentIndex(self._root_selector.findData(path))
+
+
+# Signals must be defined on a QObject (or descendant)
+class UntaggedWorkerSignal(QObject):
+    result = Signal(tuple)
+
+
+class UntaggedWorker(QRunnable):
+    """An async worker that finds the next untagged images of a pass (see `iter_untagged`).
+
+    Emits the pass, the images found and whether there are no more.
+    """
+    def __init__(self, untagged: Iterator[str], n: int):
+        super().__init__()
+        self._untagged = untagged
+        self._n = n
+        self.signal = UntaggedWorkerSignal()
+
+    @Slot()
+    def run(self):
+        filepaths = list(itertools.islice(self._untagged, self._n))
+        self.signal.result.emit((self._untagged, filepaths, len(filepaths) < self._n))
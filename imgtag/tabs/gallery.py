@@ -1,8 +1,14 @@
 import os
-from typing import Tuple
+from typing import List, Tuple
 
+from PySide2.QtCore import QModelIndex
 from PySide2.QtWidgets import QCheckBox, QGridLayout, QLabel, QSplitter, QWidget
 
+from .. import diagnostics
+from ..cooccurrence import get_cooccurrence
+from ..data import resolve_tagnames
+from ..query import parse_query
+from ..settings import SUGGESTIONS_ENABLED
 from ..state import GlobalState
 from ..widgets import GalleryView, ImageView, MultiTagEntry, TagListView, wrap_image
 
@@ -15,11 +21,16 @@ class GalleryTab(QWidget):
         super().__init__()
 
         self.global_state = global_state
+        self._selected_filename = ''
 
-        (layout, self._gallery, self._entry, self._shuffle, self._taglist,
+        (layout, self._gallery, self._entry, self._shuffle, self._taglist, self._facets,
          self._image) = self._layout()
         self.setLayout(layout)
 
+        signals = self.global_state.tag_edit_signals
+        signals.edited.connect(self._on_tags_changed)
+        signals.written.connect(self._on_tags_changed)
+
     # -- Initialization
 
     def _layout(self) -> Tuple:
@@ -55,6 +66,13 @@ class GalleryTab(QWidget):
         taglist = TagListView()
         left_layout.addWidget(taglist, 1, 0, 1, 3)
 
+        # Most common tags among the search results (hidden if disabled)
+        facets = TagListView()
+        facets.model().setHorizontalHeaderLabels(['Related tag', '# Results'])
+        facets.doubleClicked.connect(self._refine_search)
+        facets.setVisible(SUGGESTIONS_ENABLED)
+        left_layout.addWidget(facets, 2, 0, 1, 3)
+
         # Image
         image = ImageView()
         splitter.addWidget(wrap_image(image))
@@ -62,15 +80,42 @@ class GalleryTab(QWidget):
         # Initialize equal widths (needs to be set at the end)
         splitter.setSizes([1000000, 1000000])
 
-        return layout, gallery, entry, shuffle, taglist, image
+        return layout, gallery, entry, shuffle, taglist, facets, image
 
     # -- Callbacks
 
     def _load_image(self, filepath: str):
-        self._taglist.load(os.path.split(filepath)[-1])
+        self._selected_filename = os.path.split(filepath)[-1]
+        self._load_tags()
         self._image.load(filepath)
 
+    def _on_tags_changed(self, filenames: List[str]):
+        if self._selected_filename in filenames:
+            self._load_tags()
+
     def _search(self):
         text = self._entry.text().strip().lower()
         shuffle = self._shuffle.isChecked()
-        self._gallery.search(text, shuffle=shuffle)
+        with diagnostics.action('gallery.search'):
+            filenames = self._gallery.search(text, shuffle=shuffle)
+            self._update_facets(text, filenames)
+
+    def _refine_search(self, idx: QModelIndex):
+        # Narrow the current search down to the double-clicked tag
+        tagname = self._facets.tag_by_index(idx.siblingAtColumn(0))
+        self._entry.setText(f'{self._entry.text().strip()} {tagname}'.strip())
+        self._search()
+
+    # -- Helpers
+
+    def _load_tags(self):
+        self._taglist.load(self._selected_filename,
+                           self.global_state.write_queue.pending_edits(self._selected_filename))
+
+    def _update_facets(self, text: str, filenames: List[str]):
+        index = get_cooccurrence()
+        if not index:
+            return
+        query = parse_query(text)
+        self._facets.set_tags(
+            index.facets(filenames, excluded_tagnames=resolve_tagnames(query.tagnames)))
@@ -0,0 +1,74 @@
+"""Finds untagged images by diffing the filesystem against the database."""
+
+import itertools
+import os
+import threading
+from typing import Iterator, List, Set
+
+from .data import FileTagPairs, add_filetag_observer, get_tagged_filenames, remove_filetag_observer
+from .utils import is_image_file
+
+
+class TaggedFilenames(object):
+    """The names of all files with tags, fetched in a single query and fetched again after any
+    change to file tags (see `data.add_filetag_observer`).
+    """
+    def __init__(self):
+        self._names: Set[str] = set()
+        self._stale = True
+        self._lock = threading.Lock()
+        add_filetag_observer(self._on_filetags_changed)
+
+    def __contains__(self, filename: str) -> bool:
+        with self._lock:
+            stale, self._stale = self._stale, False
+        if stale:
+            self._names = get_tagged_filenames()
+        return filename in self._names
+
+    # -- Public
+
+    def close(self):
+        remove_filetag_observer(self._on_filetags_changed)
+
+    # -- Callbacks
+
+    def _on_filetags_changed(self, _added: FileTagPairs, _removed: FileTagPairs):
+        with self._lock:
+            self._stale = True
+
+
+def iter_untagged(root_dirs: List[str]) -> Iterator[str]:
+    """Lazily yields the paths of all images under the root directories that have no tags, root by
+    root in directory order (see `iter_images`).
+
+    Each file is a set lookup rather than a query (see `TaggedFilenames`), so files tagged while
+    iterating are skipped too.
+    """
+    tagged = TaggedFilenames()
+    try:
+        for filepath in itertools.chain.from_iterable(
+                iter_images(root_dir) for root_dir in root_dirs):
+            if os.path.split(filepath)[-1] not in tagged:
+                yield filepath
+    finally:
+        tagged.close()
+
+
+def iter_images(root_dir: str) -> Iterator[str]:
+    """Lazily yields the paths of all images under the directory, depth-first with directories
+    before files and each sorted by name, as in the filesystem tree.
+
+    Symlinked directories aren't followed (as in `roots`), since they may form loops.
+    """
+    try:
+        with os.scandir(root_dir) as it:
+            entries = sorted(it, key=lambda entry: entry.name.lower())
+    except OSError:
+        return
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            yield from iter_images(entry.path)
+    for entry in entries:
+        if not entry.is_dir() and is_image_file(entry.name):
+            yield entry.path
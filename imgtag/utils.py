@@ -8,3 +8,8 @@ from .settings import IMAGE_EXTS
 def is_image_file(filepath: str) -> bool:
     """Checks if the given file has one of the configured image extensions."""
     return os.path.splitext(filepath)[-1].lower().replace('.', '') in IMAGE_EXTS
+
+
+def normalize_tagname(text: str) -> str:
+    """Converts user-entered text to the canonical (lowercase, underscored) tag name form."""
+    return text.strip().replace(' ', '_').lower()
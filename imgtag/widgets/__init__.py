@@ -1,9 +1,11 @@
 from PySide2.QtCore import Qt
 from PySide2.QtWidgets import QScrollArea
 
+from .diagnostics import DiagnosticsView
 from .file import FileTreeView
 from .gallery import GalleryView
-from .image import ImageView
+from .image import ImagePrefetcher, ImageView
+from .stats import StatsView
 from .tag import FileTagView, MultiTagEntry, TagListView
 
 
@@ -0,0 +1,42 @@
+from PySide2.QtGui import QFontDatabase
+from PySide2.QtWidgets import QDialog, QGridLayout, QPlainTextEdit, QPushButton
+
+from .. import diagnostics
+
+
+class DiagnosticsView(QDialog):
+    """A dialog showing the current diagnostics report."""
+    def __init__(self, parent=None):
+        super().__init__(parent)
+
+        self.setWindowTitle('Diagnostics')
+        self.resize(800, 600)
+
+        layout = QGridLayout()
+        self.setLayout(layout)
+
+        self._text = QPlainTextEdit()
+        self._text.setReadOnly(True)
+        self._text.setFont(QFontDatabase.systemFont(QFontDatabase.FixedFont))
+        layout.addWidget(self._text, 0, 0, 1, 2)
+
+        refresh = QPushButton('Refresh')
+        refresh.clicked.connect(self.refresh)
+        layout.addWidget(refresh, 1, 0)
+
+        reset = QPushButton('Reset')
+        reset.clicked.connect(self._reset)
+        layout.addWidget(reset, 1, 1)
+
+        self.refresh()
+
+    # -- Public
+
+    def refresh(self):
+        self._text.setPlainText(diagnostics.report())
+
+    # -- Callbacks
+
+    def _reset(self):
+        diagnostics.reset()
+        self.refresh()
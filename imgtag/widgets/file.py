@@ -6,7 +6,8 @@ from PySide2.QtWidgets import QFileSystemModel, QTreeView
 
 from ..data import get_file_tags
 from ..logger import get_logger
-from ..settings import IMAGE_EXTS, ROOT_DIR
+from ..roots import get_roots
+from ..settings import IMAGE_EXTS
 from ..utils import is_image_file
 
 logger = get_logger(__name__)
@@ -24,9 +25,10 @@ class FileTreeView(QTreeView):
             list(itertools.chain(*[[f'*.{ext.lower()}', f'*.{ext.upper()}']
                                    for ext in IMAGE_EXTS])))
 
-        model.setRootPath(ROOT_DIR)
         self.setModel(model)
-        self.setRootIndex(model.index(ROOT_DIR))
+        roots = get_roots()
+        if roots:
+            self.set_root(roots[0].path)
 
         # Hide size, type, date modified
         header = self.header()
@@ -42,6 +44,18 @@ class FileTreeView(QTreeView):
         for i in range(1, self.model().columnCount() + 1):
             self.resizeColumnToContents(i)
 
+    # -- Public
+
+    @property
+    def root_path(self) -> str:
+        return self.model().rootPath()
+
+    def set_root(self, path: str):
+        """Shows the tree under the given (root) directory."""
+        model = self.model()
+        model.setRootPath(path)
+        self.setRootIndex(model.index(path))
+
 
 class FileTreeModel(QFileSystemModel):
     """A filesystem tree model that can be extended with custom columns."""
@@ -1,139 +1,340 @@
 import os
 import random
-from typing import Callable, List, Tuple
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
 
-from PySide2.QtCore import QObject, QRunnable, QSize, Qt, QThreadPool, Signal, Slot
-from PySide2.QtGui import QIcon
-from PySide2.QtWidgets import QComboBox, QGridLayout, QLabel, QListWidget, QListWidgetItem, QWidget
+from PySide2.QtCore import (QAbstractListModel, QModelIndex, QObject, QRect, QRunnable, QSize, Qt,
+                            QThreadPool, QTimer, Signal, Slot)
+from PySide2.QtGui import QIcon, QImage, QPixmap
+from PySide2.QtWidgets import QCheckBox, QGridLayout, QLabel, QListView, QWidget
 
-from ..data import get_file_metadata, get_file_paths, get_files_with_tags
+from .. import diagnostics
+from ..data import get_file_metadata, get_file_paths
+from ..decoding import decode_image
 from ..logger import get_logger
-from ..settings import ROOT_DIR
+from ..query import search_files
+from ..settings import DECODE_THREADS
 
 logger = get_logger(__name__)
 
 
 class GalleryView(QWidget):
-    """A gallery widget with paginated thumbnails, aligned horizontally and scrollable."""
+    """A gallery widget with lazily loaded thumbnails, either in a horizontally scrollable strip or
+    a wrapping grid.
+    """
 
-    # Always fit to configured height
-    thumbnail_width = 10000
     thumbnail_height = 100
     padding_height = 70
-    images_per_page = 20
+    # Height of the widget in grid mode, unless resized
+    grid_height = 600
+    # Delay before loading thumbnails after the viewport changes, so that fast scrolling doesn't
+    # queue loads for rows that are only passed over
+    load_delay_ms = 50
 
     def __init__(self, load_image_callback: Callable):
         super().__init__()
 
         self._load_image_callback = load_image_callback
-        # For async thumbnail loading
-        self._thread_pool = QThreadPool()
-        # For pagination
-        self._all_filenames: List[str] = []
+        # Uniform cells, so that layout doesn't need every row's thumbnail (or size) up front
+        self._cell_size = QSize(self.thumbnail_height * 2,
+                                self.thumbnail_height + self.padding_height // 2)
+        self._model = GalleryModel(self.thumbnail_height, self._cell_size)
+
+        self._load_timer = QTimer(self)
+        self._load_timer.setSingleShot(True)
+        self._load_timer.setInterval(self.load_delay_ms)
+        self._load_timer.timeout.connect(self._load_visible)
+        self._model.rowsInserted.connect(self._schedule_load)
+        self._model.modelReset.connect(self._schedule_load)
 
         self.setFixedHeight(self.thumbnail_height + self.padding_height)
 
-        (layout, self._page_select, self._query_label, self._viewing_label,
+        (layout, self._query_label, self._viewing_label, self._grid_toggle,
          self._gallery) = self._layout()
         self.setLayout(layout)
 
-    def _layout(self) -> Tuple[QGridLayout, QComboBox, QLabel, QLabel, QListWidget]:
+    def _layout(self) -> Tuple[QGridLayout, QLabel, QLabel, QCheckBox, 'GalleryList']:
         layout = QGridLayout()
         layout.setContentsMargins(0, 0, 0, 0)
 
-        page_label = QLabel('Page:')
-        page_label.setFixedWidth(40)
-        layout.addWidget(page_label, 0, 0)
-
-        # Page select dropdown
-        page_select = QComboBox()
-        page_select.currentTextChanged.connect(self._on_page_changed)
-        page_select.setFixedWidth(60)
-        layout.addWidget(page_select, 0, 1)
-
         # Query results and image label
         query_label = QLabel('Query:')
-        layout.addWidget(query_label, 0, 2)
+        layout.addWidget(query_label, 0, 0)
         viewing_label = QLabel('Viewing:')
-        layout.addWidget(viewing_label, 0, 3)
+        layout.addWidget(viewing_label, 0, 1)
+
+        # Layout toggle
+        grid_toggle = QCheckBox('Grid?')
+        grid_toggle.toggled.connect(self._on_grid_toggled)
+        layout.addWidget(grid_toggle, 0, 2)
 
         # Gallery
-        gallery = QListWidget()
-        gallery.setFlow(QListWidget.LeftToRight)
+        gallery = GalleryList()
+        gallery.setViewMode(QListView.IconMode)
+        gallery.setFlow(QListView.LeftToRight)
         gallery.setWrapping(False)
-        gallery.setViewMode(QListWidget.IconMode)
-        gallery.setIconSize(QSize(self.thumbnail_width, self.thumbnail_height))
-        gallery.currentItemChanged.connect(self._on_item_changed)
-        layout.addWidget(gallery, 1, 0, 1, 4)
-
-        return layout, page_select, query_label, viewing_label, gallery
+        gallery.setMovement(QListView.Static)
+        gallery.setResizeMode(QListView.Adjust)
+        # Lay out in batches so that huge result sets don't block the UI
+        gallery.setLayoutMode(QListView.Batched)
+        gallery.setUniformItemSizes(True)
+        gallery.setGridSize(self._cell_size)
+        gallery.setIconSize(QSize(self._cell_size.width(), self.thumbnail_height))
+        gallery.setModel(self._model)
+        gallery.viewport_changed.connect(self._schedule_load)
+        gallery.selectionModel().currentChanged.connect(self._on_current_changed)
+        layout.addWidget(gallery, 1, 0, 1, 3)
+
+        return layout, query_label, viewing_label, grid_toggle, gallery
 
     # -- Public
 
-    @property
-    def page_count(self) -> int:
-        """The total number of pages for the current search results."""
-        count = len(self._all_filenames) // self.images_per_page
-        if len(self._all_filenames) % self.images_per_page == 0:
-            return count
-        return count + 1
-
-    def search(self, text: str, shuffle: bool):
+    def search(self, text: str, shuffle: bool) -> List[str]:
         tags = text.split()
-        filenames = get_files_with_tags([t for t in tags if not t.startswith('-')],
-                                        [t[1:] for t in tags if t.startswith('-')])
+        filenames = search_files(text)
         if shuffle:
             random.shuffle(filenames)
         self.populate(filenames)
-        self._query_label.setText(
-            f'Query: {tags} | {len(filenames)} images ({self.page_count} pages)')
+        self._query_label.setText(f'Query: {tags} | {len(filenames)} images')
+        return filenames
 
     def populate(self, filenames: List[str]):
-        self._all_filenames = filenames
-        self._page_select.clear()
-        self._page_select.addItems([str(i) for i in range(1, self.page_count + 1)])
-
-        # NOTE: We don't need to call _populate() here since the page change handler does it
-        #       (Which includes the first page)
+        self._model.set_filenames(filenames)
+        self._gallery.scrollToTop()
 
     # -- Callbacks
 
-    def _on_page_changed(self, val: str):
-        if not val or len(self._all_filenames) == 0:
-            return
-        # 1-indexed on UI, 0-indexed internally
-        self._change_page(int(val) - 1)
-
-    def _on_item_changed(self, current, _previous):
-        if not current:
+    def _on_current_changed(self, current: QModelIndex, _previous: QModelIndex):
+        filepath = current.data(Qt.StatusTipRole) if current.isValid() else None
+        if not filepath:
             return
-        filepath = current.data(Qt.StatusTipRole)
         self._viewing_label.setText(f'Viewing: {os.path.split(filepath)[-1]}')
-        self._load_image_callback(filepath)
+        with diagnostics.action('gallery.select'):
+            self._load_image_callback(filepath)
+
+    def _on_grid_toggled(self, checked: bool):
+        self._gallery.setWrapping(checked)
+        if checked:
+            self.setFixedHeight(self.grid_height)
+        else:
+            self.setFixedHeight(self.thumbnail_height + self.padding_height)
+        self._schedule_load()
+
+    def _schedule_load(self, *_args):
+        # Restarts the delay if already scheduled
+        self._load_timer.start()
+
+    def _load_visible(self):
+        rows = self._gallery.visible_rows()
+        if rows:
+            self._model.load_rows(*rows)
+
+
+class GalleryList(QListView):
+    """A list view that reports when its visible area changes (by scrolling or resizing)."""
+    viewport_changed = Signal()
+
+    # -- Public
+
+    def visible_rows(self) -> Optional[Tuple[int, int]]:
+        """Returns the first and last rows in the viewport, if any.
+
+        Rows are laid out in order, so everything in between is visible too.
+        """
+        count = self.model().rowCount()
+        rect = self.viewport().rect()
+        first = self.indexAt(rect.topLeft())
+        if first.isValid():
+            row = first.row()
+        else:
+            # E.g. in the spacing between cells: find the first row that isn't scrolled past
+            (low, high) = (0, count)
+            while low < high:
+                middle = (low + high) // 2
+                if self._is_before(self.visualRect(self.model().index(middle)), rect):
+                    low = middle + 1
+                else:
+                    high = middle
+            row = low
+        if row >= count:
+            return None
+
+        last = row
+        while last + 1 < count and self._is_visible(self.visualRect(self.model().index(last + 1)),
+                                                    rect):
+            last += 1
+        return (row, last)
+
+    # Override
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.viewport_changed.emit()
+
+    # Override
+    def scrollContentsBy(self, dx: int, dy: int):
+        super().scrollContentsBy(dx, dy)
+        self.viewport_changed.emit()
+
+    # -- Helpers
+
+    @staticmethod
+    def _is_before(item_rect: QRect, viewport_rect: QRect) -> bool:
+        # Items that haven't been laid out yet have an invalid rect
+        return item_rect.isValid() and (item_rect.bottom() < viewport_rect.top()
+                                        or item_rect.right() < viewport_rect.left())
+
+    @staticmethod
+    def _is_visible(item_rect: QRect, viewport_rect: QRect) -> bool:
+        return item_rect.isValid() and item_rect.intersects(viewport_rect)
+
+
+class GalleryModel(QAbstractListModel):
+    """A list model over a (possibly huge) list of filenames.
+
+    Rows are exposed to the view in batches as it scrolls (via `canFetchMore`/`fetchMore`), paths
+    are resolved per batch, and thumbnails are only loaded for the rows the view reports as visible
+    (see `load_rows`); queued loads for rows scrolled out of view are dropped. Decoded thumbnails
+    are kept in a bounded LRU cache, so memory use is proportional to the viewport rather than the
+    result size.
+    """
+    batch_size = 100
+    max_cached_icons = 500
+
+    def __init__(self, thumbnail_height: int, cell_size: QSize):
+        super().__init__()
+
+        self._thumbnail_height = thumbnail_height
+        self._cell_size = cell_size
+        # For async thumbnail loading
+        self._thread_pool = QThreadPool()
+        if DECODE_THREADS:
+            self._thread_pool.setMaxThreadCount(DECODE_THREADS)
+        self._placeholder = QIcon()
+
+        self._filenames: List[str] = []
+        # Number of rows currently exposed to the view
+        self._row_count = 0
+        # Resolved paths for the exposed rows
+        self._filepaths: List[str] = []
+        self._rows_by_filepath: Dict[str, int] = {}
+        # Filepath -> (icon, label), least recently used first
+        self._icons: 'OrderedDict[str, Tuple[QIcon, str]]' = OrderedDict()
+        # Filepath -> queued or running load
+        self._pending: Dict[str, IconWorker] = {}
+
+    # -- Public
+
+    def load_rows(self, first: int, last: int):
+        """Loads thumbnails for the given (visible) rows, dropping loads for other rows that
+        haven't started yet.
+        """
+        filepaths = [filepath for filepath in self._filepaths[first:last + 1] if filepath]
+        visible = set(filepaths)
+        for filepath, worker in list(self._pending.items()):
+            if filepath not in visible and self._thread_pool.tryTake(worker):
+                del self._pending[filepath]
+        for filepath in filepaths:
+            if filepath not in self._icons:
+                self._load_icon(filepath)
+        self._update_queue_gauge()
+
+    def set_filenames(self, filenames: List[str]):
+        self.beginResetModel()
+        # Drop thumbnail loads for the previous results that haven't started yet
+        self._thread_pool.clear()
+        self._pending.clear()
+        self._update_queue_gauge()
+        self._filenames = filenames
+        self._row_count = 0
+        self._filepaths = []
+        self._rows_by_filepath = {}
+        self.endResetModel()
+
+    # -- Overrides
+
+    def rowCount(self, parent=QModelIndex()) -> int:
+        return 0 if parent.isValid() else self._row_count
+
+    def canFetchMore(self, parent=QModelIndex()) -> bool:
+        return not parent.isValid() and self._row_count < len(self._filenames)
+
+    def fetchMore(self, parent=QModelIndex()):
+        start = self._row_count
+        end = min(start + self.batch_size, len(self._filenames))
+        with diagnostics.action('gallery.fetch'):
+            filepaths = get_file_paths(self._filenames[start:end])
+
+        self.beginInsertRows(QModelIndex(), start, end - 1)
+        for row, filepath in enumerate(filepaths, start):
+            self._filepaths.append(filepath)
+            if filepath:
+                self._rows_by_filepath[filepath] = row
+        self._row_count = end
+        self.endInsertRows()
+
+    def data(self, index: QModelIndex, role: int = Qt.DisplayRole):
+        if not index.isValid() or index.row() >= self._row_count:
+            return None
+        filepath = self._filepaths[index.row()]
+
+        if role == Qt.StatusTipRole:
+            # Filepath to be retrieved by other components
+            return filepath
+        if role == Qt.ToolTipRole:
+            return self._filenames[index.row()]
+        if role == Qt.SizeHintRole:
+            return self._cell_size
+        if role in (Qt.DecorationRole, Qt.DisplayRole):
+            # Loads are started by the view for visible rows only (see `load_rows`)
+            cached = self._cached_icon(filepath, count=role == Qt.DecorationRole)
+            if cached:
+                icon, label = cached
+                return icon if role == Qt.DecorationRole else label
+            if role == Qt.DecorationRole:
+                return self._placeholder
+            return '' if filepath else 'Not found'
+        return None
 
     # -- Helpers
 
-    def _change_page(self, idx: int):
-        start, end = self.images_per_page * idx, self.images_per_page * (idx + 1)
-        filepaths = get_file_paths(ROOT_DIR, self._all_filenames[start:end])
-        self._populate(filepaths)
-
-    def _populate(self, filepaths: List[str]):
-        self._gallery.clear()
-        for i, filepath in enumerate(filepaths):
-            if not filepath:
-                continue
-            # Thumbnail loads are a little slow, so push them to the background
-            worker = IconWorker(i, filepath)
-            worker.signal.result.connect(self._set_icon)
-            self._thread_pool.start(worker)
-
-    def _set_icon(self, result: Tuple[int, QIcon, str, str]):
-        (idx, icon, filepath, label) = result
-        item = QListWidgetItem(icon, label)
-        # Store filepath to be retrieved by other components
-        item.setData(Qt.StatusTipRole, filepath)
-        self._gallery.addItem(item)
+    def _cached_icon(self, filepath: str, count: bool) -> Optional[Tuple[QIcon, str]]:
+        cached = self._icons.get(filepath)
+        if cached:
+            self._icons.move_to_end(filepath)
+        if count and filepath:
+            diagnostics.record_cache('thumbnails', hit=cached is not None)
+        return cached
+
+    def _load_icon(self, filepath: str):
+        if not filepath or filepath in self._pending:
+            return
+        # Thumbnail loads are a little slow, so push them to the background
+        worker = IconWorker(filepath, self._thumbnail_height)
+        worker.signal.result.connect(self._set_icon)
+        self._pending[filepath] = worker
+        self._thread_pool.start(worker)
+
+    def _set_icon(self, result: Tuple[str, QImage, str]):
+        (filepath, image, label) = result
+        if filepath not in self._pending:
+            # Stale result from a previous search
+            return
+        del self._pending[filepath]
+        self._update_queue_gauge()
+
+        self._icons[filepath] = (QIcon(QPixmap.fromImage(image)), label)
+        while len(self._icons) > self.max_cached_icons:
+            self._icons.popitem(last=False)
+
+        row = self._rows_by_filepath.get(filepath)
+        if row is not None:
+            index = self.index(row)
+            self.dataChanged.emit(index, index, [Qt.DecorationRole, Qt.DisplayRole])
+
+    def _update_queue_gauge(self):
+        diagnostics.set_gauge('gallery.thumbnail_queue', len(self._pending))
+        diagnostics.set_gauge('gallery.active_threads', self._thread_pool.activeThreadCount())
+        diagnostics.set_gauge('gallery.cached_icons', len(self._icons))
 
 
 # Signals must be defined on a QObject (or descendant)
@@ -142,18 +343,22 @@ class IconWorkerSignal(QObject):
 
 
 class IconWorker(QRunnable):
-    """An async worker used to load thumbnails in the background."""
-    def __init__(self, item_idx: int, filepath: str):
+    """An async worker used to load thumbnails in the background.
+
+    Decodes the first frame only, straight to thumbnail size (which is much cheaper than a full
+    decode for e.g. JPEGs), into a `QImage`, since pixmaps can only be created on the GUI thread.
+    """
+    def __init__(self, filepath: str, height: int):
         super().__init__()
-        self._item_idx = item_idx
         self._filepath = filepath
+        self._height = height
         self.signal = IconWorkerSignal()
 
     @Slot()
     def run(self):
-        icon = QIcon(self._filepath)
+        image = decode_image(self._filepath, max_height=self._height)
         label = self._get_label()
-        self.signal.result.emit((self._item_idx, icon, self._filepath, label))
+        self.signal.result.emit((self._filepath, image, label))
 
     def _get_label(self):
         filename = os.path.split(self._filepath)[-1]
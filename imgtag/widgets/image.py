@@ -1,14 +1,22 @@
-from PySide2.QtCore import Qt
-from PySide2.QtGui import QPixmap
+from typing import Dict, Optional, Tuple
+
+from PySide2.QtCore import QObject, QRunnable, QSize, Qt, QThreadPool, Signal, Slot
+from PySide2.QtGui import QImage, QImageReader, QMovie, QPixmap
 from PySide2.QtWidgets import QLabel, QSizePolicy
 
+from .. import diagnostics
+from ..decoding import decode_image, is_animated
 from ..logger import get_logger
 
 logger = get_logger(__name__)
 
 
 class ImageView(QLabel):
-    """A simple image display."""
+    """A simple image display.
+
+    Large images are shown downscaled (see `decoding`), and animations are played with a `QMovie`,
+    which decodes each frame as it is shown rather than holding all of them in memory.
+    """
     def __init__(self):
         super().__init__()
         self.setSizePolicy(QSizePolicy.Ignored, QSizePolicy.Ignored)
@@ -16,14 +24,28 @@ class ImageView(QLabel):
         self._pixmap = QPixmap()
         self._pixmap.fill()
         self._has_image = False
+        self._movie: Optional[QMovie] = None
+        # Original dimensions of the animation
+        self._movie_size = QSize()
 
-    def load(self, filepath: str):
+    def load(self, filepath: str, image: Optional[QImage] = None):
+        """Shows the image at the given path, or the given already decoded image of it."""
+        self._stop_movie()
         self._has_image = True
-        self._pixmap = QPixmap(filepath)
-        self.setPixmap(
-            self._pixmap.scaled(self.size(), Qt.KeepAspectRatio, Qt.SmoothTransformation))
+        if image is None and is_animated(filepath):
+            self._pixmap = QPixmap()
+            self._movie = QMovie(filepath)
+            self._movie.setCacheMode(QMovie.CacheNone)
+            self._movie_size = QImageReader(filepath).size()
+            self._fit_movie()
+            self.setMovie(self._movie)
+            self._movie.start()
+            return
+        self._pixmap = QPixmap.fromImage(image or decode_image(filepath, wait=False))
+        self._fit_pixmap()
 
     def clear(self):
+        self._stop_movie()
         self._has_image = False
         pixmap = QPixmap()
         pixmap.fill()
@@ -31,6 +53,90 @@ class ImageView(QLabel):
 
     # Override
     def resizeEvent(self, _event):
-        if self._has_image:
-            self.setPixmap(
-                self._pixmap.scaled(self.size(), Qt.KeepAspectRatio, Qt.SmoothTransformation))
+        if self._movie:
+            self._fit_movie()
+        elif self._has_image:
+            self._fit_pixmap()
+
+    # -- Helpers
+
+    def _fit_pixmap(self):
+        self.setPixmap(
+            self._pixmap.scaled(self.size(), Qt.KeepAspectRatio, Qt.SmoothTransformation))
+
+    def _fit_movie(self):
+        if self._movie_size.isValid():
+            # Frames are decoded straight to this size
+            self._movie.setScaledSize(self._movie_size.scaled(self.size(), Qt.KeepAspectRatio))
+
+    def _stop_movie(self):
+        if self._movie:
+            self._movie.stop()
+            # NOTE: Setting a pixmap (see `load` and `clear`) detaches the movie from the label
+            self._movie.deleteLater()
+            self._movie = None
+
+
+class ImagePrefetcher(QObject):
+    """Decodes full images in the background ahead of time, e.g. the next image to be shown."""
+
+    # Maximum number of decoded images kept
+    max_images = 2
+
+    def __init__(self):
+        super().__init__()
+        self._thread_pool = QThreadPool()
+        self._thread_pool.setMaxThreadCount(1)
+        # Filepath -> decoded image (None while decoding)
+        self._images: Dict[str, Optional[QImage]] = {}
+
+    # -- Public
+
+    def prefetch(self, filepath: str):
+        if filepath in self._images:
+            return
+        while len(self._images) >= self.max_images:
+            del self._images[next(iter(self._images))]
+        self._images[filepath] = None
+        worker = DecodeWorker(filepath)
+        worker.signal.result.connect(self._set_image)
+        self._thread_pool.start(worker)
+
+    def take(self, filepath: str) -> Optional[QImage]:
+        """Returns (and forgets) the decoded image, or None if it hasn't been decoded (yet)."""
+        image = self._images.pop(filepath, None)
+        diagnostics.record_cache('prefetched_images', hit=image is not None)
+        return image
+
+    # -- Callbacks
+
+    def _set_image(self, result: Tuple[str, QImage]):
+        filepath, image = result
+        # Ignore images that have been taken or evicted in the meantime
+        if filepath in self._images and not image.isNull():
+            self._images[filepath] = image
+
+
+# Signals must be defined on a QObject (or descendant)
+class DecodeWorkerSignal(QObject):
+    result = Signal(tuple)
+
+
+class DecodeWorker(QRunnable):
+    """An async worker that decodes a full image into a `QImage` (since pixmaps can only be created
+    on the GUI thread).
+
+    Animations aren't decoded (a null image is returned), since `ImageView` plays them as movies.
+    """
+    def __init__(self, filepath: str):
+        super().__init__()
+        self._filepath = filepath
+        self.signal = DecodeWorkerSignal()
+
+    @Slot()
+    def run(self):
+        if is_animated(self._filepath):
+            image = QImage()
+        else:
+            image = decode_image(self._filepath)
+        self.signal.result.emit((self._filepath, image))
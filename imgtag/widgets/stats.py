@@ -0,0 +1,63 @@
+from PySide2.QtCore import QObject, QRunnable, QThreadPool, Signal, Slot
+from PySide2.QtGui import QFontDatabase
+from PySide2.QtWidgets import QDialog, QGridLayout, QPlainTextEdit, QPushButton
+
+from ..analytics import compute_stats, format_stats
+
+
+class StatsView(QDialog):
+    """A dialog showing library statistics (computed in the background, since it reads the whole
+    database).
+    """
+    def __init__(self, parent=None):
+        super().__init__(parent)
+
+        self.setWindowTitle('Library statistics')
+        self.resize(800, 600)
+
+        self._thread_pool = QThreadPool()
+
+        layout = QGridLayout()
+        self.setLayout(layout)
+
+        self._text = QPlainTextEdit()
+        self._text.setReadOnly(True)
+        self._text.setFont(QFontDatabase.systemFont(QFontDatabase.FixedFont))
+        layout.addWidget(self._text, 0, 0)
+
+        self._refresh_button = QPushButton('Refresh')
+        self._refresh_button.clicked.connect(self.refresh)
+        layout.addWidget(self._refresh_button, 1, 0)
+
+        self.refresh()
+
+    # -- Public
+
+    def refresh(self):
+        self._refresh_button.setEnabled(False)
+        self._text.setPlainText('Computing...')
+        worker = StatsWorker()
+        worker.signal.result.connect(self._set_report)
+        self._thread_pool.start(worker)
+
+    # -- Callbacks
+
+    def _set_report(self, report: str):
+        self._text.setPlainText(report)
+        self._refresh_button.setEnabled(True)
+
+
+# Signals must be defined on a QObject (or descendant)
+class StatsWorkerSignal(QObject):
+    result = Signal(str)
+
+
+class StatsWorker(QRunnable):
+    """An async worker that computes the statistics report."""
+    def __init__(self):
+        super().__init__()
+        self.signal = StatsWorkerSignal()
+
+    @Slot()
+    def run(self):
+        self.signal.result.emit(format_stats(compute_stats()))
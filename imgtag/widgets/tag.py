@@ -1,26 +1,57 @@
+import datetime
+import html
 import os
-from typing import Callable
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
-from PySide2.QtCore import QEvent, QModelIndex, Qt, Signal
+from PySide2.QtCore import (QEvent, QModelIndex, QObject, QRunnable, Qt, QThreadPool, QTimer,
+                            Signal, Slot)
 from PySide2.QtGui import QContextMenuEvent, QStandardItem, QStandardItemModel
-from PySide2.QtWidgets import (QAction, QGridLayout, QHeaderView, QLabel, QLineEdit, QMenu,
-                               QTableView, QWidget)
+from PySide2.QtWidgets import (QAction, QComboBox, QGridLayout, QHeaderView, QLabel, QLineEdit,
+                               QMenu, QTableView, QWidget)
 
-from ..data import add_file_tag, get_file_tags, remove_file_tag
+from .. import diagnostics
+from ..completer import TagCompleter
+from ..cooccurrence import get_cooccurrence
+from ..data import get_file_metadata, get_file_tags
 from ..logger import get_logger
+from ..settings import SUGGESTIONS_ENABLED
 from ..state import GlobalState
-from ..utils import is_image_file
+from ..utils import is_image_file, normalize_tagname
+from ..writes import RatingEdit, TagEdit, apply_pending, apply_pending_rating
 
 logger = get_logger(__name__)
 
 
 class FileTagView(QWidget):
-    """Combines a tag entry field and tag list table."""
+    """Combines a tag entry field and tag list table, plus suggestions of related tags, a rating
+    selector and the image's attributes.
+
+    The file's tags and attributes are read in the background, and pending edits applied on top of
+    them, so edits show without reading them again.
+    """
+
+    # Maximum number of suggested tags shown
+    max_suggestions = 8
+    # Delay before re-reading the file's tags once edits are written, to coalesce bursts of writes
+    reload_delay_ms = 50
+
     def __init__(self, global_state: GlobalState):
         super().__init__()
 
         self.global_state = global_state
         self._selected_filepath = ''
+        # Rating of the selected file, including pending edits
+        self._rating_value: Optional[int] = None
+        # The selected file's tags and attributes as last read, without pending edits
+        self._file_tags: List[Tuple[str, Optional[int]]] = []
+        self._meta: Optional[Dict[str, Any]] = None
+
+        self._thread_pool = QThreadPool()
+        self._thread_pool.setMaxThreadCount(1)
+        self._reload_timer = QTimer(self)
+        self._reload_timer.setSingleShot(True)
+        self._reload_timer.setInterval(self.reload_delay_ms)
+        self._reload_timer.timeout.connect(self._reload)
 
         layout = QGridLayout()
         layout.setContentsMargins(0, 0, 0, 0)
@@ -33,15 +64,43 @@ class FileTagView(QWidget):
         self._entry.setCompleter(self.global_state.tag_completer)
         layout.addWidget(self._entry, 0, 1)
 
+        # Rating and attributes
+        layout.addWidget(QLabel('Rating:'), 1, 0)
+        info_layout = QGridLayout()
+        self._rating = QComboBox()
+        self._rating.addItems(['Unrated'] + ['\u2605' * rating for rating in range(1, 6)])
+        self._rating.activated.connect(self._set_rating)
+        info_layout.addWidget(self._rating, 0, 0)
+        self._info = QLabel()
+        info_layout.addWidget(self._info, 0, 1)
+        info_layout.setColumnStretch(1, 1)
+        layout.addLayout(info_layout, 1, 1)
+
         # Tag list
         self._taglist = TagListView(self._remove_file_tag)
-        layout.addWidget(self._taglist, 1, 0, 1, 2)
+        layout.addWidget(self._taglist, 2, 0, 1, 2)
+
+        # Related tag suggestions (hidden if disabled)
+        self._suggestions = QLabel()
+        self._suggestions.setWordWrap(True)
+        self._suggestions.setTextFormat(Qt.RichText)
+        self._suggestions.linkActivated.connect(self._add_suggested_tag)
+        self._suggestions.setVisible(SUGGESTIONS_ENABLED)
+        layout.addWidget(self._suggestions, 3, 0, 1, 2)
+
+        signals = self.global_state.tag_edit_signals
+        signals.edited.connect(self._on_tags_edited)
+        signals.written.connect(self._on_tags_written)
 
     # -- Public
 
     def load(self, filepath: str):
         self._selected_filepath = filepath
-        self._taglist.load(self._selected_filename)
+        self._file_tags = []
+        self._meta = None
+        self._show()
+        self._reload_timer.stop()
+        self._reload()
 
     # -- Properties
 
@@ -64,21 +123,112 @@ class FileTagView(QWidget):
     def _add_file_tag(self):
         if not is_image_file(self._selected_filepath):
             return
-        tagname = self._entry.text().strip().replace(' ', '_').lower()
+        tagname = normalize_tagname(self._entry.text())
         if tagname == '':
             return
-        add_file_tag(self._selected_filename, tagname)
-        self._taglist.load(self._selected_filename)
+        with diagnostics.action('tag.add'):
+            # Aliases are resolved when written
+            self._edit(tagname, add=True)
         self._entry.clear()
 
+    def _add_suggested_tag(self, tagname: str):
+        if not is_image_file(self._selected_filepath):
+            return
+        with diagnostics.action('tag.add_suggested'):
+            self._edit(tagname, add=True)
+
     def _remove_file_tag(self):
-        remove_file_tag(self._selected_filename, self._selected_tag)
-        self._taglist.load(self._selected_filename)
+        tagname = self._selected_tag
+        if tagname == '':
+            return
+        with diagnostics.action('tag.remove'):
+            self._edit(tagname, add=False)
+
+    def _set_rating(self, index: int):
+        if not is_image_file(self._selected_filepath):
+            return
+        # Index 0 is unrated
+        rating = index or None
+        if rating != self._rating_value:
+            with diagnostics.action('file.rate'):
+                self.global_state.write_queue.submit(
+                    [RatingEdit(self._selected_filename, rating, self._rating_value)])
+
+    def _on_tags_edited(self, filenames: List[str]):
+        if self._selected_filename in filenames:
+            self._show()
+
+    def _on_tags_written(self, filenames: List[str]):
+        if self._selected_filename in filenames:
+            self._reload_timer.start()
+
+    def _set_file_tags(self, result: tuple):
+        filename, file_tags, meta = result
+        # Ignore files no longer selected
+        if filename == self._selected_filename:
+            self._file_tags = file_tags
+            self._meta = meta
+            self._show()
+
+    # -- Helpers
+
+    def _edit(self, tagname: str, add: bool):
+        # Only queue edits that change something (see `WriteQueue`); the view is refreshed via the
+        # `edited` signal without waiting for the write
+        if (tagname in self._taglist.tagnames()) != add:
+            self.global_state.write_queue.submit([TagEdit(self._selected_filename, tagname, add)])
+
+    def _reload(self):
+        # Queued reads are superseded by this one
+        self._thread_pool.clear()
+        worker = FileTagsWorker(self._selected_filename)
+        worker.signal.result.connect(self._set_file_tags)
+        self._thread_pool.start(worker)
+
+    def _show(self):
+        pending_edits = self.global_state.write_queue.pending_edits(self._selected_filename)
+        self._taglist.set_tags(apply_pending(self._file_tags, pending_edits))
+        self._update_suggestions()
+
+        self._rating_value = apply_pending_rating(self._meta['rating'] if self._meta else None,
+                                                  pending_edits)
+        self._rating.setCurrentIndex(self._rating_value or 0)
+        self._info.setText(_describe(self._meta) if self._meta else '')
+
+    def _update_suggestions(self):
+        index = get_cooccurrence()
+        tagnames = self._taglist.tagnames()
+        if not index or not tagnames:
+            self._suggestions.setText('')
+            return
+        links = [
+            f'<a href="{html.escape(name)}">{html.escape(name)}</a> ({count})'
+            for name, count in index.related_tags(tagnames, k=self.max_suggestions)
+        ]
+        self._suggestions.setText('Suggested: ' + ', '.join(links) if links else '')
+
+
+# Signals must be defined on a QObject (or descendant)
+class FileTagsWorkerSignal(QObject):
+    result = Signal(tuple)
+
+
+class FileTagsWorker(QRunnable):
+    """An async worker that reads a file's tags and attributes."""
+    def __init__(self, filename: str):
+        super().__init__()
+        self._filename = filename
+        self.signal = FileTagsWorkerSignal()
+
+    @Slot()
+    def run(self):
+        self.signal.result.emit(
+            (self._filename, get_file_tags(self._filename), get_file_metadata(self._filename)))
 
 
 class TagListView(QTableView):
     """A tag list table with an optional context menu."""
-    def __init__(self, callback_remove_tag: Callable = None):
+    def __init__(self, callback_remove_tag: Optional[Callable] = None):
         super().__init__()
 
         self._callback_remove_tag = callback_remove_tag
@@ -108,11 +258,20 @@ class TagListView(QTableView):
     def tag_by_index(self, idx: QModelIndex) -> str:
         return self.model().itemFromIndex(idx).text()
 
-    def load(self, filename: str):
+    def tagnames(self) -> List[str]:
+        model = self.model()
+        return [model.item(row, 0).text() for row in range(model.rowCount())]
+
+    def load(self, filename: str, pending_edits: List[TagEdit] = []):
+        """Shows the file's tags, including any edits that haven't been written yet."""
+        self.set_tags(apply_pending(get_file_tags(filename), pending_edits))
+
+    def set_tags(self, tags: List[Tuple[str, Optional[int]]]):
         model = self.model()
         model.removeRows(0, model.rowCount())
-        for name, file_count in get_file_tags(filename):
-            model.appendRow([QStandardItem(name), QStandardItem(str(file_count))])
+        for name, file_count in tags:
+            count = '' if file_count is None else str(file_count)
+            model.appendRow([QStandardItem(name), QStandardItem(count)])
 
 
 class MultiTagEntry(QLineEdit):
@@ -121,6 +280,7 @@ class MultiTagEntry(QLineEdit):
     def __init__(self, parent=None):
         super().__init__(parent)
         self.tabPressed.connect(self.cycle_completion)
+        self.textEdited.connect(self._update_completions)
 
     def cycle_completion(self):
         self.completer().popup().setCurrentIndex(self.completer().currentIndex())
@@ -128,8 +288,25 @@ class MultiTagEntry(QLineEdit):
         if not self.completer().setCurrentRow(idx + 1):
             self.completer().setCurrentRow(0)
 
+    def _update_completions(self, text: str):
+        completer = self.completer()
+        if isinstance(completer, TagCompleter):
+            completer.update_completions(text)
+
     def event(self, event):
         if event.type() == QEvent.KeyPress and event.key() == Qt.Key_Tab:
             self.tabPressed.emit()
             return True
         return super().event(event)
+
+
+def _describe(meta: dict) -> str:
+    """Summarizes an image's attributes, e.g. `1920x1080 PNG, 1.2 MB, 2020-05-16 12:00`."""
+    parts = []
+    if meta['width'] and meta['height']:
+        parts.append(f'{meta["width"]}x{meta["height"]} {(meta["format"] or "").upper()}'.strip())
+    if meta['size'] is not None:
+        parts.append(f'{meta["size"] / (1 << 20):.1f} MB')
+    if meta['mtime'] is not None:
+        parts.append(datetime.datetime.fromtimestamp(meta['mtime']).strftime('%Y-%m-%d %H:%M'))
+    return ', '.join(parts)
@@ -0,0 +1,296 @@
+"""Provides a write-behind queue for tag (and rating) edits, with undo/redo.
+
+Edits are submitted from the GUI thread and return immediately; views show them optimistically (see
+`WriteQueue.pending_edits`) until they are written. A background thread coalesces pending edits per
+(file, tag), so e.g. adding and then removing a tag before it is written cancels out, and writes
+each batch in a single transaction.
+"""
+
+import threading
+from collections import OrderedDict, deque
+from typing import Callable, Deque, Dict, List, NamedTuple, Optional, Sequence, Set, Tuple, Union
+
+from . import diagnostics
+from .data import add_file_tag, batched_writes, remove_file_tag, set_file_rating
+from .diagnostics import timed
+from .logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class TagEdit(NamedTuple):
+    """Adding (or removing) a tag to (or from) a file.
+
+    Added tags also add the tags they imply, unless `with_implied` is False.
+    """
+    filename: str
+    tagname: str
+    add: bool
+    with_implied: bool = True
+
+    def inverse(self) -> 'TagEdit':
+        # Only restore the one row (e.g. re-adding a removed tag shouldn't re-add implied tags)
+        return self._replace(add=not self.add, with_implied=False)
+
+
+class RatingEdit(NamedTuple):
+    """Changing a file's rating (None for unrated)."""
+    filename: str
+    rating: Optional[int]
+    previous_rating: Optional[int]
+
+    def inverse(self) -> 'RatingEdit':
+        return self._replace(rating=self.previous_rating, previous_rating=self.rating)
+
+
+Edit = Union[TagEdit, RatingEdit]
+EditKey = Tuple[str, Optional[str]]
+
+
+class WriteQueue(object):
+    """Writes tag edits on a background thread, and keeps a journal of them for undo/redo.
+
+    Edits are assumed to change the state they are applied to (i.e. a tag is only added if the file
+    doesn't already have it, and ratings record the rating they replace), which is what makes
+    cancelling out opposite edits safe.
+
+    Once written, added tags in the journal are replaced by the tags that were actually added
+    (including implied ones), so that undo removes exactly those rows and redo adds them back.
+    Edits that fail to be written are dropped from the journal, since it no longer matches the
+    database.
+
+    `on_edited` is called with the affected filenames whenever edits are submitted, undone or
+    redone (on the calling thread), and `on_written` whenever a batch has been written (on the
+    writer thread), with the exception if writing failed.
+    """
+
+    # Seconds to wait for more edits before writing, so that bursts end up in one transaction
+    write_delay = 0.1
+    # Maximum number of undoable submissions
+    max_journal = 1000
+
+    def __init__(self,
+                 on_edited: Optional[Callable[[Set[str]], None]] = None,
+                 on_written: Optional[Callable[[Set[str], Optional[Exception]], None]] = None):
+        self._on_edited = on_edited
+        self._on_written = on_written
+
+        self._condition = threading.Condition()
+        # Latest edit per (file, tag) (or (file, None) for ratings), oldest first
+        self._pending: 'OrderedDict[EditKey, Edit]' = OrderedDict()
+        # The journal entry each pending edit came from (submitted, undone or redone)
+        self._pending_entries: Dict[EditKey, List[Edit]] = {}
+        # Edits being written
+        self._writing: List[Edit] = []
+        self._closed = False
+
+        # Each entry is a list of edits submitted together (guarded by the condition, since entries
+        # are updated once written)
+        self._undo_stack: Deque[List[Edit]] = deque(maxlen=self.max_journal)
+        self._redo_stack: List[List[Edit]] = []
+
+        self._thread = threading.Thread(target=self._run, name='write-queue', daemon=True)
+        self._thread.start()
+
+    # -- Public
+
+    def submit(self, edits: List[Edit]):
+        """Queues the given edits as a single undoable step."""
+        if not edits:
+            return
+        entry = list(edits)
+        with self._condition:
+            self._undo_stack.append(entry)
+            self._redo_stack.clear()
+            self._enqueue(entry, entry)
+        self._notify_edited(entry)
+
+    def undo(self) -> bool:
+        """Queues the inverse of the last submitted (or redone) edits, if any."""
+        with self._condition:
+            if not self._undo_stack:
+                return False
+            entry = self._undo_stack.pop()
+            self._redo_stack.append(entry)
+            self._enqueue([edit.inverse() for edit in reversed(entry)], entry)
+        self._notify_edited(entry)
+        return True
+
+    def redo(self) -> bool:
+        """Queues the last undone edits again, if any."""
+        with self._condition:
+            if not self._redo_stack:
+                return False
+            entry = self._redo_stack.pop()
+            self._undo_stack.append(entry)
+            self._enqueue(list(entry), entry)
+        self._notify_edited(entry)
+        return True
+
+    @property
+    def can_undo(self) -> bool:
+        return bool(self._undo_stack)
+
+    @property
+    def can_redo(self) -> bool:
+        return bool(self._redo_stack)
+
+    def pending_edits(self, filename: str) -> List[Edit]:
+        """Returns the edits to the given file that haven't been written yet, oldest first."""
+        with self._condition:
+            edits = self._writing + list(self._pending.values())
+        return [edit for edit in edits if edit.filename == filename]
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Waits until all queued edits are written, returning False on timeout."""
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._pending and not self._writing,
+                                            timeout)
+
+    def close(self):
+        """Writes all queued edits and stops the writer thread."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+
+    # -- Helpers
+
+    def _enqueue(self, edits: List[Edit], entry: List[Edit]):
+        """Queues edits that came from (or undo) the given journal entry."""
+        with self._condition:
+            if self._closed:
+                raise RuntimeError('Write queue is closed')
+            for edit in edits:
+                key = _key(edit)
+                previous = self._pending.pop(key, None)
+                coalesced = _coalesce(previous, edit) if previous else edit
+                if coalesced:
+                    self._pending[key] = coalesced
+                    self._pending_entries[key] = entry
+                else:
+                    self._pending_entries.pop(key, None)
+            self._update_gauge()
+            self._condition.notify_all()
+
+    def _notify_edited(self, edits: List[Edit]):
+        if self._on_edited:
+            self._on_edited({edit.filename for edit in edits})
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._pending or self._closed)
+                # Give bursts of edits a chance to be batched together
+                self._condition.wait_for(lambda: self._closed, self.write_delay)
+                if not self._pending:
+                    return
+                self._writing = list(self._pending.values())
+                entries = [self._pending_entries.pop(key) for key in self._pending]
+                self._pending.clear()
+                edits = self._writing
+
+            error = None
+            added: List[List[str]] = []
+            try:
+                added = self._write(edits)
+            except Exception as e:
+                logger.exception(f'Failed to write {len(edits)} tag edit(s)')
+                error = e
+
+            with self._condition:
+                for i, (edit, entry) in enumerate(zip(edits, entries)):
+                    if error:
+                        _drop_edit(entry, edit)
+                    elif isinstance(edit, TagEdit) and edit.add:
+                        _replace_added(entry, edit, added[i])
+                self._drop_empty_entries()
+                self._writing = []
+                self._update_gauge()
+                self._condition.notify_all()
+            if self._on_written:
+                self._on_written({edit.filename for edit in edits}, error)
+
+    @timed
+    def _write(self, edits: List[Edit]) -> List[List[str]]:
+        """Writes the edits, returning the names of the tags each one actually added."""
+        added = []
+        with batched_writes():
+            for edit in edits:
+                tagnames = []
+                if isinstance(edit, RatingEdit):
+                    set_file_rating(edit.filename, edit.rating)
+                elif edit.add:
+                    tagnames = add_file_tag(edit.filename, edit.tagname, edit.with_implied)
+                else:
+                    remove_file_tag(edit.filename, edit.tagname)
+                added.append(tagnames)
+        logger.info(f'Wrote {len(edits)} tag edit(s)')
+        return added
+
+    def _drop_empty_entries(self):
+        # E.g. if all of an entry's edits failed, or its tags turned out to exist already
+        for stack in (self._undo_stack, self._redo_stack):
+            kept = [entry for entry in stack if entry]
+            if len(kept) < len(stack):
+                stack.clear()
+                stack.extend(kept)
+
+    def _update_gauge(self):
+        diagnostics.set_gauge('writes.pending', len(self._pending) + len(self._writing))
+
+
+def apply_pending(tags: List[Tuple[str, Optional[int]]],
+                  edits: Sequence[Edit]) -> List[Tuple[str, Optional[int]]]:
+    """Applies pending edits to a file's (tag name, file count) list, as from `get_file_tags`.
+
+    Added tags have an unknown (None) file count until written.
+    """
+    counts: Dict[str, Optional[int]] = dict(tags)
+    for edit in edits:
+        if not isinstance(edit, TagEdit):
+            continue
+        if edit.add:
+            counts.setdefault(edit.tagname, None)
+        else:
+            counts.pop(edit.tagname, None)
+    return sorted(counts.items())
+
+
+def apply_pending_rating(rating: Optional[int], edits: Sequence[Edit]) -> Optional[int]:
+    """Applies pending edits to a file's rating."""
+    for edit in edits:
+        if isinstance(edit, RatingEdit):
+            rating = edit.rating
+    return rating
+
+
+def _key(edit: Edit) -> EditKey:
+    return (edit.filename, edit.tagname if isinstance(edit, TagEdit) else None)
+
+
+def _drop_edit(entry: List[Edit], edit: Edit):
+    """Removes a failed edit from a journal entry."""
+    entry[:] = [other for other in entry if _key(other) != _key(edit)]
+
+
+def _replace_added(entry: List[Edit], edit: TagEdit, tagnames: List[str]):
+    """Replaces a written tag addition in a journal entry with the tags it actually added."""
+    for i, other in enumerate(entry):
+        if isinstance(other, TagEdit) and other.add and _key(other) == _key(edit):
+            entry[i:i + 1] = [
+                TagEdit(edit.filename, tagname, add=True, with_implied=False)
+                for tagname in tagnames
+            ]
+            return
+
+
+def _coalesce(previous: Edit, edit: Edit) -> Optional[Edit]:
+    """Combines two consecutive edits of the same thing, returning None if they cancel out."""
+    # Edits of the same thing are of the same type
+    if isinstance(previous, RatingEdit) and isinstance(edit, RatingEdit):
+        edit = edit._replace(previous_rating=previous.previous_rating)
+        return None if edit.rating == edit.previous_rating else edit
+    if isinstance(previous, TagEdit) and isinstance(edit, TagEdit):
+        return None if previous.add != edit.add else edit
+    return edit
@@ -2,13 +2,19 @@
 
 import os
 import sys
+import threading
 
 from PySide2.QtWidgets import QApplication
 
 from imgtag import MainWindow
-from imgtag.data import File, FileTag, Tag, db
+from imgtag.accel import get_index, init_index
+from imgtag.cooccurrence import init_cooccurrence
+from imgtag.data import init_db
 from imgtag.logger import get_logger
-from imgtag.settings import DB_FILEPATH
+from imgtag.metadata import refresh_metadata
+from imgtag.roots import get_roots, scan_roots
+from imgtag.settings import (ACCEL_ENABLED, ACCEL_SNAPSHOT_DIR, DB_FILEPATH,
+                             METADATA_REFRESH_ON_STARTUP, METADATA_WORKERS, SUGGESTIONS_ENABLED)
 
 VER_MAJ_REQ, VER_MIN_REQ = 3, 7
 
@@ -18,11 +24,23 @@ logger = get_logger(__name__)
 def init():
     check_version()
 
-    # Create database if not present
+    # Create database (or any missing tables and indexes)
     if not os.path.exists(DB_FILEPATH):
-        db.connect()
-        db.create_tables([File, Tag, FileTag])
-        logger.debug('Created all tables')
+        logger.info(f'Creating database at {DB_FILEPATH}')
+    init_db()
+
+    if ACCEL_ENABLED:
+        init_index(ACCEL_SNAPSHOT_DIR)
+    if SUGGESTIONS_ENABLED:
+        # Suggestions and facets stay empty until this is done
+        threading.Thread(target=init_cooccurrence, name='cooccurrence-build', daemon=True).start()
+    # Index all roots in the background, so that paths resolve without walking directories
+    scan_roots()
+    if METADATA_REFRESH_ON_STARTUP:
+        threading.Thread(target=refresh_metadata,
+                         args=([root.path for root in get_roots()], METADATA_WORKERS),
+                         name='metadata-refresh',
+                         daemon=True).start()
 
 
 def check_version():
@@ -38,6 +56,10 @@ if __name__ == '__main__':
 
     app = QApplication(sys.argv)
     win = MainWindow()
+    # After the window's handlers, so that queued tag edits are included
+    index = get_index()
+    if index:
+        app.aboutToQuit.connect(lambda: index.save(ACCEL_SNAPSHOT_DIR))
     win.show()
 
     sys.exit(app.exec_())
@@ -0,0 +1,28 @@
+import pytest
+
+from imgtag import data, shards
+from imgtag.data import clear_caches, db, init_db
+
+
+@pytest.fixture
+def database(tmp_path):
+    """A fresh, unsharded database bound to the data layer."""
+    yield from _database(tmp_path, 'none')
+
+
+@pytest.fixture
+def sharded_database(tmp_path, monkeypatch):
+    """A fresh database bound to the data layer, with file tags sharded by year."""
+    monkeypatch.setattr(shards, '_shards', None)
+    monkeypatch.setattr(data, '_shard_models', {})
+    yield from _database(tmp_path, 'year')
+
+
+def _database(tmp_path, shard_by: str):
+    if not db.is_closed():
+        db.close()
+    db.init(str(tmp_path / 'imgtag.db'))
+    init_db(shard_by=shard_by, shard_dir=str(tmp_path / 'shards'))
+    clear_caches()
+    yield db
+    db.close()
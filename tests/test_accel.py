@@ -0,0 +1,19 @@
+from imgtag import accel
+from imgtag.accel import TagIndex
+from imgtag.data import File, add_file_tag
+
+
+def test_build_tolerates_names_older_than_postings(database, monkeypatch):
+    for filename in ['a.png', 'b.png']:
+        add_file_tag(filename, 'cat')
+        add_file_tag(filename, 'dog')
+        if filename == 'a.png':
+            # As if b.png was written between reading the postings and the names
+            names = accel._name_arrays()
+    monkeypatch.setattr(accel, '_name_arrays', lambda: names)
+
+    assert TagIndex.build().search(['cat', 'dog']) == ['a.png', 'b.png']
+
+    # Files unknown to both the arrays and the database are left out
+    File.delete().where(File.name == 'b.png').execute()
+    assert TagIndex.build().search(['cat', 'dog']) == ['a.png']
@@ -0,0 +1,27 @@
+import os
+
+from imgtag.backup import (export_tags, prune_snapshots, read_tag_export, shard_backup_dir,
+                           take_snapshot)
+from imgtag.data import add_file_tag
+from imgtag.shards import get_shards
+
+
+def test_snapshot_includes_shards(sharded_database, tmp_path):
+    add_file_tag('a.png', 'cat')
+    add_file_tag('b.png', 'dog')
+    snapshot_dir = str(tmp_path / 'backups')
+    src = sharded_database.database
+
+    snapshot = take_snapshot(snapshot_dir, keep=1, src=src, shards=get_shards())
+    assert snapshot and os.listdir(shard_backup_dir(snapshot)) == ['year-other.db']
+    export = list(read_tag_export(snapshot[:-len('.db')] + '.tags.tsv'))
+    assert export == [('a.png', 'cat'), ('b.png', 'dog')]
+
+    # Exports of the snapshot come from its own shards, not the live ones
+    add_file_tag('c.png', 'cat')
+    assert export_tags(str(tmp_path / 'tags.tsv'), snapshot) == 2
+    assert export_tags(str(tmp_path / 'tags.tsv'), src) == 3
+
+    # Pruning deletes the shards too
+    assert prune_snapshots(snapshot_dir, keep=0) == [snapshot]
+    assert os.listdir(snapshot_dir) == []
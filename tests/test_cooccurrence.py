@@ -0,0 +1,60 @@
+from imgtag import cooccurrence
+from imgtag.cooccurrence import CooccurrenceIndex, init_cooccurrence
+from imgtag.data import (add_file_tag, add_filetag_observer, remove_file_tag,
+                         remove_filetag_observer)
+
+
+def _build(database) -> CooccurrenceIndex:
+    add_file_tag('a.png', 'cat')
+    add_file_tag('a.png', 'pet')
+    add_file_tag('b.png', 'cat')
+    return CooccurrenceIndex.build()
+
+
+def test_facets_after_adding_then_removing_new_tag(database):
+    index = _build(database)
+    add_filetag_observer(index.on_filetags_changed)
+    try:
+        add_file_tag('a.png', 'indoor')
+        assert dict(index.facets(['a.png', 'b.png']))['indoor'] == 1
+        remove_file_tag('a.png', 'indoor')
+    finally:
+        remove_filetag_observer(index.on_filetags_changed)
+
+    assert index.facets(['a.png', 'b.png']) == [('cat', 2), ('pet', 1)]
+    assert index.related_tags(['cat']) == [('pet', 1)]
+
+
+def test_facets_after_removing_then_readding_tag(database):
+    index = _build(database)
+    add_filetag_observer(index.on_filetags_changed)
+    try:
+        remove_file_tag('a.png', 'pet')
+        assert index.facets(['a.png', 'b.png']) == [('cat', 2)]
+        add_file_tag('a.png', 'pet')
+    finally:
+        remove_filetag_observer(index.on_filetags_changed)
+
+    assert index.facets(['a.png', 'b.png']) == [('cat', 2), ('pet', 1)]
+    assert index.related_tags(['pet']) == [('cat', 1)]
+
+
+def test_init_replays_writes_made_while_building(database, monkeypatch):
+    add_file_tag('a.png', 'cat')
+    build = CooccurrenceIndex.build
+
+    def build_while_writing():
+        # Included in the arrays, but also seen by the observer
+        add_file_tag('a.png', 'pet')
+        index = build()
+        # Committed after the arrays were read
+        add_file_tag('b.png', 'cat')
+        add_file_tag('b.png', 'pet')
+        return index
+
+    monkeypatch.setattr(CooccurrenceIndex, 'build', build_while_writing)
+    monkeypatch.setattr(cooccurrence, '_index', None)
+    index = init_cooccurrence()
+
+    assert index.facets(['a.png', 'b.png']) == [('cat', 2), ('pet', 2)]
+    assert index.related_tags(['cat']) == [('pet', 2)]
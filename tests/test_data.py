@@ -0,0 +1,45 @@
+import time
+
+from imgtag.data import (File, add_file_tag, add_tag_alias, add_tag_implication, get_file_metadata,
+                         get_file_tags, init_db, remove_tag_implication)
+
+
+def _mtime(year: int) -> float:
+    return time.mktime(time.strptime(f'{year}-06-01', '%Y-%m-%d'))
+
+
+def test_file_metadata_counts_tags_in_own_shard(sharded_database, tmp_path):
+    File.insert_many([('a.png', _mtime(2019)), ('b.png', _mtime(2020)), ('c.png', None)],
+                     fields=[File.name, File.mtime]).execute()
+    init_db(shard_by='year', shard_dir=str(tmp_path / 'shards'))
+    for tagname in ['cat', 'dog', 'bird']:
+        add_file_tag('a.png', tagname)
+    add_file_tag('b.png', 'cat')
+
+    assert File.get(name='a.png').shard == '2019'
+    assert get_file_metadata('a.png')['tag_count'] == 3
+    assert get_file_metadata('b.png')['tag_count'] == 1
+    assert get_file_metadata('c.png')['tag_count'] == 0
+    assert get_file_metadata('missing.png') == {
+        'tag_count': 0,
+        'width': None,
+        'height': None,
+        'size': None,
+        'mtime': None,
+        'format': None,
+        'rating': None
+    }
+
+
+def test_file_metadata_unsharded(database):
+    add_file_tag('a.png', 'cat')
+    add_file_tag('a.png', 'dog')
+    assert get_file_metadata('a.png')['tag_count'] == 2
+
+
+def test_remove_implication_through_alias(database):
+    add_tag_alias('kitty', 'cat')
+    add_tag_implication('kitty', 'animal')
+    assert remove_tag_implication('kitty', 'animal') == 1
+    add_file_tag('a.png', 'cat')
+    assert [tagname for tagname, _ in get_file_tags('a.png')] == ['cat']
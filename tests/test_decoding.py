@@ -0,0 +1,51 @@
+import threading
+from typing import List
+
+import pytest
+from PySide2.QtGui import QImage, QImageReader
+
+from imgtag import decoding
+from imgtag.decoding import DecodeBudget, decode_image, plan_decode
+
+SIZE = 4000
+
+
+@pytest.fixture
+def large_image(tmp_path):
+    def save(extension: str) -> str:
+        filepath = str(tmp_path / f'large.{extension}')
+        image = QImage(SIZE, SIZE, QImage.Format_RGB32)
+        image.fill(0xff336699)
+        assert image.save(filepath)
+        return filepath
+
+    return save
+
+
+def test_plan_reserves_full_size_without_scaled_decoding(large_image):
+    plan = plan_decode(QImageReader(large_image('png')), max_height=100)
+    assert plan.full_decode
+    assert plan.nbytes == (SIZE * SIZE + 100 * 100) * decoding.BYTES_PER_PIXEL
+
+    plan = plan_decode(QImageReader(large_image('jpg')), max_height=100)
+    assert not plan.full_decode
+    assert plan.nbytes == 100 * 100 * decoding.BYTES_PER_PIXEL
+
+
+def test_decode_over_budget_runs_alone(large_image, monkeypatch):
+    monkeypatch.setattr(decoding, '_budget', DecodeBudget(32 * 2**20))
+    filepath = large_image('png')
+
+    # Waits for other decodes to finish instead of going over the budget alongside them
+    decoding.get_budget().reserve(2**20)
+    results: List[QImage] = []
+    thread = threading.Thread(target=lambda: results.append(decode_image(filepath, 100)))
+    thread.start()
+    thread.join(0.5)
+    assert thread.is_alive()
+    decoding.get_budget().release(2**20)
+    thread.join(10)
+
+    [thumbnail] = results
+    assert (thumbnail.width(), thumbnail.height()) == (100, 100)
+    assert decoding.get_budget().reserved == 0
@@ -0,0 +1,47 @@
+import pytest
+
+from imgtag import roots
+from imgtag.data import add_file_tag, get_file_paths, get_file_tags
+from imgtag.roots import init_roots
+from imgtag.settings import Root
+
+
+@pytest.fixture
+def root_dir(database, tmp_path, monkeypatch):
+    monkeypatch.setattr(roots, '_indexes', None)
+    root_dir = tmp_path / 'root'
+    (root_dir / 'sub').mkdir(parents=True)
+    (root_dir / 'sub' / 'old.png').touch()
+    return root_dir
+
+
+def _init(root_dir, stale_after: float):
+    (index, ) = init_roots([Root('test', str(root_dir), 0, 1, stale_after)])
+    index.scan()
+
+
+def test_file_added_after_scan_keeps_tags(root_dir):
+    _init(root_dir, stale_after=300)
+    (root_dir / 'sub' / 'new.png').touch()
+    add_file_tag('new.png', 'cat')
+
+    # Not rescanned yet, since the index is up to date
+    assert get_file_paths(['old.png', 'new.png']) == [str(root_dir / 'sub' / 'old.png'), '']
+    assert get_file_tags('new.png') == [('cat', 1)]
+
+
+def test_file_added_after_scan_is_found_once_stale(root_dir):
+    _init(root_dir, stale_after=0)
+    (root_dir / 'sub' / 'new.png').touch()
+    add_file_tag('new.png', 'cat')
+
+    assert get_file_paths(['new.png']) == [str(root_dir / 'sub' / 'new.png')]
+    assert get_file_tags('new.png') == [('cat', 1)]
+
+
+def test_file_missing_from_fresh_scan_is_removed(root_dir):
+    _init(root_dir, stale_after=0)
+    add_file_tag('gone.png', 'cat')
+
+    assert get_file_paths(['gone.png']) == ['']
+    assert get_file_tags('gone.png') == []
@@ -0,0 +1,23 @@
+import time
+
+from imgtag import shards
+from imgtag.shards import MAX_SHARDS, OTHER_SHARD, init_shards, list_shard_files
+
+
+def test_too_many_years_share_the_other_shard(tmp_path, monkeypatch):
+    monkeypatch.setattr(shards, '_shards', None)
+    years = [str(year) for year in range(2000, 2020)]
+    shard_set = init_shards('year', str(tmp_path), years)
+    newest = years[-(MAX_SHARDS - 1):]
+    assert shard_set.names == newest + [OTHER_SHARD]
+    assert len(list_shard_files(str(tmp_path))) == MAX_SHARDS
+
+    def mtime(year: str) -> float:
+        return time.mktime(time.strptime(f'{year}-06-01', '%Y-%m-%d'))
+
+    assert shard_set.shard_of('new.png', None, mtime(years[-1])) == years[-1]
+    assert shard_set.shard_of('old.png', None, mtime(years[0])) == OTHER_SHARD
+
+    # Shards that already exist keep theirs, even once newer years come along
+    shard_set = init_shards('year', str(tmp_path), years + ['2020', '2021'])
+    assert shard_set.names == newest + [OTHER_SHARD]
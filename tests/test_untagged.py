@@ -0,0 +1,28 @@
+import os
+
+from imgtag.data import add_file_tag
+from imgtag.untagged import iter_images, iter_untagged
+
+
+def test_iter_images_skips_symlink_loops(tmp_path):
+    (tmp_path / 'b').mkdir()
+    (tmp_path / 'b' / 'x.png').touch()
+    (tmp_path / 'a.jpg').touch()
+    (tmp_path / 'notes.txt').touch()
+    os.symlink(tmp_path, tmp_path / 'b' / 'loop')
+
+    assert list(iter_images(str(tmp_path))) == [
+        str(tmp_path / 'b' / 'x.png'),
+        str(tmp_path / 'a.jpg'),
+    ]
+
+
+def test_iter_untagged_skips_files_tagged_while_iterating(database, tmp_path):
+    for name in ['a.png', 'b.png', 'c.png']:
+        (tmp_path / name).touch()
+    add_file_tag('a.png', 'cat')
+
+    untagged = iter_untagged([str(tmp_path)])
+    assert next(untagged) == str(tmp_path / 'b.png')
+    add_file_tag('c.png', 'cat')
+    assert list(untagged) == []
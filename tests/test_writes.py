@@ -0,0 +1,69 @@
+import pytest
+
+from imgtag import writes
+from imgtag.data import add_file_tag, add_tag_implication, get_file_tags
+from imgtag.writes import TagEdit, WriteQueue
+
+
+@pytest.fixture
+def queue(database):
+    queue = WriteQueue()
+    queue.write_delay = 0
+    yield queue
+    queue.close()
+
+
+def _tagnames(filename: str):
+    return [tagname for tagname, _ in get_file_tags(filename)]
+
+
+def test_undo_removes_implied_tags(queue):
+    add_tag_implication('cat', 'animal')
+    queue.submit([TagEdit('a.png', 'cat', add=True)])
+    assert queue.flush(5)
+    assert _tagnames('a.png') == ['animal', 'cat']
+
+    queue.undo()
+    assert queue.flush(5)
+    assert _tagnames('a.png') == []
+
+    queue.redo()
+    assert queue.flush(5)
+    assert _tagnames('a.png') == ['animal', 'cat']
+
+
+def test_undo_keeps_implied_tags_that_existed(queue):
+    add_tag_implication('cat', 'animal')
+    add_file_tag('a.png', 'animal')
+    queue.submit([TagEdit('a.png', 'cat', add=True)])
+    assert queue.flush(5)
+
+    queue.undo()
+    assert queue.flush(5)
+    assert _tagnames('a.png') == ['animal']
+
+
+def test_failed_edits_are_dropped_from_journal(database, monkeypatch):
+    errors = []
+    queue = WriteQueue(on_written=lambda _filenames, error: errors.append(error))
+    queue.write_delay = 0
+    try:
+        queue.submit([TagEdit('a.png', 'cat', add=True)])
+        assert queue.flush(5)
+        with monkeypatch.context() as patch:
+            patch.setattr(writes, 'add_file_tag', _fail)
+            queue.submit([TagEdit('a.png', 'dog', add=True)])
+            assert queue.flush(5)
+        assert errors[0] is None and isinstance(errors[1], OSError)
+
+        # Only the successful edit is left to undo
+        assert queue.undo()
+        assert queue.flush(5)
+        assert not queue.can_undo
+        assert _tagnames('a.png') == []
+    finally:
+        queue.close()
+
+
+def _fail(*_args):
+    raise OSError('disk full')